@@ -1,31 +1,150 @@
 # aircraft_map: maintains a list of aircraft "seen" by an ADSB
 # receiver.
 
-import copy
-import datetime
+import bisect
+import collections
 import math
 import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import callback_dispatcher
+import geodesy
+import metrics
+import sbs_parser
 import util
 
 DEFAULT_PURGE_TIME = 120  # Forget planes not heard from in this many seconds
 DEFAULT_PURGE_INTERVAL = 1  # How often to purge stale aircraft
 EARTH_RADIUS = 6371000  # Earth's radius in meters
+MAX_EXTRAPOLATION = 30  # Don't dead-reckon further than this many seconds
+METERS_PER_SECOND_PER_KNOT = 0.514444
+DEFAULT_MOTION_CAPACITY = 256  # Initial rows of a MotionTable; grows as needed
+
+# The IDs of aircraft added, updated and removed by a batch update
+ChangeSet = collections.namedtuple("ChangeSet", ["new", "updated", "removed"])
+
+
+def extrapolate(latitude, longitude, altitude, velocity, dt):
+    """
+    Move a position along velocity (ground speed knots, track degrees,
+    vertical rate feet/minute) for dt seconds, treating the earth as
+    locally flat. Returns (latitude, longitude, altitude).
+    """
+    ground_speed, track, vertical_rate = velocity
+    meters = ground_speed * METERS_PER_SECOND_PER_KNOT * dt
+    track_rad = math.radians(track)
+    d_lat = math.degrees(meters * math.cos(track_rad) / EARTH_RADIUS)
+    d_lon = math.degrees(meters * math.sin(track_rad) / (
+        EARTH_RADIUS * math.cos(math.radians(latitude))))
+    return (latitude + d_lat, longitude + d_lon,
+            altitude + vertical_rate * dt / 60.0)
+
+
+def extrapolate_many(latitudes, longitudes, altitudes, ground_speeds,
+                     tracks, vertical_rates, dts):
+    """
+    As extrapolate(), but for NumPy arrays of positions, velocities and
+    times. Returns arrays (latitudes, longitudes, altitudes).
+    """
+    meters = ground_speeds * METERS_PER_SECOND_PER_KNOT * dts
+    track_rad = numpy.radians(tracks)
+    d_lat = numpy.degrees(meters * numpy.cos(track_rad) / EARTH_RADIUS)
+    d_lon = numpy.degrees(meters * numpy.sin(track_rad) / (
+        EARTH_RADIUS * numpy.cos(numpy.radians(latitudes))))
+    return (latitudes + d_lat, longitudes + d_lon,
+            altitudes + vertical_rates * dts / 60.0)
+
+
+class MotionTable(object):
+    """
+    The last position report and velocity of each aircraft in a map,
+    in NumPy columns with a row per aircraft, so that positions_at()
+    can dead-reckon them all at once. Rows of purged aircraft are
+    reused. An aircraft with no velocity has a zero one, so stays put.
+    """
+    _COLUMNS = ("fix_latitude", "fix_longitude", "fix_altitude", "fix_time",
+                "ground_speed", "track", "vertical_rate")
+
+    def __init__(self, capacity=DEFAULT_MOTION_CAPACITY):
+        for name in self._COLUMNS:
+            setattr(self, name, numpy.zeros(capacity))
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def _grow(self):
+        old_capacity = len(self.fix_time)
+        for name in self._COLUMNS:
+            new = numpy.zeros(old_capacity * 2)
+            new[:old_capacity] = getattr(self, name)
+            setattr(self, name, new)
+        self._free.extend(range(old_capacity * 2 - 1, old_capacity - 1, -1))
+
+    def allocate(self):
+        """Claim a row for a new aircraft and return its index."""
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        self.ground_speed[row] = 0.0
+        self.track[row] = 0.0
+        self.vertical_rate[row] = 0.0
+        return row
+
+    def release(self, aircraft):
+        """Return aircraft's row to be reused, and detach it."""
+        self._free.append(aircraft._row)
+        aircraft._motion = None
+        aircraft._row = None
+
+    def positions_at(self, rows, t):
+        """
+        Dead-reckon the aircraft in rows (an array of row indexes) to
+        time t, as Aircraft.position_at() does. Returns arrays
+        (latitudes, longitudes, altitudes).
+        """
+        dts = numpy.clip(t - self.fix_time[rows], 0.0, MAX_EXTRAPOLATION)
+        return extrapolate_many(
+            self.fix_latitude[rows], self.fix_longitude[rows],
+            self.fix_altitude[rows], self.ground_speed[rows],
+            self.track[rows], self.vertical_rate[rows], dts)
 
 
 class Aircraft(object):
     """Represents a single aircraft"""
-    def __init__(self, id, now=None):
+    __slots__ = ("_id", "_altitude", "_latitude", "_longitude", "_update",
+                 "_create_time", "_observer", "_distance", "_bearing",
+                 "_fix", "_velocity", "_motion", "_row")
+
+    def __init__(self, id, now=None, observer=None, motion=None):
         self._id = id
         self._altitude = 0
         self._latitude = 0.0
         self._longitude = 0.0
         self._update = 0.0
         self._create_time = now or time.time()
+        self._observer = observer  # a geodesy strategy, or None
+        self._distance = None  # to observer, as of the last position change
+        self._bearing = None  # from observer, computed when first needed
+        # (lat, lon, altitude, time) of the last position report, unrounded
+        self._fix = None
+        # (ground speed knots, track degrees, vertical rate feet/minute)
+        self._velocity = None
+        # The MotionTable that _fix and _velocity are copied to, if any
+        self._motion = motion
+        self._row = None if motion is None else motion.allocate()
 
     @property
     def id(self):
+        """The integer ID (see sbs_parser.parse_icao())."""
         return self._id
 
+    @property
+    def icao(self):
+        """The hex ICAO address, for display."""
+        return sbs_parser.format_icao(self._id)
+
     @property
     def altitude(self):
         return self._altitude
@@ -38,9 +157,33 @@ class Aircraft(object):
     def longitude(self):
         return self._longitude
 
+    @property
+    def update_time(self):
+        """When the aircraft's last position report was received."""
+        return self._update
+
+    @property
+    def distance(self):
+        """
+        Distance, in meters, to the observer of the AircraftMap tracking
+        this aircraft.
+        """
+        return self._distance
+
+    @property
+    def bearing(self):
+        """
+        Bearing, in degrees, of this aircraft as seen from the observer
+        of the AircraftMap tracking it.
+        """
+        if self._bearing is None and self._observer is not None:
+            self._bearing = self._observer.bearing(self._latitude,
+                                                   self._longitude)
+        return self._bearing
+
     def __str__(self):
         return "%s: alt %d lat %f lon %f" % (
-            self.id, self.altitude, self.latitude, self.longitude)
+            self.icao, self.altitude, self.latitude, self.longitude)
 
     def __repr__(self):
         return self.__str__()
@@ -63,11 +206,76 @@ class Aircraft(object):
             self._altitude = altitude
             self._latitude = latitude
             self._longitude = longitude
+            self._bearing = None
             updated = True
+        if (updated or self._distance is None) and self._observer is not None:
+            self._distance = self._observer.distance(latitude, longitude)
         self._update = now
         return updated
 
+    def set_fix(self, latitude, longitude, altitude, now):
+        """
+        Record the unrounded position from the latest position report,
+        which position_at() extrapolates from.
+        """
+        self._fix = (latitude, longitude, altitude, now)
+        motion = self._motion
+        if motion is not None:
+            row = self._row
+            motion.fix_latitude[row] = latitude
+            motion.fix_longitude[row] = longitude
+            motion.fix_altitude[row] = altitude
+            motion.fix_time[row] = now
+
+    @property
+    def fix(self):
+        """
+        (latitude, longitude, altitude, time) of the latest position
+        report, unrounded, or None if there hasn't been one.
+        """
+        return self._fix
+
+    def update_velocity(self, ground_speed, track, vertical_rate):
+        """
+        Update an aircraft's ground speed (knots), track (degrees) and
+        vertical rate (feet/minute).
+        """
+        self._velocity = (ground_speed, track, vertical_rate)
+        motion = self._motion
+        if motion is not None:
+            row = self._row
+            motion.ground_speed[row] = ground_speed
+            motion.track[row] = track
+            motion.vertical_rate[row] = vertical_rate
+
+    @property
+    def velocity(self):
+        """
+        (ground speed knots, track degrees, vertical rate feet/minute),
+        or None if no velocity message has been seen.
+        """
+        return self._velocity
+
+    def position_at(self, t):
+        """
+        Return the aircraft's (latitude, longitude, altitude) at time t,
+        dead-reckoned from the last position report using the last
+        reported velocity, for up to MAX_EXTRAPOLATION seconds.
+        """
+        if self._fix is None:
+            return (self._latitude, self._longitude, self._altitude)
+        latitude, longitude, altitude, fix_time = self._fix
+        if self._velocity is None:
+            return (latitude, longitude, altitude)
+        return extrapolate(latitude, longitude, altitude, self._velocity,
+                           min(max(t - fix_time, 0.0), MAX_EXTRAPOLATION))
+
     def distance_to(self, observer_latitude, observer_longitude):
+        observer = self._observer
+        if (observer is not None and
+                observer_latitude == observer.latitude and
+                observer_longitude == observer.longitude):
+            return self._distance
         return util.distance_to(self._latitude, self._longitude,
                                 self._altitude, observer_latitude,
                                 observer_longitude)
@@ -77,25 +285,11 @@ class Aircraft(object):
         Compute the bearing, in degrees, of the aircraft as seen from
         the position given by lat and lon.
         """
-        lat1_rad = math.radians(self._latitude)
-        long1_rad = math.radians(self._longitude)
-        lat2_rad = math.radians(lat)
-        long2_rad = math.radians(lon)
-
-        d_lon = long2_rad - long1_rad
-
-        d_phi = math.log(
-            math.tan(
-                lat2_rad/2.0+math.pi/4.0)/math.tan(lat1_rad/2.0+math.pi/4.0))
-
-        if abs(d_lon) > math.pi:
-            if d_lon > 0.0:
-                d_lon = -(2.0 * math.pi - dLong)
-            else:
-                d_lon = (2.0 * math.pi + dLong)
-
-        bearing = (math.degrees(math.atan2(d_lon, d_phi)) + 360.0) % 360.0;
-        return bearing
+        observer = self._observer
+        if (observer is not None and
+                lat == observer.latitude and lon == observer.longitude):
+            return self.bearing
+        return util.bearing_from(self._latitude, self._longitude, lat, lon)
 
 
 class AircraftMap(object):
@@ -109,7 +303,9 @@ class AircraftMap(object):
     def __init__(self, latitude, longitude, purge_age=DEFAULT_PURGE_TIME,
                  position_accuracy=2, altitude_accuracy=-2, start_time=None,
                  minimum_altitude=0, maximum_altitude=50000,
-                 maximum_distance=100000):
+                 maximum_distance=100000,
+                 geodesy_strategy=geodesy.DEFAULT_STRATEGY,
+                 metrics_registry=metrics.REGISTRY):
         """
         Arguments:
         latitude: the latitude, in fractional degrees, of the observer.
@@ -124,10 +320,20 @@ class AircraftMap(object):
         minimum_altitude: Ignore data from aircraft lower than this
         maximum_altitude: Ignore data from aircraft higher than this
         maximum_distance: Ignore data from aircraft farther away than this
+        geodesy_strategy: The name of the geodesy strategy used to compute
+                          distances and bearings to the observer
+        metrics_registry: The metrics.Registry to record ingest metrics in
         """
-        self._aircraft = {}  # ADSB ID -> aircraft
+        # Integer ADSB ID -> aircraft, least recently updated first, so that
+        # stale aircraft can be found without scanning the whole map
+        self._aircraft = collections.OrderedDict()
+        self._out_of_order = False  # restore() broke the update order
         self._latitude = latitude
         self._longitude = longitude
+        self._observer = geodesy.observer(geodesy_strategy, latitude,
+                                          longitude)
+        # For dead-reckoning every aircraft at once, if NumPy is available
+        self._motion = MotionTable() if numpy is not None else None
         self._purge_age = purge_age
         self._position_accuracy = position_accuracy
         self._altitude_accuracy = altitude_accuracy
@@ -136,72 +342,233 @@ class AircraftMap(object):
         self._maximum_altitude = maximum_altitude
         self._maximum_distance = maximum_distance
         self._callback_destinations = {}  # map id -> callback_destination
+        self._dispatcher = None  # deliver callbacks inline if None
+        self._update_filter = None
+        # (distance, ADSB ID) for every aircraft, kept sorted so that
+        # closest() and farthest() don't need to compute distances
+        self._by_distance = []
+        registry = metrics_registry
+        self._lines_parsed = registry.counter(
+            "adsb_lines_parsed_total",
+            "Position and velocity messages parsed")
+        self._ignored_non_position = registry.counter(
+            "adsb_lines_ignored_total", "Lines ignored, by reason",
+            {"reason": "non_position"})
+        self._ignored_value_error = registry.counter(
+            "adsb_lines_ignored_total", "Lines ignored, by reason",
+            {"reason": "value_error"})
+        self._ignored_altitude = registry.counter(
+            "adsb_lines_ignored_total", "Lines ignored, by reason",
+            {"reason": "altitude_filter"})
+        self._callbacks_dispatched = registry.counter(
+            "adsb_callbacks_dispatched_total",
+            "New/update/remove callbacks dispatched")
+        self._callbacks_skipped = registry.counter(
+            "adsb_callbacks_skipped_total",
+            "Update callbacks skipped by the update filter")
+        self._purge_duration = registry.histogram(
+            "adsb_purge_duration_seconds", "Time spent purging stale aircraft")
+        self._aircraft_tracked = registry.gauge(
+            "adsb_aircraft_tracked", "Aircraft currently in the map")
 
     def update(self, parts, now=None):
+        """
+        Record an already parsed position report, parts being
+        [time, ID, altitude, latitude, longitude] (e.g. a record from
+        a columnar recording). The position is rounded, filtered and
+        passed to callbacks just as one from update_from_raw() is.
+        Returns None if it's ignored, otherwise (was_updated, aircraft).
+        """
         if now == None:
             now = time.time()
         self._purge(now=now)
         aircraft_id = parts[1]
-        altitude = parts[2]
-        lat = parts[3]
-        lon = parts[4]
-        if self._should_ignore(altitude, lat, lon):
+        if isinstance(aircraft_id, str):
+            aircraft_id = sbs_parser.parse_icao(aircraft_id)
+        result = self._apply_report(sbs_parser.PositionReport(
+            aircraft_id, parts[2], parts[3], parts[4], None), now)
+        if result is None:
             return None
-        aircraft = self._aircraft.get(aircraft_id)
-        if aircraft is None:
-            aircraft = Aircraft(aircraft_id, now)
-            self._aircraft[aircraft_id] = aircraft
-        return (aircraft.update(altitude, lat, lon, now=now), aircraft)
+        was_updated, aircraft, new_aircraft = result
+        if was_updated:
+            self._notify(aircraft, new_aircraft)
+        return (was_updated, aircraft)
 
     def update_from_raw(self, line, now=None):
         if now == None:
             now = time.time()
         self._purge(now=now)
-        parts = line.split(",")
-        if parts and (parts[0] == "MSG"):
-            if parts[1] == "3":
-                # Airborne position message
-                try:
-                    aircraft_id = parts[4]
-                    try:
-                        d = parts[6]
-                        t = parts[7]
-                        msg_time = datetime.datetime.strptime(
-                            "%s:%s" % (d, t), "%Y/%m/%d:%H:%M:%S.%f")
-                        altitude = round(int(parts[11]),
-                                         self._altitude_accuracy)
-                        lat = round(float(parts[14]),
-                                    self._position_accuracy)
-                        lon = round(float(parts[15]),
-                                    self._position_accuracy)
-                        if self._should_ignore(altitude, lat, lon):
-                            return False, None
-                        aircraft = self._aircraft.get(aircraft_id)
-                        retval = False
-                        new_aircraft = False
-                        if aircraft is None:
-                            aircraft = Aircraft(aircraft_id, now)
-                            self._aircraft[aircraft_id] = aircraft
-                            new_aircraft = True
-                            #print("New: %s" % aircraft.id)
-                        else:
-                            #print("Update: %s" % aircraft.id)
-                            pass
-                        was_updated = aircraft.update(altitude, lat, lon)
-                        if was_updated:
-                            for id, obj in self._callback_destinations.items():
-                                if new_aircraft:
-                                    obj.new_aircraft_callback(aircraft)
-                                else:
-                                    obj.update_aircraft_callback(aircraft)
-                        return (was_updated, aircraft)
-                    except ValueError:
-                        # Some position messages omit the lat/lon. Ignore.
-                        return False, None
-                except:
-                    print("big oops: %s" % line)
-                    raise
-        return False, None
+        try:
+            report = sbs_parser.parse_position(line)
+            if report is None:
+                velocity = sbs_parser.parse_velocity(line)
+                if velocity is None:
+                    # Neither a position nor a velocity message
+                    self._ignored_non_position.inc()
+                    return False, None
+                self._lines_parsed.inc()
+                return False, self._apply_velocity(velocity)
+        except ValueError:
+            # Some position messages omit the lat/lon. Ignore.
+            self._ignored_value_error.inc()
+            return False, None
+        self._lines_parsed.inc()
+        result = self._apply_report(report, now)
+        if result is None:
+            return False, None
+        was_updated, aircraft, new_aircraft = result
+        if was_updated:
+            self._notify(aircraft, new_aircraft)
+        return (was_updated, aircraft)
+
+    def update_from_raw_many(self, data, now=None, source=None):
+        """
+        Consume a batch of raw lines from the ADSB receiver. data is
+        either a bytes-like chunk of complete, newline terminated lines
+        (e.g. what's been received from the socket, up to the last
+        newline) or a list of lines. If an aircraft reports more than
+        once in the batch, only its latest position is used, so
+        callbacks are invoked at most once per aircraft. Stale aircraft
+        are purged once for the whole batch.
+
+        source names the receiver the lines came from (see
+        feed_client.MultiFeed); the map doesn't need it, but wrappers
+        like load_shedding.LoadShedder do.
+
+        Returns a ChangeSet with the IDs of new, updated and removed
+        aircraft.
+        """
+        if now == None:
+            now = time.time()
+        removed = [aircraft.id for aircraft in self._purge(now=now)]
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).split(b"\n")
+        latest = {}  # ADSB ID -> latest position report
+        velocities = {}  # ADSB ID -> latest velocity report
+        parse_position = sbs_parser.parse_position
+        parse_velocity = sbs_parser.parse_velocity
+        parsed = 0
+        value_errors = 0
+        for line in data:
+            try:
+                report = parse_position(line)
+                if report is not None:
+                    latest[report.aircraft_id] = report
+                    parsed += 1
+                    continue
+                report = parse_velocity(line)
+                if report is not None:
+                    velocities[report.aircraft_id] = report
+                    parsed += 1
+            except ValueError:
+                # Some position messages omit the lat/lon. Ignore.
+                value_errors += 1
+        self._lines_parsed.inc(parsed)
+        self._ignored_value_error.inc(value_errors)
+        # The empty string after the final newline isn't a line
+        lines = len(data) - (1 if data and not data[-1] else 0)
+        self._ignored_non_position.inc(lines - parsed - value_errors)
+        new = []
+        updated = []
+        for report in latest.values():
+            result = self._apply_report(report, now)
+            if result is None:
+                continue
+            was_updated, aircraft, new_aircraft = result
+            if was_updated:
+                if new_aircraft:
+                    new.append(aircraft.id)
+                else:
+                    updated.append(aircraft.id)
+                self._notify(aircraft, new_aircraft)
+        for report in velocities.values():
+            self._apply_velocity(report)
+        return ChangeSet(new, updated, removed)
+
+    def _apply_report(self, report, now):
+        """
+        Round and filter a parsed position report, then record it.
+        Returns None if the report is ignored, otherwise a tuple
+        (was_updated, aircraft, new_aircraft).
+        """
+        altitude = round(report.altitude, self._altitude_accuracy)
+        lat = round(report.latitude, self._position_accuracy)
+        lon = round(report.longitude, self._position_accuracy)
+        if self._should_ignore(altitude, lat, lon):
+            self._ignored_altitude.inc()
+            return None
+        result = self._update_position(report.aircraft_id, altitude, lat, lon,
+                                       now)
+        result[1].set_fix(report.latitude, report.longitude, report.altitude,
+                          now)
+        return result
+
+    def _apply_velocity(self, report):
+        """
+        Record a parsed velocity report for a known aircraft. Returns the
+        aircraft, or None if it isn't in the map.
+        """
+        aircraft = self._aircraft.get(report.aircraft_id)
+        if aircraft is not None:
+            aircraft.update_velocity(report.ground_speed, report.track,
+                                     report.vertical_rate)
+        return aircraft
+
+    def _notify(self, aircraft, new_aircraft):
+        if (not new_aircraft and self._update_filter is not None and
+                not self._update_filter(aircraft)):
+            self._callbacks_skipped.inc()
+            return
+        self._callbacks_dispatched.inc()
+        if self._dispatcher is not None:
+            self._dispatcher.submit(
+                callback_dispatcher.NEW if new_aircraft
+                else callback_dispatcher.UPDATE, aircraft)
+            return
+        for id, obj in self._callback_destinations.items():
+            if new_aircraft:
+                obj.new_aircraft_callback(aircraft)
+            else:
+                obj.update_aircraft_callback(aircraft)
+
+    def _notify_removed(self, aircraft):
+        self._callbacks_dispatched.inc()
+        if self._dispatcher is not None:
+            self._dispatcher.submit(callback_dispatcher.REMOVE, aircraft)
+            return
+        for id, obj in self._callback_destinations.items():
+            obj.remove_aircraft_callback(aircraft)
+
+    def _update_position(self, aircraft_id, altitude, lat, lon, now):
+        """
+        Record a position report, creating the aircraft if it's new.
+        Returns a tuple (was_updated, aircraft, new_aircraft).
+        """
+        aircraft = self._aircraft.get(aircraft_id)
+        new_aircraft = False
+        if aircraft is None:
+            aircraft = Aircraft(aircraft_id, now, self._observer,
+                                self._motion)
+            self._aircraft[aircraft_id] = aircraft
+            self._aircraft_tracked.set(len(self._aircraft))
+            new_aircraft = True
+        else:
+            self._aircraft.move_to_end(aircraft_id)
+        old_distance = aircraft._distance
+        was_updated = aircraft.update(altitude, lat, lon, now=now)
+        if was_updated or new_aircraft:
+            # Move the aircraft to its new place in the distance index
+            if old_distance is not None:
+                self._unindex(aircraft, old_distance)
+            bisect.insort(self._by_distance,
+                          (aircraft._distance, aircraft_id))
+        return was_updated, aircraft, new_aircraft
+
+    def _unindex(self, aircraft, distance):
+        key = (distance, aircraft.id)
+        i = bisect.bisect_left(self._by_distance, key)
+        if i < len(self._by_distance) and self._by_distance[i] == key:
+            del self._by_distance[i]
 
     def _should_ignore(self, altitude, lat, lon):
         if altitude < self._minimum_altitude or altitude > self._maximum_altitude:
@@ -214,21 +581,54 @@ class AircraftMap(object):
         return False
 
 
+    def purge(self, now=None):
+        """
+        Discard aircraft not heard from in purge_age seconds, as the
+        update methods do, for when updates may not be arriving (e.g.
+        a quiet feed). Returns the list of discarded aircraft.
+        """
+        return self._purge(now=now)
+
     def _purge(self, now=None):
+        """
+        Discard aircraft not heard from in purge_age seconds, oldest
+        first, and return the list of discarded aircraft. Does nothing
+        if the last purge was less than DEFAULT_PURGE_INTERVAL ago.
+        """
         if now == None:
             now = time.time()
         if now - self._last_purge < DEFAULT_PURGE_INTERVAL:
-            return
-        n = 0
-        prev_aircraft = copy.deepcopy(self._aircraft)
-        for id, aircraft in list(self._aircraft.items()):
-            if aircraft._update < now - self._purge_age:
-                # Invoke callback to notify about removal
-                for id, obj in self._callback_destinations.items():
-                    obj.remove_aircraft_callback(aircraft)
-                del self._aircraft[id]
-                n += 1
+            return []
+        with self._purge_duration.time():
+            expired = self._expire(now - self._purge_age)
+        self._aircraft_tracked.set(len(self._aircraft))
         self._last_purge = now
+        return expired
+
+    def _expire(self, cutoff):
+        """
+        Remove the aircraft last updated before cutoff, oldest first,
+        and return them. Since the map is kept in update order, this
+        only looks at the aircraft that actually expire (plus one).
+        """
+        if self._out_of_order:
+            # Put aircraft restored with older update times back in order
+            for aircraft in sorted(self._aircraft.values(),
+                                   key=lambda a: a._update):
+                self._aircraft.move_to_end(aircraft.id)
+            self._out_of_order = False
+        expired = []
+        for aircraft in self._aircraft.values():
+            if aircraft._update >= cutoff:
+                break
+            expired.append(aircraft)
+        for aircraft in expired:
+            self._notify_removed(aircraft)
+            self._unindex(aircraft, aircraft._distance)
+            if aircraft._motion is not None:
+                aircraft._motion.release(aircraft)
+            del self._aircraft[aircraft.id]
+        return expired
 
     def print_summary(self):
         print("%d aircraft" % len(self._aircraft))
@@ -240,21 +640,16 @@ class AircraftMap(object):
         aircraft in that range. May return fewer than <count>
         aircraft.
         """
-        # I know there's a one-line list comprehension that will do
-        # this, but I suck.
         ret = []
-        dist_map = {}  # distance -> aircraft
-        for id, aircraft in self._aircraft.items():
-            dist = aircraft.distance_to(self._latitude, self._longitude)
-            dist_map[dist] = aircraft
-        closest = sorted(dist_map.keys())
-        for d in closest:
-            aircraft = dist_map[d]
+        if count <= 0:
+            return ret
+        for dist, aircraft_id in self._by_distance:
+            aircraft = self._aircraft[aircraft_id]
             if (aircraft.altitude <= max_altitude and
                    aircraft.altitude >= min_altitude):
                 ret.append(aircraft)
-            if len(ret) >= count:
-                return ret
+                if len(ret) >= count:
+                    break
         return ret
 
     def count(self):
@@ -265,20 +660,97 @@ class AircraftMap(object):
 
     def farthest(self):
         """
-        Return the fathest aircraft
-        TODO can probably optimize this to compute on update
+        Return the fathest aircraft, or None if the map is empty.
         """
-        farthest = 0
-        for id, aircraft in self._aircraft.items():
-            dist = aircraft.distance_to(self._latitude, self._longitude)
-            if dist > farthest:
-                farthest = dist
-                farthest_aircraft = aircraft
-        return farthest_aircraft
+        if not self._by_distance:
+            return None
+        return self._aircraft[self._by_distance[-1][1]]
 
     def get(self, aircraft_id):
+        """
+        Return the aircraft with aircraft_id (an integer ID, or a hex
+        ICAO address), or None if it isn't in the map.
+        """
+        if isinstance(aircraft_id, str):
+            aircraft_id = sbs_parser.parse_icao(aircraft_id)
         return self._aircraft.get(aircraft_id)
 
+    def aircraft(self):
+        """Return a list of all the aircraft in the map."""
+        return list(self._aircraft.values())
+
+    @property
+    def purge_age(self):
+        return self._purge_age
+
+    def restore(self, aircraft_id, altitude, latitude, longitude, update_time,
+                velocity=None):
+        """
+        Add an aircraft from saved state (e.g. a snapshot) as if a
+        position report, and velocity if given, had been received at
+        update_time, but without invoking callbacks. Aircraft may be
+        restored in any order. Returns the aircraft, or None if it's filtered
+        out like a position report would be. Aircraft already in the
+        map with a newer position are left alone. aircraft_id may be
+        an integer ID or a hex ICAO address.
+        """
+        if isinstance(aircraft_id, str):
+            aircraft_id = sbs_parser.parse_icao(aircraft_id)
+        aircraft = self._aircraft.get(aircraft_id)
+        if aircraft is not None and aircraft.update_time >= update_time:
+            return aircraft
+        newest = next(reversed(self._aircraft.values()), None)
+        result = self._apply_report(
+            sbs_parser.PositionReport(aircraft_id, altitude, latitude,
+                                      longitude, None),
+            update_time)
+        if result is None:
+            return None
+        if velocity is not None:
+            result[1].update_velocity(*velocity)
+        # The aircraft is now last, as if it were the most recently
+        # updated; if it isn't, have the next purge sort the map
+        if newest is not None and newest._update > update_time:
+            self._out_of_order = True
+        return result[1]
+
+    def positions_at(self, t, aircraft=None):
+        """
+        Return a list of (aircraft, latitude, longitude, altitude) with
+        each aircraft's position dead-reckoned to time t (on the same
+        clock as the now arguments of the update methods). Covers all
+        aircraft in the map, or just those in the aircraft list, e.g.
+        the result of closest(). With NumPy, all the positions are
+        computed at once.
+        """
+        if aircraft is None:
+            aircraft = list(self._aircraft.values())
+        rows = [a._row for a in aircraft]
+        if self._motion is None or None in rows:
+            # No NumPy, or some aircraft have left the map
+            return [(a,) + a.position_at(t) for a in aircraft]
+        latitudes, longitudes, altitudes = self._motion.positions_at(
+            numpy.array(rows, dtype=numpy.intp), t)
+        return list(zip(aircraft, latitudes.tolist(), longitudes.tolist(),
+                        altitudes.tolist()))
+
     def register_callback(self, id, obj):
         self._callback_destinations[id] = obj
 
+    def set_update_filter(self, update_filter):
+        """
+        Only deliver update callbacks for aircraft for which
+        update_filter(aircraft) returns True (e.g. the ones that can
+        be heard), or for all aircraft if update_filter is None. New
+        and remove callbacks are always delivered.
+        """
+        self._update_filter = update_filter
+
+    def set_dispatcher(self, dispatcher):
+        """
+        Deliver callbacks through a callback_dispatcher.CallbackDispatcher,
+        from its worker thread, instead of from inside update_from_raw().
+        """
+        self._dispatcher = dispatcher
+        dispatcher.start(self._callback_destinations)
+
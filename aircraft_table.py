@@ -0,0 +1,382 @@
+# aircraft_table: a NumPy struct-of-arrays backend for AircraftMap.
+#
+# Instead of one Python object per aircraft, positions live in
+# preallocated NumPy columns, and the aircraft handed out to callers
+# are lightweight views over a row. Observer-relative geometry,
+# closest() and purging are done for every aircraft at once with a
+# few vector operations, which pays off once thousands of aircraft
+# are tracked (e.g. aggregated multi-site feeds, see ingest_daemon.py's
+# --table). With a few hundred, the dict-backed map's distance index
+# answers closest() and farthest() faster.
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import aircraft_map
+import geodesy
+import sbs_parser
+import util
+
+DEFAULT_CAPACITY = 1024  # Initial number of rows; grows as needed
+
+
+class AircraftTable(object):
+    """
+    Preallocated columns of aircraft state, one row per aircraft, with
+    a free-list so rows of purged aircraft are reused. Distance and
+    bearing to the observer are recomputed for all rows, in one go,
+    the first time they're needed after any position changes.
+    """
+    def __init__(self, latitude, longitude, capacity=DEFAULT_CAPACITY,
+                 geodesy_strategy=geodesy.DEFAULT_STRATEGY):
+        if numpy is None:
+            raise ImportError("AircraftTable requires numpy")
+        self._observer = geodesy.vectorized_observer(geodesy_strategy,
+                                                     latitude, longitude)
+        self._free = list(range(capacity - 1, -1, -1))
+        self.active = numpy.zeros(capacity, dtype=bool)
+        self.aircraft_id = numpy.zeros(capacity, dtype=numpy.uint32)
+        self.altitude = numpy.zeros(capacity, dtype=numpy.int32)
+        self.latitude = numpy.zeros(capacity, dtype=numpy.float64)
+        self.longitude = numpy.zeros(capacity, dtype=numpy.float64)
+        self.update_time = numpy.zeros(capacity, dtype=numpy.float64)
+        self.create_time = numpy.zeros(capacity, dtype=numpy.float64)
+        self.distance = numpy.zeros(capacity, dtype=numpy.float64)
+        self.bearing = numpy.zeros(capacity, dtype=numpy.float64)
+        # Unrounded last position report, and velocity, for dead reckoning
+        self.fix_latitude = numpy.zeros(capacity, dtype=numpy.float64)
+        self.fix_longitude = numpy.zeros(capacity, dtype=numpy.float64)
+        self.fix_altitude = numpy.zeros(capacity, dtype=numpy.float64)
+        self.fix_time = numpy.full(capacity, numpy.nan)  # nan: no fix yet
+        self.ground_speed = numpy.zeros(capacity, dtype=numpy.float64)
+        self.track = numpy.zeros(capacity, dtype=numpy.float64)
+        self.vertical_rate = numpy.zeros(capacity, dtype=numpy.float64)
+        self.has_velocity = numpy.zeros(capacity, dtype=bool)
+        self._geometry_dirty = False
+
+    _COLUMNS = ("active", "aircraft_id", "altitude", "latitude", "longitude",
+                "update_time", "create_time", "distance", "bearing",
+                "fix_latitude", "fix_longitude", "fix_altitude", "fix_time",
+                "ground_speed", "track", "vertical_rate", "has_velocity")
+
+    def _grow(self):
+        old_capacity = len(self.active)
+        new_capacity = old_capacity * 2
+        for name in self._COLUMNS:
+            old = getattr(self, name)
+            new = numpy.zeros(new_capacity, dtype=old.dtype)
+            new[:old_capacity] = old
+            setattr(self, name, new)
+        self._free.extend(range(new_capacity - 1, old_capacity - 1, -1))
+
+    def allocate(self, aircraft_id, now):
+        """Claim a row for a new aircraft and return its index."""
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        self.aircraft_id[row] = aircraft_id
+        self.active[row] = True
+        self.altitude[row] = 0
+        self.latitude[row] = 0.0
+        self.longitude[row] = 0.0
+        self.update_time[row] = 0.0
+        self.create_time[row] = now
+        self.fix_time[row] = numpy.nan
+        self.has_velocity[row] = False
+        self._geometry_dirty = True
+        return row
+
+    def release(self, row):
+        """Return a row to the free-list."""
+        self.active[row] = False
+        self._free.append(row)
+
+    def id_at(self, row):
+        return int(self.aircraft_id[row])
+
+    def set_position(self, row, altitude, latitude, longitude):
+        self.altitude[row] = altitude
+        self.latitude[row] = latitude
+        self.longitude[row] = longitude
+        self._geometry_dirty = True
+
+    def positions_at(self, rows, t):
+        """
+        Dead-reckon the given rows to time t, as Aircraft.position_at()
+        does. Returns arrays (latitudes, longitudes, altitudes).
+        """
+        has_fix = ~numpy.isnan(self.fix_time[rows])
+        latitude = numpy.where(has_fix, self.fix_latitude[rows],
+                               self.latitude[rows])
+        longitude = numpy.where(has_fix, self.fix_longitude[rows],
+                                self.longitude[rows])
+        altitude = numpy.where(has_fix, self.fix_altitude[rows],
+                               self.altitude[rows])
+        moving = has_fix & self.has_velocity[rows]
+        dt = numpy.where(moving, numpy.clip(
+            t - numpy.where(has_fix, self.fix_time[rows], t), 0.0,
+            aircraft_map.MAX_EXTRAPOLATION), 0.0)
+        return aircraft_map.extrapolate_many(
+            latitude, longitude, altitude, self.ground_speed[rows],
+            self.track[rows], self.vertical_rate[rows], dt)
+
+    def refresh_geometry(self):
+        """
+        Recompute distance and bearing to the observer for every row,
+        if any position changed since they were last computed.
+        """
+        if not self._geometry_dirty:
+            return
+        self.distance[:] = self._observer.distances(self.latitude,
+                                                     self.longitude)
+        self.bearing[:] = self._observer.bearings(self.latitude,
+                                                  self.longitude)
+        self._geometry_dirty = False
+
+    def altitude_band(self, min_altitude, max_altitude):
+        """Boolean mask of active rows within the altitude band."""
+        return (self.active & (self.altitude >= min_altitude) &
+                (self.altitude <= max_altitude))
+
+    def closest_rows(self, count, min_altitude, max_altitude):
+        """
+        Return the rows of the closest [count] aircraft in the altitude
+        band, closest first.
+        """
+        self.refresh_geometry()
+        rows = numpy.flatnonzero(self.altitude_band(min_altitude,
+                                                    max_altitude))
+        if count < len(rows):
+            nearest = numpy.argpartition(self.distance[rows], count - 1)
+            rows = rows[nearest[:count]]
+        return rows[numpy.argsort(self.distance[rows], kind="stable")]
+
+    def farthest_row(self):
+        """Return the row of the farthest aircraft, or None."""
+        self.refresh_geometry()
+        rows = numpy.flatnonzero(self.active)
+        if len(rows) == 0:
+            return None
+        return rows[numpy.argmax(self.distance[rows])]
+
+    def expired_rows(self, cutoff):
+        """
+        Return the rows last updated before cutoff, least recently
+        updated first.
+        """
+        rows = numpy.flatnonzero(self.active & (self.update_time < cutoff))
+        return rows[numpy.argsort(self.update_time[rows], kind="stable")]
+
+
+class AircraftView(object):
+    """
+    An aircraft backed by a row of an AircraftTable. Has the same
+    interface as aircraft_map.Aircraft. A view must not be kept after
+    its aircraft has been purged, since the row may be reused; removal
+    callbacks are given a detached copy instead.
+    """
+    __slots__ = ("_table", "_row", "_id")
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+        self._id = table.id_at(row)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def icao(self):
+        return sbs_parser.format_icao(self._id)
+
+    @property
+    def altitude(self):
+        return int(self._table.altitude[self._row])
+
+    @property
+    def latitude(self):
+        return float(self._table.latitude[self._row])
+
+    @property
+    def longitude(self):
+        return float(self._table.longitude[self._row])
+
+    @property
+    def distance(self):
+        self._table.refresh_geometry()
+        return float(self._table.distance[self._row])
+
+    @property
+    def bearing(self):
+        self._table.refresh_geometry()
+        return float(self._table.bearing[self._row])
+
+    @property
+    def _update(self):
+        return float(self._table.update_time[self._row])
+
+    @property
+    def _create_time(self):
+        return float(self._table.create_time[self._row])
+
+    @property
+    def update_time(self):
+        return self._update
+
+    def __str__(self):
+        return "%s: alt %d lat %f lon %f" % (
+            self.icao, self.altitude, self.latitude, self.longitude)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self, other):
+        return (self.altitude == other.altitude and
+                self.latitude == other.latitude and
+                self.longitude == other.longitude)
+
+    def update(self, altitude, latitude, longitude, now=None):
+        """Update an aircraft's altitude, latitude, and longitude.
+           Returns True if something changed in the aircraft's
+           position."""
+        if now == None:
+            now = time.time()
+        table = self._table
+        row = self._row
+        updated = False
+        if (table.altitude[row] != altitude or
+                table.latitude[row] != latitude or
+                table.longitude[row] != longitude):
+            table.set_position(row, altitude, latitude, longitude)
+            updated = True
+        table.update_time[row] = now
+        return updated
+
+    def detach(self):
+        """
+        Return an aircraft_map.Aircraft with this view's current state,
+        which stays valid after the row is released.
+        """
+        aircraft = aircraft_map.Aircraft(self._id, self._create_time)
+        aircraft.update(self.altitude, self.latitude, self.longitude,
+                        now=self._update)
+        aircraft._distance = self.distance
+        aircraft._bearing = self.bearing
+        fix = self.fix
+        if fix is not None:
+            aircraft.set_fix(*fix)
+        aircraft._velocity = self.velocity
+        return aircraft
+
+    def set_fix(self, latitude, longitude, altitude, now):
+        table = self._table
+        row = self._row
+        table.fix_latitude[row] = latitude
+        table.fix_longitude[row] = longitude
+        table.fix_altitude[row] = altitude
+        table.fix_time[row] = now
+
+    @property
+    def fix(self):
+        table = self._table
+        row = self._row
+        if numpy.isnan(table.fix_time[row]):
+            return None
+        return (float(table.fix_latitude[row]),
+                float(table.fix_longitude[row]),
+                float(table.fix_altitude[row]), float(table.fix_time[row]))
+
+    def update_velocity(self, ground_speed, track, vertical_rate):
+        table = self._table
+        row = self._row
+        table.ground_speed[row] = ground_speed
+        table.track[row] = track
+        table.vertical_rate[row] = vertical_rate
+        table.has_velocity[row] = True
+
+    @property
+    def velocity(self):
+        table = self._table
+        row = self._row
+        if not table.has_velocity[row]:
+            return None
+        return (float(table.ground_speed[row]), float(table.track[row]),
+                float(table.vertical_rate[row]))
+
+    def position_at(self, t):
+        latitudes, longitudes, altitudes = self._table.positions_at(
+            [self._row], t)
+        return (float(latitudes[0]), float(longitudes[0]),
+                float(altitudes[0]))
+
+    def distance_to(self, observer_latitude, observer_longitude):
+        return util.distance_to(self.latitude, self.longitude,
+                                self.altitude, observer_latitude,
+                                observer_longitude)
+
+    def bearing_from(self, lat, lon):
+        return util.bearing_from(self.latitude, self.longitude, lat, lon)
+
+
+class TableAircraftMap(aircraft_map.AircraftMap):
+    """
+    An AircraftMap that keeps its aircraft in an AircraftTable. It
+    takes the same arguments as AircraftMap, plus the initial table
+    capacity, and hands out AircraftViews instead of Aircraft.
+    """
+    def __init__(self, latitude, longitude, *args, capacity=DEFAULT_CAPACITY,
+                 geodesy_strategy=geodesy.DEFAULT_STRATEGY, **kwargs):
+        aircraft_map.AircraftMap.__init__(self, latitude, longitude, *args,
+                                          geodesy_strategy=geodesy_strategy,
+                                          **kwargs)
+        self._table = AircraftTable(latitude, longitude, capacity,
+                                    geodesy_strategy)
+        self._aircraft = {}  # ADSB ID -> AircraftView
+
+    def _update_position(self, aircraft_id, altitude, lat, lon, now):
+        aircraft = self._aircraft.get(aircraft_id)
+        new_aircraft = False
+        if aircraft is None:
+            aircraft = AircraftView(self._table,
+                                    self._table.allocate(aircraft_id, now))
+            self._aircraft[aircraft_id] = aircraft
+            self._aircraft_tracked.set(len(self._aircraft))
+            new_aircraft = True
+        was_updated = aircraft.update(altitude, lat, lon, now=now)
+        return was_updated, aircraft, new_aircraft
+
+    def _expire(self, cutoff):
+        expired = []
+        for row in self._table.expired_rows(cutoff):
+            # The row may be reused, so hand out a copy of the aircraft
+            aircraft = self._aircraft.pop(self._table.id_at(row)).detach()
+            self._table.release(row)
+            self._notify_removed(aircraft)
+            expired.append(aircraft)
+        return expired
+
+    def closest(self, count, min_altitude=0, max_altitude=100000):
+        if count <= 0:
+            return []
+        table = self._table
+        return [self._aircraft[table.id_at(row)] for row in
+                table.closest_rows(count, min_altitude, max_altitude)]
+
+    def farthest(self):
+        row = self._table.farthest_row()
+        if row is None:
+            return None
+        return self._aircraft[self._table.id_at(row)]
+
+    def positions_at(self, t, aircraft=None):
+        if aircraft is None:
+            aircraft = list(self._aircraft.values())
+        rows = numpy.array([a._row for a in aircraft], dtype=numpy.intp)
+        latitudes, longitudes, altitudes = self._table.positions_at(rows, t)
+        return list(zip(aircraft, latitudes.tolist(), longitudes.tolist(),
+                        altitudes.tolist()))
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the ADSB theremin's ingest and query paths.
+Run with the name of a benchmark, e.g. "./benchmark.py parser".
+"""
+
+import argparse
+import asyncio
+import copy
+import datetime
+import os
+import pickle
+import random
+import selectors
+import socket
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import zlib
+
+import aircraft_map
+import aircraft_table
+import byte_reader
+import columnar_recording
+import feed_client
+import geodesy
+import metrics
+import recording
+import relay
+import sbs_parser
+import test_geodesy
+
+OBSERVER_LAT = 37.3806
+OBSERVER_LON = -122.0877
+PACED_SECONDS = 4  # how long each reader runs in the paced reader benchmark
+
+
+def synthetic_lines(count, num_aircraft=300, position_fraction=0.3,
+                    seed=1):
+    """
+    Make [count] lines that look like a dump1090 port 30003 feed:
+    roughly position_fraction of them are MSG,3 position messages,
+    the rest are other message types.
+    """
+    rng = random.Random(seed)
+    icaos = ["%06X" % rng.randrange(0x1000000) for i in range(num_aircraft)]
+    lines = []
+    for i in range(count):
+        icao = rng.choice(icaos)
+        t = "2021/06/01,12:%02d:%02d.%03d" % (
+            (i // 60000) % 60, (i // 1000) % 60, i % 1000)
+        if rng.random() < position_fraction:
+            lines.append(
+                "MSG,3,1,1,%s,1,%s,%s,,%d,,,%.5f,%.5f,,,0,,0,0\r\n" % (
+                    icao, t, t, rng.randrange(0, 40000, 25),
+                    OBSERVER_LAT + rng.uniform(-1.0, 1.0),
+                    OBSERVER_LON + rng.uniform(-1.0, 1.0)))
+        elif rng.random() < 0.3:
+            lines.append(
+                "MSG,4,1,1,%s,1,%s,%s,,,%d,%.1f,,,%d,,0,0,0,0\r\n" % (
+                    icao, t, t, rng.randrange(100, 500),
+                    rng.uniform(0.0, 360.0), rng.randrange(-2000, 2000, 64)))
+        else:
+            msg_type = rng.choice((1, 5, 7, 8))
+            lines.append("MSG,%d,1,1,%s,1,%s,%s,,,,,,,,,,,,0\r\n" % (
+                msg_type, icao, t, t))
+    return lines
+
+
+def legacy_parse(line):
+    """
+    The pre-sbs_parser parsing path from AircraftMap.update_from_raw,
+    kept here as the benchmark baseline.
+    """
+    parts = line.split(",")
+    if parts and (parts[0] == "MSG"):
+        if parts[1] == "3":
+            try:
+                aircraft_id = parts[4]
+                datetime.datetime.strptime(
+                    "%s:%s" % (parts[6], parts[7]), "%Y/%m/%d:%H:%M:%S.%f")
+                return (aircraft_id, int(parts[11]), float(parts[14]),
+                        float(parts[15]))
+            except ValueError:
+                return None
+    return None
+
+
+def fast_parse(line):
+    try:
+        return sbs_parser.parse_position(line)
+    except ValueError:
+        return None
+
+
+def report(name, count, elapsed):
+    print("%-32s %10.0f lines/s  (%d lines in %.3f s)" % (
+        name, count / elapsed, count, elapsed))
+
+
+def bench_parser(args):
+    lines = synthetic_lines(args.count)
+    byte_lines = [line.encode("ascii") for line in lines]
+    for name, fn, data in (
+            ("legacy split + strptime", legacy_parse, lines),
+            ("sbs_parser (str)", fast_parse, lines),
+            ("sbs_parser (bytes)", fast_parse, byte_lines),
+            ("sbs_parser with timestamps",
+             lambda l: sbs_parser.parse_position(l, parse_time=True), lines)):
+        start = time.perf_counter()
+        for line in data:
+            fn(line)
+        report(name, len(data), time.perf_counter() - start)
+    amap = new_map(args)
+    now = time.time()
+    start = time.perf_counter()
+    for line in lines:
+        amap.update_from_raw(line, now=now)
+    report("AircraftMap.update_from_raw", len(lines),
+           time.perf_counter() - start)
+    chunks = chunked(byte_lines, 65536)
+    amap = new_map(args)
+    start = time.perf_counter()
+    for chunk in chunks:
+        amap.update_from_raw_many(chunk, now=now)
+    report("AircraftMap.update_from_raw_many", len(lines),
+           time.perf_counter() - start)
+
+
+def chunked(byte_lines, size):
+    """
+    Group lines into chunks of about [size] bytes, as if read from a
+    socket in large recv()s.
+    """
+    chunks = []
+    current = []
+    current_size = 0
+    for line in byte_lines:
+        current.append(line)
+        current_size += len(line)
+        if current_size >= size:
+            chunks.append(b"".join(current))
+            current = []
+            current_size = 0
+    if current:
+        chunks.append(b"".join(current))
+    return chunks
+
+
+def new_map(args, **kwargs):
+    if args.table:
+        return aircraft_table.TableAircraftMap(OBSERVER_LAT, OBSERVER_LON,
+                                               **kwargs)
+    return aircraft_map.AircraftMap(OBSERVER_LAT, OBSERVER_LON, **kwargs)
+
+
+def populated_map(args, num_aircraft, now):
+    amap = new_map(args)
+    for line in synthetic_lines(num_aircraft * 20, num_aircraft=num_aircraft,
+                                position_fraction=1.0):
+        amap.update_from_raw(line, now=now)
+    return amap
+
+
+def bench_queries(args):
+    amap = populated_map(args, args.aircraft, time.time())
+    iterations = 10000
+    for name, fn in (
+            ("closest(8)", lambda: amap.closest(8)),
+            ("closest(8, 10000, 20000)",
+             lambda: amap.closest(8, min_altitude=10000,
+                                  max_altitude=20000)),
+            ("farthest()", amap.farthest)):
+        start = time.perf_counter()
+        for i in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        print("%-32s %8.2f us/call  (%d aircraft)" % (
+            name, elapsed / iterations * 1e6, amap.count()))
+
+
+def legacy_purge(amap, now):
+    """
+    The pre-expiry-order AircraftMap._purge, kept here as the benchmark
+    baseline.
+    """
+    copy.deepcopy(amap._aircraft)
+    for id, aircraft in list(amap._aircraft.items()):
+        if aircraft._update < now - amap._purge_age:
+            amap._unindex(aircraft, aircraft._distance)
+            del amap._aircraft[id]
+    amap._last_purge = now
+
+
+def bench_purge(args):
+    num_aircraft = args.aircraft
+    for expiring in (0, 10, 100):
+        for name, purge in (("legacy deepcopy + scan", legacy_purge),
+                            ("expiry order", aircraft_map.AircraftMap._purge)):
+            # Every aircraft is heard from once per second, except for
+            # [expiring] that go quiet and age out on the purge we time.
+            amap = aircraft_map.AircraftMap(OBSERVER_LAT, OBSERVER_LON,
+                                            start_time=200.0)
+            for i in range(num_aircraft):
+                update_time = 0.0 if i < expiring else 200.0
+                amap.update(["", i, 10000 + i, 37.0, -122.0],
+                            now=update_time)
+            amap._last_purge = 0.0
+            start = time.perf_counter()
+            purge(amap, 200.5)
+            elapsed = time.perf_counter() - start
+            print("%-24s %8.1f us  (%d aircraft, %d expired)" % (
+                name, elapsed * 1e6, num_aircraft, expiring))
+
+
+def bench_geometry(args):
+    num_aircraft = args.aircraft
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    amap = populated_map(args, num_aircraft, time.time())
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%-32s %8.0f bytes/aircraft  (%d aircraft, whole map)" % (
+        "memory", used / amap.count(), amap.count()))
+    aircraft = amap.closest(1)[0]
+    iterations = 100000
+    for name, fn in (
+            ("distance_to(observer)",
+             lambda: aircraft.distance_to(OBSERVER_LAT, OBSERVER_LON)),
+            ("bearing_from(observer)",
+             lambda: aircraft.bearing_from(OBSERVER_LAT, OBSERVER_LON)),
+            ("distance_to(other point)",
+             lambda: aircraft.distance_to(OBSERVER_LAT + 1, OBSERVER_LON)),
+            ("bearing_from(other point)",
+             lambda: aircraft.bearing_from(OBSERVER_LAT + 1, OBSERVER_LON))):
+        elapsed = timeit.timeit(fn, number=iterations)
+        print("%-32s %8.0f ns/call" % (name, elapsed / iterations * 1e9))
+
+
+def bench_geodesy(args):
+    # Timing only; test_geodesy.py checks the error bounds
+    lats, lons = test_geodesy.random_positions(
+        random.Random(1), OBSERVER_LAT, OBSERVER_LON, args.aircraft,
+        geodesy.MAX_CHECKED_RANGE)
+    positions = list(zip(lats, lons))
+    iterations = max(1, 200000 // len(positions))
+    for name in sorted(geodesy.STRATEGIES):
+        strategy = geodesy.observer(name, OBSERVER_LAT, OBSERVER_LON)
+        start = time.perf_counter()
+        for i in range(iterations):
+            for lat, lon in positions:
+                strategy.distance(lat, lon)
+        elapsed = time.perf_counter() - start
+        print("%-32s %8.0f ns/distance" % (
+            name, elapsed / iterations / len(positions) * 1e9))
+    if geodesy.numpy is not None:
+        lat_array = geodesy.numpy.array(lats)
+        lon_array = geodesy.numpy.array(lons)
+        for name in ("numpy", "equirectangular"):
+            strategy = geodesy.observer(name, OBSERVER_LAT, OBSERVER_LON)
+            start = time.perf_counter()
+            for i in range(iterations):
+                strategy.distances(lat_array, lon_array)
+            elapsed = time.perf_counter() - start
+            print("%-32s %8.0f ns/distance  (vectorized, %d aircraft)" % (
+                name, elapsed / iterations / len(positions) * 1e9,
+                len(positions)))
+
+
+def bench_positions(args):
+    now = time.time()
+    amap = new_map(args)
+    amap.update_from_raw_many(synthetic_lines(args.aircraft * 40,
+                                              num_aircraft=args.aircraft),
+                              now=now)
+    iterations = 100
+    start = time.perf_counter()
+    for i in range(iterations):
+        amap.positions_at(now + i * 0.02)
+    elapsed = time.perf_counter() - start
+    print("%-32s %8.1f us/call  (%d aircraft)" % (
+        "positions_at()", elapsed / iterations * 1e6, amap.count()))
+
+
+def bench_fanin(args):
+    """
+    Serve overlapping subsets of a synthetic feed from several local
+    receivers, and merge them with a MultiFeed. Each receiver hears
+    each line with probability 0.7, so most positions arrive more than
+    once; checks that exactly the repeats are dropped.
+    """
+    lines = [line.encode("ascii") for line in synthetic_lines(args.count)]
+    rng = random.Random(2)
+    feeds = [b"".join(line for line in lines if rng.random() < 0.7)
+             for i in range(args.receivers)]
+    sent = sum(feed.count(b"\n") for feed in feeds)
+    positions = [line.split(b",")[4:16] for feed in feeds
+                 for line in feed.splitlines()
+                 if line.startswith(sbs_parser.POSITION_PREFIX_BYTES)]
+    expected = len(positions) - len(set(
+        (p[0], p[7], p[10], p[11]) for p in positions))
+
+    async def run():
+        servers = []
+        for feed in feeds:
+            async def serve(reader, writer, feed=feed):
+                writer.write(feed)
+                await writer.drain()
+                writer.close()
+            servers.append(await asyncio.start_server(serve, "127.0.0.1", 0))
+        registry = metrics.Registry()
+        amap = new_map(args, metrics_registry=registry)
+        multi = feed_client.MultiFeed(
+            [("127.0.0.1", server.sockets[0].getsockname()[1])
+             for server in servers], amap, duplicate_window=3600.0,
+            metrics_registry=registry)
+        lines_read = registry.counter("adsb_lines_read_total", "")
+
+        async def stop_when_read():
+            while lines_read.value < sent:
+                await asyncio.sleep(0.01)
+            multi.stop()
+
+        start = time.perf_counter()
+        await asyncio.gather(multi.run(), stop_when_read())
+        elapsed = time.perf_counter() - start
+        for server in servers:
+            server.close()
+        return registry, elapsed
+
+    registry, elapsed = asyncio.run(run())
+    report("MultiFeed (%d receivers)" % args.receivers, sent, elapsed)
+    dropped = 0
+    for name, value in sorted(registry.snapshot().items()):
+        if name.startswith("adsb_receiver_duplicate"):
+            print("%-56s %8.3f" % (name, value))
+            if name.startswith("adsb_receiver_duplicates_total"):
+                dropped += value
+    print("%d duplicates dropped, %d expected: %s" % (
+        dropped, expected, "ok" if dropped == expected else "FAILED"))
+
+
+def serve_feed(data, rate):
+    """
+    Serve data (bytes lines) once, to the first client to connect to
+    the returned listening socket, at rate lines per second (as fast
+    as possible if rate is 0), then close the connection.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    lines = data.splitlines(True)
+    tick = 0.01  # seconds
+    per_tick = max(1, int(rate * tick)) if rate else len(lines)
+
+    def serve():
+        connection, address = listener.accept()
+        start = time.time()
+        for i in range(0, len(lines), per_tick):
+            if rate:
+                delay = start + i / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            connection.sendall(b"".join(lines[i:i + per_tick]))
+        connection.close()
+        listener.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+
+def read_with_makefile(sock):
+    """The old way: text mode makefile().readline(), then filter."""
+    fp = sock.makefile()
+    kept = []
+    while True:
+        line = fp.readline()
+        if len(line) == 0:
+            break
+        if line.startswith((sbs_parser.POSITION_PREFIX,
+                            sbs_parser.VELOCITY_PREFIX)):
+            kept.append(line)
+    return len(kept)
+
+
+def read_with_line_buffer(sock):
+    buffer = byte_reader.LineBuffer()
+    kept = []
+    while True:
+        result = buffer.recv(sock)
+        if result is None:
+            break
+        kept.extend(result[0])
+    return len(kept)
+
+
+def bench_reader(args):
+    """
+    Read a synthetic feed from a local server with makefile().readline()
+    and with byte_reader.LineBuffer, paced at --rate lines/s (for
+    PACED_SECONDS each) and then unpaced (--count lines). Reports the
+    reading thread's CPU time per line.
+    """
+    for rate, count in ((args.rate, args.rate * PACED_SECONDS),
+                        (0, args.count)):
+        data = "".join(synthetic_lines(count)).encode("ascii")
+        for name, reader in (("makefile().readline()", read_with_makefile),
+                             ("LineBuffer.recv()", read_with_line_buffer)):
+            listener = serve_feed(data, rate)
+            sock = socket.create_connection(listener.getsockname())
+            start = time.perf_counter()
+            start_cpu = time.thread_time()
+            kept = reader(sock)
+            cpu = time.thread_time() - start_cpu
+            elapsed = time.perf_counter() - start
+            sock.close()
+            print("%-22s %-10s %6.2f us CPU/line  %6.1f%% CPU  "
+                  "(%d lines, %d kept, %.2f s)" % (
+                      name, "%d/s" % rate if rate else "unpaced",
+                      cpu / count * 1e6, cpu / elapsed * 100, count, kept,
+                      elapsed))
+
+
+def receive_all(socks, expected, done):
+    """
+    Read from every socket in socks until each has received expected
+    bytes (or nothing arrives for a few seconds), then set done.
+    Returns {socket: (bytes received, CRC-32)}.
+    """
+    selector = selectors.DefaultSelector()
+    received = {}
+    for sock in socks:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        received[sock] = (0, 0)
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+    remaining = len(socks)
+    while remaining:
+        events = selector.select(timeout=5.0)
+        if not events:
+            break
+        for key, mask in events:
+            sock = key.fileobj
+            count = sock.recv_into(buffer)
+            length, crc = received[sock]
+            received[sock] = (length + count,
+                              zlib.crc32(view[:count], crc))
+            if count == 0 or length + count >= expected:
+                selector.unregister(sock)
+                remaining -= 1
+    done.set()
+    return received
+
+
+def bench_relay(args):
+    """
+    Relay a synthetic feed at --rate lines/s for PACED_SECONDS to
+    --clients local clients, plus one that never reads, and check that
+    every reading client gets the whole feed unchanged however far the
+    stalled one falls behind. Raise --rate to find where the relay (or
+    the clients) can't keep up.
+    """
+    count = args.rate * PACED_SECONDS
+    data = "".join(synthetic_lines(count)).encode("ascii")
+    expected_crc = zlib.crc32(data)
+    upstream = serve_feed(data, args.rate)
+    registry = metrics.Registry()
+    done = threading.Event()
+    results = {}
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # A small client buffer, so the stalled client falls behind
+        # within the run
+        the_relay = relay.Relay(*upstream.getsockname(), listen_port=0,
+                                client_buffer=65536,
+                                metrics_registry=registry)
+        await the_relay.start()
+        address = ("127.0.0.1", the_relay.port)
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        await loop.sock_connect(stalled, address)
+        socks = []
+        for i in range(args.clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+            socks.append(sock)
+        clients = registry.gauge("adsb_relay_clients", "")
+        while clients.value < args.clients + 1:
+            await asyncio.sleep(0.01)
+        thread = threading.Thread(
+            target=lambda: results.update(receive_all(socks, len(data),
+                                                      done)))
+        thread.start()
+
+        async def stop_when_done():
+            await loop.run_in_executor(None, done.wait)
+            the_relay.stop()
+
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        await asyncio.gather(the_relay.run(), stop_when_done())
+        cpu = time.thread_time() - start_cpu
+        elapsed = time.perf_counter() - start
+        thread.join()
+        stalled.close()
+        for sock in socks:
+            sock.close()
+        return elapsed, cpu
+
+    elapsed, cpu = asyncio.run(run())
+    intact = sum(1 for length, crc in results.values()
+                 if length == len(data) and crc == expected_crc)
+    sent = registry.counter("adsb_relay_bytes_total", "").value
+    print("Relay to %d clients at %d lines/s: %.1f MB/s relayed, "
+          "%.1f%% CPU, %.2f us CPU/line/client (%d lines in %.2f s)" % (
+              args.clients, args.rate, sent / elapsed / 1e6,
+              cpu / elapsed * 100, cpu / count / args.clients * 1e6, count,
+              elapsed))
+    print("Stalled client: %d bytes skipped" % registry.counter(
+        "adsb_relay_skipped_bytes_total", "").value)
+    print("%d of %d clients got the whole feed: %s" % (
+        intact, args.clients, "ok" if intact == args.clients else "FAILED"))
+
+
+def bench_replay(args):
+    lines = synthetic_lines(args.count, num_aircraft=args.aircraft)
+    start_time = time.time()
+    records = [[start_time + i / args.rate, line]
+               for i, line in enumerate(lines)]
+    end_time = records[-1][0]
+    tail_start = end_time - (end_time - start_time) / 10
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pickle_path = os.path.join(tmpdir, "recording.pickle")
+        with open(pickle_path, "wb") as fp:
+            pickle.dump(records, fp)
+        chunked_path = os.path.join(tmpdir, "recording.rec")
+        writer = recording.RecordingWriter(chunked_path)
+        for timestamp, line in records:
+            writer.append(timestamp, line)
+        writer.close()
+        columnar_path = os.path.join(tmpdir, "recording.col")
+        columnar_recording.convert([chunked_path], columnar_path)
+        print("%d lines, %d position reports; files: pickle %.1f MB, "
+              "chunked %.1f MB, columnar %.1f MB" % (
+                  len(records), len(columnar_recording.ColumnarRecording(
+                      columnar_path)),
+                  os.path.getsize(pickle_path) / 1e6,
+                  os.path.getsize(chunked_path) / 1e6,
+                  os.path.getsize(columnar_path) / 1e6))
+
+        def replay_lines(path, from_time=None):
+            amap = new_map(args, start_time=start_time)
+            for timestamp, line in recording.read_recording(path):
+                if from_time is None or timestamp >= from_time:
+                    amap.update_from_raw(line, now=timestamp)
+            return amap
+
+        def replay_columns(from_time=None):
+            amap = new_map(args, start_time=start_time)
+            columnar_recording.ColumnarRecording(columnar_path).replay(
+                amap, start_time=from_time)
+            return amap
+
+        maps = []
+        for name, fn in (
+                ("pickle + update_from_raw",
+                 lambda: replay_lines(pickle_path)),
+                ("chunked + update_from_raw",
+                 lambda: replay_lines(chunked_path)),
+                ("columnar + update", replay_columns),
+                ("last 10%: chunked",
+                 lambda: replay_lines(chunked_path, tail_start)),
+                ("last 10%: columnar",
+                 lambda: replay_columns(tail_start))):
+            start = time.perf_counter()
+            maps.append(fn())
+            report(name, len(records), time.perf_counter() - start)
+        # Both ways of replaying should end with the same sky
+        same = ([str(a) for a in maps[0].closest(args.aircraft)] ==
+                [str(a) for a in maps[2].closest(args.aircraft)])
+        print("Final maps match: %s" % ("ok" if same else "FAILED"))
+
+
+BENCHMARKS = {
+    "geodesy": bench_geodesy,
+    "fanin": bench_fanin,
+    "geometry": bench_geometry,
+    "parser": bench_parser,
+    "positions": bench_positions,
+    "purge": bench_purge,
+    "queries": bench_queries,
+    "reader": bench_reader,
+    "relay": bench_relay,
+    "replay": bench_replay,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("-n", "--count", type=int,
+                        help="Number of feed lines to use",
+                        default=200000)
+    parser.add_argument("-a", "--aircraft", type=int,
+                        help="Number of aircraft to track",
+                        default=300)
+    parser.add_argument("-r", "--receivers", type=int,
+                        help="Number of receivers for the fanin benchmark",
+                        default=3)
+    parser.add_argument("-c", "--clients", type=int,
+                        help="Number of clients for the relay benchmark",
+                        default=100)
+    parser.add_argument("--rate", type=int,
+                        help="Feed rate (lines/s) for the paced reader, "
+                        "relay and replay benchmarks",
+                        default=5000)
+    parser.add_argument("--table", action="store_true",
+                        help="Use the NumPy table backed AircraftMap")
+
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# byte_reader: splits the dump1090 feed into lines without decoding it.
+#
+# Data is received straight into a preallocated buffer (recv_into), and
+# the lines with wanted message prefixes are picked out of it in place
+# by a single compiled pattern. Only those lines become new bytes
+# objects; the rest of the feed (the large majority) is never copied,
+# split or decoded.
+
+import re
+
+import sbs_parser
+
+DEFAULT_BUFFER_SIZE = 65536  # bytes; must be longer than any line
+
+# The messages the aircraft map uses
+MAP_PREFIXES = (sbs_parser.POSITION_PREFIX_BYTES,
+                sbs_parser.VELOCITY_PREFIX_BYTES)
+
+
+class LineBuffer(object):
+    """
+    A reusable receive buffer. Call writable() to get a memoryview to
+    receive into, then commit() with the number of bytes received to
+    get the complete lines that start with one of prefixes (all lines
+    if prefixes is None), or commit_raw() to get all the complete lines
+    as they arrived. A partial line at the end is kept for next time;
+    the buffer is compacted only when it fills up.
+
+    The byte before the first unread line is always a newline (the
+    first byte of the buffer is reserved for one), so every wanted
+    line is a match for newline + prefix, which the pattern can search
+    for much faster than a line by line loop.
+    """
+    def __init__(self, size=DEFAULT_BUFFER_SIZE, prefixes=MAP_PREFIXES):
+        self._buffer = bytearray(size)
+        self._buffer[0:1] = b"\n"
+        self._view = memoryview(self._buffer)
+        if prefixes is None:
+            alternatives = b""
+        else:
+            alternatives = b"|".join(re.escape(p) for p in prefixes)
+        self._pattern = re.compile(b"\n((?:%s)[^\r\n]*)" % alternatives)
+        self._start = 1  # start of the first incomplete line
+        self._end = 1  # end of the received data
+        self._discarding = False  # skipping the rest of an overlong line
+
+    def writable(self):
+        """Return a memoryview of the free space in the buffer."""
+        if self._end == len(self._buffer):
+            if self._start == 1:
+                # A line that fills the whole buffer isn't SBS-1 data.
+                # Drop what we have, and the rest of it when it comes.
+                self._discarding = True
+                self._end = 1
+            else:
+                length = self._end - self._start
+                self._view[1:1 + length] = self._view[self._start:self._end]
+                self._start = 1
+                self._end = 1 + length
+        return self._view[self._end:]
+
+    def commit(self, count):
+        """
+        Account for count bytes received into writable(). Returns a
+        tuple of (list of the wanted lines, as bytes without the line
+        ending, number of complete lines received).
+        """
+        start, last = self._complete(count)
+        if last == start:
+            return [], 0
+        buffer = self._buffer
+        # Stop short of the last newline, or it would start a match
+        lines = self._pattern.findall(buffer, start - 1, last - 1)
+        seen = buffer.count(b"\n", start, last)
+        self._consume(last)
+        return lines, seen
+
+    def commit_raw(self, count):
+        """
+        Account for count bytes received into writable(). Returns all
+        the complete lines received, line endings included, as one
+        bytes object (empty if there are none). prefixes is ignored.
+        """
+        start, last = self._complete(count)
+        if last == start:
+            return b""
+        data = bytes(self._view[start:last])
+        self._consume(last)
+        return data
+
+    def _complete(self, count):
+        # Returns (start, end) of the complete lines now in the buffer
+        buffer = self._buffer
+        start = self._start
+        end = self._end + count
+        self._end = end
+        if self._discarding:
+            newline = buffer.find(b"\n", start, end)
+            if newline < 0:
+                self._end = 1
+                return start, start
+            start = newline + 1
+            self._discarding = False
+        last = buffer.rfind(b"\n", start, end) + 1
+        if last == 0:
+            self._start = start
+            return start, start
+        return start, last
+
+    def _consume(self, last):
+        if last == self._end:
+            # Nothing left over, so start at the front again
+            self._start = self._end = 1
+        else:
+            self._start = last
+
+    def recv(self, sock):
+        """
+        Receive once from the blocking socket sock. Returns what
+        commit() does, or None if the connection was closed.
+        """
+        count = sock.recv_into(self.writable())
+        if count == 0:
+            return None
+        return self.commit(count)
@@ -0,0 +1,168 @@
+# callback_dispatcher: delivers AircraftMap callbacks from a worker
+# thread, so slow callbacks (e.g. starting notes on a synthesizer)
+# don't stall the code reading from the ADSB receiver.
+
+import collections
+import threading
+import traceback
+
+NEW = "new"
+UPDATE = "update"
+REMOVE = "remove"
+
+# What to do when an event arrives and the queue is full. Only update
+# events are ever dropped: losing a new or remove event would leave a
+# voice that never starts, or never stops, so those are queued even if
+# the queue is full of them.
+DROP_OLDEST = "drop-oldest"  # discard the oldest queued update
+DROP_NEWEST = "drop-newest"  # discard the update that just arrived
+BLOCK = "block"  # make the caller wait for room in the queue
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+DEFAULT_MAX_PENDING = 1000
+
+
+class CallbackDispatcher(object):
+    """
+    A bounded queue of new/update/remove events, drained by a worker
+    thread that invokes the callback destinations registered with an
+    AircraftMap. The events carry the aircraft itself, so the
+    callbacks see its state as of delivery. That means pending updates
+    for an aircraft can be collapsed into one: an update for an
+    aircraft that already has a new or update event queued is counted
+    as coalesced and not queued again.
+    """
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, overflow=DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % overflow)
+        self._max_pending = max_pending
+        self._overflow = overflow
+        self._queue = collections.deque()  # [kind, aircraft] events
+        self._pending = {}  # aircraft id -> its queued new/update event
+        self._condition = threading.Condition()
+        self._destinations = {}
+        self._thread = None
+        self._stop_requested = False
+        self._delivered = 0
+        self._coalesced = 0
+        self._dropped = 0
+        self._errors = 0
+
+    @property
+    def delivered(self):
+        return self._delivered
+
+    @property
+    def coalesced(self):
+        return self._coalesced
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    @property
+    def errors(self):
+        return self._errors
+
+    def pending(self):
+        return len(self._queue)
+
+    def start(self, destinations):
+        """
+        Start delivering events to destinations, a dict of id ->
+        callback destination (shared with the AircraftMap, so later
+        registrations are seen).
+        """
+        self._destinations = destinations
+        self._stop_requested = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="callback-dispatcher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Deliver any queued events, then stop the worker thread."""
+        with self._condition:
+            self._stop_requested = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, kind, aircraft):
+        """Queue an event of the given kind (NEW, UPDATE or REMOVE)."""
+        with self._condition:
+            if kind == REMOVE:
+                # Any later event for this aircraft belongs to a new
+                # sighting, so don't coalesce it into an earlier one
+                self._pending.pop(aircraft.id, None)
+            elif aircraft.id in self._pending:
+                self._coalesced += 1
+                return
+            if len(self._queue) >= self._max_pending:
+                if self._overflow == DROP_NEWEST:
+                    if kind == UPDATE:
+                        self._dropped += 1
+                        return
+                    self._drop_oldest_update()
+                elif self._overflow == DROP_OLDEST:
+                    if not self._drop_oldest_update() and kind == UPDATE:
+                        self._dropped += 1
+                        return
+                else:
+                    while (len(self._queue) >= self._max_pending and
+                           self._thread is not None):
+                        self._condition.wait()
+            event = [kind, aircraft]
+            if kind != REMOVE:
+                self._pending[aircraft.id] = event
+            self._queue.append(event)
+            self._condition.notify_all()
+
+    def _drop_oldest_update(self):
+        # Must hold the lock. Returns False if no update is queued.
+        for i, event in enumerate(self._queue):
+            if event[0] == UPDATE:
+                del self._queue[i]
+                self._discard(event)
+                self._dropped += 1
+                return True
+        return False
+
+    def _discard(self, event):
+        kind, aircraft = event
+        if self._pending.get(aircraft.id) is event:
+            del self._pending[aircraft.id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stop_requested:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                event = self._queue.popleft()
+                self._discard(event)
+                # Wake up anyone blocked waiting for room in the queue
+                self._condition.notify_all()
+            self._deliver(*event)
+
+    def _deliver(self, kind, aircraft):
+        for id, obj in list(self._destinations.items()):
+            try:
+                if kind == NEW:
+                    obj.new_aircraft_callback(aircraft)
+                elif kind == UPDATE:
+                    obj.update_aircraft_callback(aircraft)
+                else:
+                    obj.remove_aircraft_callback(aircraft)
+            except Exception:
+                self._errors += 1
+                print(traceback.format_exc())
+        self._delivered += 1
+
+    def print_summary(self):
+        print("%d callbacks delivered, %d coalesced, %d dropped, "
+              "%d errors, %d pending" % (
+                  self._delivered, self._coalesced, self._dropped,
+                  self._errors, len(self._queue)))
@@ -0,0 +1,205 @@
+# columnar_recording: recorded position reports stored as fixed width
+# columns, for replaying long recordings quickly. Where a recording
+# (see recording.py) keeps every raw line, to be parsed again on every
+# replay, a columnar recording keeps just the parsed airborne positions
+# (MSG,3), one column per field, in time order, so replay tools can
+# memory map it, find a time range with a binary search, and feed
+# AircraftMap.update() without any string parsing. Make one from other
+# recordings with convert_recording.py.
+#
+# The file is a header followed by the columns, all little endian:
+#
+#   header:  magic "ADSBCOL\0", u16 version, u64 record count,
+#            f8 first timestamp, f8 last timestamp
+#   columns: count f8 timestamps, then count each of u4 ID,
+#            i4 altitude (feet), f4 latitude, f4 longitude
+#
+# IDs are the integer ones from sbs_parser.parse_icao(). Positions are
+# unrounded (to float32 precision, about a meter), so replaying applies
+# the map's rounding and filtering as usual. Velocity messages aren't
+# kept.
+#
+# Writing needs only the standard library; reading needs numpy.
+
+import array
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import recording
+import sbs_parser
+
+MAGIC = b"ADSBCOL\0"
+VERSION = 1
+DEFAULT_BLOCK_SIZE = 65536  # records converted to Python values at once
+
+_HEADER = struct.Struct("<8sH6xQdd")
+# (name, array typecode, numpy dtype) of each column, in file order
+_COLUMNS = (
+    ("timestamp", "d", "<f8"),
+    ("aircraft_id", "I", "<u4"),
+    ("altitude", "i", "<i4"),
+    ("latitude", "f", "<f4"),
+    ("longitude", "f", "<f4"),
+)
+
+
+class ColumnarWriter(object):
+    """
+    Collects position reports and writes them to path as a columnar
+    recording on close(). The columns are held in memory (24 bytes a
+    report) until then, and sorted by time if they were added out of
+    order.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._columns = [array.array(typecode)
+                         for name, typecode, dtype in _COLUMNS]
+        self._sorted = True
+
+    @property
+    def count(self):
+        """The number of reports added so far."""
+        return len(self._columns[0])
+
+    def append(self, timestamp, aircraft_id, altitude, latitude, longitude):
+        timestamps = self._columns[0]
+        if timestamps and timestamp < timestamps[-1]:
+            self._sorted = False
+        for column, value in zip(self._columns, (
+                timestamp, aircraft_id, altitude, latitude, longitude)):
+            column.append(value)
+
+    def append_line(self, timestamp, line):
+        """
+        Add the position in a raw SBS-1 line received at timestamp.
+        Returns True if it was a position report, False otherwise.
+        """
+        try:
+            report = sbs_parser.parse_position(line)
+        except ValueError:
+            return False
+        if report is None:
+            return False
+        self.append(timestamp, report.aircraft_id, report.altitude,
+                    report.latitude, report.longitude)
+        return True
+
+    def close(self):
+        columns = self._columns
+        if not self._sorted:
+            order = sorted(range(self.count), key=columns[0].__getitem__)
+            columns = [array.array(column.typecode,
+                                   (column[i] for i in order))
+                       for column in columns]
+        timestamps = columns[0]
+        with open(self._path, "wb") as fp:
+            fp.write(_HEADER.pack(
+                MAGIC, VERSION, len(timestamps),
+                timestamps[0] if timestamps else 0.0,
+                timestamps[-1] if timestamps else 0.0))
+            for column in columns:
+                if sys.byteorder != "little":
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                column.tofile(fp)
+
+
+def convert(paths, output_path):
+    """
+    Write the position reports from the recordings at paths (anything
+    recording.read_recording() reads) to a columnar recording at
+    output_path. Returns the number of reports written.
+    """
+    writer = ColumnarWriter(output_path)
+    for path in paths:
+        for timestamp, line in recording.read_recording(path):
+            writer.append_line(timestamp, line)
+    writer.close()
+    return writer.count
+
+
+def is_columnar(path):
+    """Return True if path is a columnar recording."""
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+class ColumnarRecording(object):
+    """
+    A columnar recording, memory mapped read only. The columns are
+    numpy arrays (attributes timestamp, aircraft_id, altitude,
+    latitude and longitude), so only the parts of the file that are
+    used are read from disk.
+    """
+    def __init__(self, path):
+        if numpy is None:
+            raise ImportError("ColumnarRecording requires numpy")
+        with open(path, "rb") as fp:
+            header = fp.read(_HEADER.size)
+        if len(header) < _HEADER.size or not header.startswith(MAGIC):
+            raise ValueError("%s is not a columnar recording" % path)
+        (magic, version, self._count, self.start_time,
+         self.end_time) = _HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError("%s is a version %d columnar recording, "
+                             "expected %d" % (path, version, VERSION))
+        offset = _HEADER.size
+        for name, typecode, dtype in _COLUMNS:
+            if self._count:
+                column = numpy.memmap(path, dtype=dtype, mode="r",
+                                      offset=offset, shape=(self._count,))
+            else:
+                # Zero length files can't be mapped
+                column = numpy.zeros(0, dtype=dtype)
+            setattr(self, name, column)
+            offset += self._count * numpy.dtype(dtype).itemsize
+
+    def __len__(self):
+        return self._count
+
+    def index(self, t):
+        """Return the index of the first report at or after time t."""
+        return int(numpy.searchsorted(self.timestamp, t, side="left"))
+
+    def slice(self, start_time=None, end_time=None):
+        """
+        Return (first, last) indexes of the reports from start_time up
+        to, but not including, end_time. None means the start or end of
+        the recording.
+        """
+        first = 0 if start_time is None else self.index(start_time)
+        last = self._count if end_time is None else self.index(end_time)
+        return first, max(first, last)
+
+    def records(self, start_time=None, end_time=None,
+                block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Generate [timestamp, ID, altitude, latitude, longitude] for each
+        report from start_time up to end_time, in the form
+        AircraftMap.update() takes.
+        """
+        first, last = self.slice(start_time, end_time)
+        columns = (self.timestamp, self.aircraft_id, self.altitude,
+                   self.latitude, self.longitude)
+        for i in range(first, last, block_size):
+            j = min(i + block_size, last)
+            for record in zip(*[column[i:j].tolist() for column in columns]):
+                yield record
+
+    def replay(self, aircraft_map, start_time=None, end_time=None):
+        """
+        Apply the reports from start_time up to end_time to
+        aircraft_map, each at the time it was received. Returns the
+        number of reports applied.
+        """
+        count = 0
+        update = aircraft_map.update
+        for record in self.records(start_time, end_time):
+            update(record, now=record[0])
+            count += 1
+        return count
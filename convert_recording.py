@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+"""
+Converts recordings made by recorder.py (chunked or the older
+pickles) and capture.py text files to a columnar recording (see
+columnar_recording.py), for fast replay. Several inputs are merged
+into one output, in time order.
+"""
+
+import argparse
+import sys
+import time
+
+import columnar_recording
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output-file",
+                        help="Columnar recording to write", required=True)
+    parser.add_argument("files", nargs="+",
+                        help="Recordings to convert")
+
+    args = parser.parse_args()
+
+    start = time.time()
+    try:
+        count = columnar_recording.convert(args.files, args.output_file)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Can't convert: %s\n" % e)
+        sys.exit(1)
+    print("Wrote %d position reports to %s in %.1f seconds" % (
+        count, args.output_file, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+# feed_client: an asyncio client for the SBS-1 (BaseStation) feed that
+# dump1090 serves on port 30003. It streams what it reads into an
+# AircraftMap (or hands it to a callback), and reconnects with
+# exponential backoff when the connection fails, times out or goes
+# quiet. A connection counts as dead if no line arrives for
+# read_timeout seconds, if the line rate stays below min_rate, or if
+# TCP keepalive probes go unanswered (which catches half open
+# connections even when read_timeout is long); the client then fails
+# over to the next of its fallback receivers, if it has any. MultiFeed
+# merges several receivers into one map, dropping the duplicate
+# reports they send for aircraft they can all hear.
+# Front ends run a feed alongside their own tasks, e.g.:
+#
+#   client = feed_client.FeedClient(host, port, aircraft_map=the_map)
+#   await asyncio.gather(client.run(),
+#                        feed_client.run_periodically(10.0, make_sound))
+
+import asyncio
+import collections
+import functools
+import socket
+import threading
+import time
+
+import byte_reader
+import metrics
+import sbs_parser
+
+DEFAULT_CONNECT_TIMEOUT = 10.0  # seconds
+DEFAULT_READ_TIMEOUT = 30.0  # seconds without a line before reconnecting
+DEFAULT_RATE_WINDOW = 30.0  # seconds over which min_rate is measured
+DEFAULT_KEEPALIVE_IDLE = 10.0  # seconds before the first keepalive probe
+KEEPALIVE_INTERVAL = 5  # seconds between keepalive probes
+KEEPALIVE_PROBES = 3  # unanswered probes before the connection is dropped
+SILENCE_THRESHOLD = 1.0  # seconds without a line that count as silence
+RECONNECT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+DEFAULT_MIN_BACKOFF = 0.5  # seconds before the first reconnect attempt
+DEFAULT_MAX_BACKOFF = 30.0  # longest wait between reconnect attempts
+DEFAULT_DUPLICATE_WINDOW = 2.0  # seconds
+
+
+class FeedClient(object):
+    """
+    Reads the feed from host:port. If data_callback is given, it is
+    called with all the complete lines received each time, as one
+    bytes object, line endings included, e.g. to pass the feed on
+    unchanged. Otherwise only the lines starting with one of prefixes
+    are kept (by default byte_reader.MAP_PREFIXES, the lines the
+    aircraft map uses; None keeps every line); they are delivered in
+    batches, as they arrive, in one of three ways:
+
+    - if line_callback is given, it is called with each line (a str,
+      including the newline), e.g. to record lines as they arrive;
+    - if batch_callback is given, it is called with the list of lines
+      (bytes, without line endings) in each batch and the number of
+      lines read, including the ones that weren't kept;
+    - otherwise they are fed to aircraft_map.update_from_raw_many()
+      (aircraft_map can be anything with that method, such as a
+      load_shedding.LoadShedder).
+
+    after_batch, if given, is called with no arguments after each
+    batch has been delivered, e.g. to publish a snapshot of the map
+    for other threads. on_connect and on_disconnect, if given, are called with
+    no arguments as the connection comes and goes.
+
+    The connection is dropped if no line arrives for read_timeout
+    seconds, or, if min_rate is given, fewer than min_rate lines per
+    second arrive over rate_window seconds. keepalive is the idle time
+    before TCP keepalive probes start (0 or None for none). fallbacks
+    is a list of (host, port) pairs to fail over to, in turn, when a
+    connection is dropped or fails; backoff only applies once every
+    address has failed in a row.
+    """
+    def __init__(self, host, port, aircraft_map=None, line_callback=None,
+                 batch_callback=None, data_callback=None,
+                 prefixes=byte_reader.MAP_PREFIXES,
+                 after_batch=None, on_connect=None, on_disconnect=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, min_rate=None,
+                 rate_window=DEFAULT_RATE_WINDOW,
+                 keepalive=DEFAULT_KEEPALIVE_IDLE, fallbacks=(),
+                 min_backoff=DEFAULT_MIN_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF,
+                 metrics_registry=metrics.REGISTRY):
+        if (aircraft_map is None and line_callback is None and
+                batch_callback is None and data_callback is None):
+            raise ValueError("Need an aircraft_map or a callback")
+        self._addresses = [(host, port)] + list(fallbacks)
+        self._map = aircraft_map
+        self._line_callback = line_callback
+        self._batch_callback = batch_callback
+        self._data_callback = data_callback
+        self._prefixes = prefixes
+        self._after_batch = after_batch
+        self._on_connect = on_connect
+        self._on_disconnect = on_disconnect
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._min_rate = min_rate
+        self._rate_window = rate_window
+        self._keepalive = keepalive
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._task = None
+        self._stop_requested = False
+        self._last_line = None  # time.monotonic() of the last line read
+        self._silence_counted = 0.0  # silence before this is counted
+        self._lost_at = None  # when the last connection was lost
+        self._lines_read = metrics_registry.counter(
+            "adsb_lines_read_total", "Lines read from the ADSB receiver")
+        self._lines_filtered = metrics_registry.counter(
+            "adsb_lines_ignored_total", "Lines ignored, by reason",
+            {"reason": "byte_filter"})
+        self._reconnects = metrics_registry.counter(
+            "adsb_reconnects_total", "Connection attempts after the first")
+        self._failovers = metrics_registry.counter(
+            "adsb_failovers_total", "Switches to another receiver address")
+        self._stalls = {
+            reason: metrics_registry.counter(
+                "adsb_feed_stalls_total",
+                "Connections dropped by the watchdog, by reason",
+                {"reason": reason})
+            for reason in ("read_timeout", "low_rate")}
+        self._silent = metrics_registry.counter(
+            "adsb_feed_silent_seconds_total",
+            "Seconds without a line, in gaps over %g s" % SILENCE_THRESHOLD)
+        self._reconnect_latency = metrics_registry.histogram(
+            "adsb_reconnect_latency_seconds",
+            "From losing a connection to the first data on the next",
+            buckets=RECONNECT_BUCKETS)
+
+    async def run(self):
+        """
+        Connect and read until stop() is called, reconnecting as
+        needed. Waits min_backoff seconds before the first reconnect
+        attempt, doubling the wait (up to max_backoff) each time an
+        attempt fails before receiving any data. With fallbacks, the
+        next address is tried straight away instead, until they have
+        all failed.
+        """
+        self._task = asyncio.current_task()
+        self._stop_requested = False
+        addresses = self._addresses
+        index = 0
+        failures = 0  # addresses in a row that failed without data
+        backoff = self._min_backoff
+        first_attempt = True
+        try:
+            while not self._stop_requested:
+                if not first_attempt:
+                    self._reconnects.inc()
+                first_attempt = False
+                host, port = addresses[index]
+                received = False
+                try:
+                    received = await self._connection(host, port)
+                except (OSError, asyncio.TimeoutError) as e:
+                    print("Connection to %s:%d failed: %s" % (
+                        host, port, str(e) or e.__class__.__name__))
+                if self._stop_requested:
+                    break
+                if self._lost_at is None:
+                    self._lost_at = time.monotonic()
+                self._count_silence(time.monotonic())
+                if received:
+                    backoff = self._min_backoff
+                    failures = 0
+                else:
+                    failures += 1
+                if len(addresses) > 1:
+                    index = (index + 1) % len(addresses)
+                    if failures < len(addresses):
+                        print("Failing over to %s:%d" % addresses[index])
+                        self._failovers.inc()
+                        continue
+                    failures = 0
+                print("Reconnect to %s:%d in %.1f s" % (
+                    addresses[index][0], addresses[index][1], backoff))
+                await asyncio.sleep(backoff)
+                if not received:
+                    backoff = min(backoff * 2, self._max_backoff)
+        except asyncio.CancelledError:
+            if not self._stop_requested:
+                raise
+        finally:
+            self._task = None
+
+    def stop(self):
+        """
+        Stop run(), closing the connection. Must be called from the
+        thread running the event loop.
+        """
+        self._stop_requested = True
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _connection(self, host, port):
+        """
+        Run one connection until it fails or the watchdog drops it.
+        Returns True if any data was received.
+        """
+        print("Connect to %s:%d" % (host, port))
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if self._keepalive:
+            set_keepalive(sock, self._keepalive)
+        connected = False
+        received = False
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (host, port)),
+                                   self._connect_timeout)
+            connected = True
+            if self._on_connect is not None:
+                self._on_connect()
+            buffer = byte_reader.LineBuffer(prefixes=self._prefixes)
+            now = time.monotonic()
+            line_deadline = now + self._read_timeout
+            window_start = now
+            window_lines = 0
+            while True:
+                wake = line_deadline
+                if self._min_rate:
+                    wake = min(wake, window_start + self._rate_window)
+                try:
+                    count = await asyncio.wait_for(
+                        loop.sock_recv_into(sock, buffer.writable()),
+                        max(0.0, wake - time.monotonic()))
+                except asyncio.TimeoutError:
+                    count = None
+                now = time.monotonic()
+                if count == 0:
+                    print("No data, reconnect")
+                    return received
+                if count:
+                    if not received and self._lost_at is not None:
+                        self._reconnect_latency.observe(now - self._lost_at)
+                        self._lost_at = None
+                    received = True
+                    seen = self._receive(buffer, count)
+                    if seen:
+                        self._count_silence(now)
+                        self._last_line = now
+                        line_deadline = now + self._read_timeout
+                        window_lines += seen
+                if now >= line_deadline:
+                    print("No lines for %.1f s" % self._read_timeout)
+                    self._stalls["read_timeout"].inc()
+                    return received
+                if self._min_rate and now >= window_start + self._rate_window:
+                    rate = window_lines / (now - window_start)
+                    if rate < self._min_rate:
+                        print("Feed rate %.1f lines/s is below %.1f" % (
+                            rate, self._min_rate))
+                        self._stalls["low_rate"].inc()
+                        return received
+                    window_start = now
+                    window_lines = 0
+        finally:
+            sock.close()
+            if connected:
+                self._lost_at = time.monotonic()
+                if self._on_disconnect is not None:
+                    self._on_disconnect()
+
+    def _receive(self, buffer, count):
+        # Deliver what count bytes in buffer complete, returning the
+        # number of lines they complete
+        if self._data_callback is not None:
+            data = buffer.commit_raw(count)
+            if not data:
+                return 0
+            seen = data.count(b"\n")
+            self._lines_read.inc(seen)
+            self._data_callback(data)
+            return seen
+        lines, seen = buffer.commit(count)
+        if seen:
+            self._deliver(lines, seen)
+        return seen
+
+    def _count_silence(self, now):
+        # Add any gap since the last line longer than SILENCE_THRESHOLD
+        # to the silent seconds, a piece at a time so a long outage
+        # shows up while it lasts
+        last_line = self._last_line
+        if last_line is None or now - last_line < SILENCE_THRESHOLD:
+            return
+        start = max(last_line, self._silence_counted)
+        self._silent.inc(now - start)
+        self._silence_counted = now
+
+    def _deliver(self, lines, seen):
+        self._lines_read.inc(seen)
+        self._lines_filtered.inc(seen - len(lines))
+        if self._line_callback is not None:
+            for line in lines:
+                self._line_callback(line.decode("ascii", "replace") + "\n")
+        elif self._batch_callback is not None:
+            self._batch_callback(lines, seen)
+        else:
+            self._map.update_from_raw_many(lines)
+        if self._after_batch is not None:
+            self._after_batch()
+
+
+def set_keepalive(sock, idle, interval=KEEPALIVE_INTERVAL,
+                  probes=KEEPALIVE_PROBES):
+    """
+    Turn on TCP keepalive for sock, so that a peer that has gone away
+    without closing the connection is noticed after about idle +
+    interval * probes seconds. The timings are set where the platform
+    allows it.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                        max(1, int(idle)))
+    elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE,
+                        max(1, int(idle)))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+
+
+class DuplicateFilter(object):
+    """
+    Recognizes position reports that have already been seen, from any
+    receiver, in the last window seconds. Receivers that hear the same
+    aircraft send the same ICAO, altitude and position, so those raw
+    fields are compared as bytes before any parsing is done.
+    """
+    def __init__(self, window=DEFAULT_DUPLICATE_WINDOW):
+        self._window = window
+        self._seen = collections.OrderedDict()  # report key -> time seen
+
+    def expire(self, now):
+        """Forget reports seen more than window seconds before now."""
+        cutoff = now - self._window
+        expired = []
+        for key, seen_at in self._seen.items():
+            if seen_at >= cutoff:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._seen[key]
+
+    def is_duplicate(self, line, now):
+        """
+        Return True if line (bytes) is a position report that has
+        been seen since the last expire(). Other lines are never
+        duplicates.
+        """
+        if not line.startswith(sbs_parser.POSITION_PREFIX_BYTES):
+            return False
+        parts = line.split(b",", sbs_parser.LONGITUDE_FIELD + 1)
+        if len(parts) <= sbs_parser.LONGITUDE_FIELD:
+            return False
+        key = (parts[sbs_parser.ICAO_FIELD], parts[sbs_parser.ALTITUDE_FIELD],
+               parts[sbs_parser.LATITUDE_FIELD],
+               parts[sbs_parser.LONGITUDE_FIELD])
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+
+class MultiFeed(object):
+    """
+    Reads from several receivers, given as (host, port) pairs, at
+    once, and merges their feeds into one AircraftMap. Position
+    reports already received from another receiver (or the same one)
+    in the last duplicate_window seconds are dropped before parsing.
+
+    The other arguments are as for FeedClient, except that there are
+    no fallbacks: every receiver is already in use. Each receiver has
+    its own lines read and duplicates dropped counters, and duplicate
+    ratio gauge, labelled with its host:port.
+    """
+    def __init__(self, receivers, aircraft_map,
+                 duplicate_window=DEFAULT_DUPLICATE_WINDOW,
+                 metrics_registry=metrics.REGISTRY, fallbacks=(), **kwargs):
+        if fallbacks:
+            print("Reading from all receivers; fallbacks are unused")
+        self._map = aircraft_map
+        self._filter = DuplicateFilter(duplicate_window)
+        self._clients = []
+        for host, port in receivers:
+            labels = {"receiver": "%s:%d" % (host, port)}
+            deliver = functools.partial(
+                self._deliver, labels["receiver"],
+                metrics_registry.counter(
+                    "adsb_receiver_lines_total",
+                    "Lines read, by receiver", labels),
+                metrics_registry.counter(
+                    "adsb_receiver_duplicates_total",
+                    "Duplicate position reports dropped, by receiver",
+                    labels),
+                metrics_registry.gauge(
+                    "adsb_receiver_duplicate_ratio",
+                    "Fraction of lines dropped as duplicates, by receiver",
+                    labels))
+            self._clients.append(FeedClient(
+                host, port, batch_callback=deliver,
+                metrics_registry=metrics_registry, **kwargs))
+
+    async def run(self):
+        """Read from all the receivers until stop() is called."""
+        await asyncio.gather(*[client.run() for client in self._clients])
+
+    def stop(self):
+        for client in self._clients:
+            client.stop()
+
+    def _deliver(self, source, lines_read, duplicates, duplicate_ratio, lines,
+                 seen):
+        now = time.time()
+        self._filter.expire(now)
+        is_duplicate = self._filter.is_duplicate
+        batch = [line for line in lines if not is_duplicate(line, now)]
+        lines_read.inc(seen)
+        duplicates.inc(len(lines) - len(batch))
+        if lines_read.value:
+            duplicate_ratio.set(float(duplicates.value) / lines_read.value)
+        self._map.update_from_raw_many(batch, source=source)
+
+
+def open_feed(receivers, aircraft_map,
+              duplicate_window=DEFAULT_DUPLICATE_WINDOW, **kwargs):
+    """
+    Return a FeedClient that feeds aircraft_map from the one receiver
+    in receivers, a list of (host, port) pairs, or a MultiFeed if
+    there are several. Other arguments are as for FeedClient (but see
+    MultiFeed on fallbacks).
+    """
+    if len(receivers) == 1:
+        host, port = receivers[0]
+        return FeedClient(host, port, aircraft_map=aircraft_map, **kwargs)
+    return MultiFeed(receivers, aircraft_map,
+                     duplicate_window=duplicate_window, **kwargs)
+
+
+async def run_periodically(interval, func, initial_delay=0.0):
+    """
+    Call func() every interval seconds, after waiting initial_delay
+    seconds, until cancelled. Time spent in func() counts towards the
+    interval, so calls don't drift.
+    """
+    await asyncio.sleep(initial_delay)
+    next_call = time.monotonic()
+    while True:
+        func()
+        next_call += interval
+        await asyncio.sleep(max(0.0, next_call - time.monotonic()))
+
+
+def start_thread(client):
+    """
+    Run client in a new event loop on a daemon thread (for front ends
+    whose main thread belongs to something else, like a GUI). Returns
+    the thread.
+    """
+    thread = threading.Thread(target=asyncio.run, args=(client.run(),),
+                              name="feed-client", daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_receiver(text):
+    """Parse a "host:port" receiver address, for argparse."""
+    host, sep, port = text.rpartition(":")
+    if not sep or not host:
+        raise ValueError("Expected host:port, got %s" % text)
+    return host, int(port)
+
+
+def add_arguments(parser, multiple_receivers=True):
+    """
+    Add the --connect-timeout, --read-timeout, --min-rate,
+    --rate-window, --keepalive and --fallback options to parser, and
+    if multiple_receivers is True, --receiver and --duplicate-window.
+    """
+    parser.add_argument("--connect-timeout", type=float,
+                        help="Seconds to wait when connecting to dump1090",
+                        default=DEFAULT_CONNECT_TIMEOUT)
+    parser.add_argument("--read-timeout", type=float,
+                        help="Reconnect after this many seconds without a "
+                        "line",
+                        default=DEFAULT_READ_TIMEOUT)
+    parser.add_argument("--min-rate", type=float,
+                        help="Reconnect if fewer than this many lines per "
+                        "second arrive over --rate-window seconds")
+    parser.add_argument("--rate-window", type=float,
+                        help="Seconds over which --min-rate is measured",
+                        default=DEFAULT_RATE_WINDOW)
+    parser.add_argument("--keepalive", type=float,
+                        help="Seconds idle before TCP keepalive probes start "
+                        "(0 for none)",
+                        default=DEFAULT_KEEPALIVE_IDLE)
+    parser.add_argument("--fallback", type=parse_receiver, action="append",
+                        metavar="HOST:PORT",
+                        help="Fail over to this dump1090 when the feed "
+                        "stalls (may be repeated)",
+                        default=[])
+    if not multiple_receivers:
+        return
+    parser.add_argument("--receiver", type=parse_receiver, action="append",
+                        metavar="HOST:PORT",
+                        help="Also read from this dump1090 (may be repeated)",
+                        default=[])
+    parser.add_argument("--duplicate-window", type=float,
+                        help="Drop position reports seen from another "
+                        "receiver within this many seconds",
+                        default=DEFAULT_DUPLICATE_WINDOW)
+
+
+def receivers(args):
+    """
+    Return the (host, port) pairs to read from: --host and --port,
+    then any --receiver options.
+    """
+    return [(args.host, args.port)] + args.receiver
+
+
+def feed_options(args):
+    """
+    Return the FeedClient keyword arguments for the timeout, watchdog
+    and fallback options added by add_arguments().
+    """
+    return {"connect_timeout": args.connect_timeout,
+            "read_timeout": args.read_timeout,
+            "min_rate": args.min_rate,
+            "rate_window": args.rate_window,
+            "keepalive": args.keepalive,
+            "fallbacks": args.fallback}
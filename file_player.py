@@ -93,7 +93,7 @@ class FilePlayer(object):
                     self._player.note_on(note, volume, midi_channel)
                     print("Id %s alt %s MIDI note %d MIDI vol %d MIDI chan %d "
                           "dist %d m" %
-                          (a.id, a.altitude, note, volume, midi_channel + 1,
+                          (a.icao, a.altitude, note, volume, midi_channel + 1,
                            a.distance_to(self._mylat, self._mylon)))
                     midi_channel = (midi_channel + 1) % self._num_midi_channels
 
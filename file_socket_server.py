@@ -2,16 +2,30 @@
 
 """
 Reads a series of saved ADSB data  dump files, and serves them
-to a TCP socket, as if being served by dump1090. Also allows
-for playback to be sped up or slowed down.
+to a TCP socket, as if being served by dump1090, to any number of
+clients at once, each playing from the start. Also allows
+for playback to be sped up or slowed down, and to start part way
+through. When it does, the preceding few minutes are sent at once
+first, so the client's map is already full of aircraft when playback
+starts.
 """
 
 import argparse
-import pickle
-import socket
+import asyncio
+import datetime
+import heapq
+import itertools
+import os
+import tempfile
 import time
 import traceback
 
+import aircraft_map
+import recording
+
+DEFAULT_CLIENT_BUFFER = 256 * 1024  # bytes
+READ_BATCH = 1024  # records read at a time for a client
+
 class SyntheticClock:
     def __init__(self, factor):
         self._factor = factor
@@ -29,51 +43,176 @@ class FileSocketServer(object):
         self._time_factor = args.time_factor
         self._port = args.port
         self._start_offset = args.start_offset
-        self._data = []
-        self._clock = SyntheticClock(self._time_factor)
+        self._seek_time = args.start_time
+        self._prewarm = args.prewarm
+        self._client_buffer = args.client_buffer
+        self._converted = None  # directory of converted old recordings
 
-    def init(self):
-        all_file_data = []
-        for file in self._files:
+    def _convert_pickles(self):
+        # An old pickled recording can only be loaded whole, so merging
+        # them would load every one at once. Convert each (one at a
+        # time) to a temporary chunked recording, which can be read a
+        # chunk at a time like the rest.
+        files = []
+        for i, file in enumerate(self._files):
             try:
-                file_data = pickle.load(open(file, "rb"))
-                print("Loaded %d data points from file %s" % (len(file_data), file))
-                all_file_data.extend(pickle.load(open(file, "rb")))
+                if recording.is_pickle(file):
+                    if self._converted is None:
+                        self._converted = tempfile.TemporaryDirectory()
+                    path = os.path.join(self._converted.name, "%d.rec" % i)
+                    print("Converting %s (%d records)" % (
+                        file, recording.convert(file, path)))
+                    file = path
             except Exception as ex:
                 print("oops on %s" % file)
                 print(traceback.format_exc())
-        print("Loaded %d data points" % len(all_file_data))
-        self._data = sorted(all_file_data)
-
-    def serve(self, connection):
-        # Note the timestamp of the first data point
-        first_timestamp = self._data[0][0]
-        self._clock.start()
-        for timestamp, line in self._data:
-            time_offset = timestamp - first_timestamp
-            clock_now = self._clock.now()
-            if time_offset < clock_now:
-                print("%0.2f %s" % (time_offset, line))
-                connection.send(line.encode("utf-8"))
-            else:
-                sleep_time = (time_offset - clock_now) / self._time_factor
-                time.sleep(sleep_time)
-                print("%0.2f %s" % (time_offset, line))
-                connection.send(line.encode("utf-8"))
-
-    def wait_for_connection(self):
-        serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        serversocket.bind(('localhost', self._port))
-        serversocket.listen(5) # become a server socket, maximum 5 connections
+                continue
+            files.append(file)
+        self._files = files
 
-        while True:
-            connection, address = serversocket.accept()
+    def init(self):
+        # Files are read as they're served (see _records()); just find
+        # where they start
+        self._convert_pickles()
+        start_times = []
+        for file in self._files:
             try:
-                self.serve(connection)
+                start_time = recording.first_timestamp(file)
             except Exception as ex:
+                print("oops on %s" % file)
                 print(traceback.format_exc())
-                # Client probably disconnected. Just go back to listening.
+                continue
+            if start_time is not None:
+                start_times.append(start_time)
+        if not start_times:
+            print("Nothing to serve")
+            return
+        start_time = min(start_times)
+        if self._seek_time is None:
+            self._seek_time = start_time + self._start_offset
+        print("Serving from %s (%.1f seconds into the recording)" % (
+            datetime.datetime.fromtimestamp(self._seek_time),
+            self._seek_time - start_time))
+
+    def _read(self, file, start_time):
+        # A file that can't be read is left out, not fatal
+        try:
+            for record in recording.read_recording(file,
+                                                   start_time=start_time):
+                yield record
+        except Exception as ex:
+            print("oops on %s" % file)
+            print(traceback.format_exc())
+
+    def _records(self, start_time):
+        """
+        Return an iterator over the records to serve from start_time
+        on, in time order. The files are merged as they're read, so
+        only a chunk of each is in memory at once (init() has converted
+        the old pickled recordings, which can't be read a chunk at a
+        time). Each file must be in time order, as recordings are.
+        """
+        return heapq.merge(*[self._read(file, start_time)
+                             for file in self._files],
+                           key=lambda record: record[0])
+
+    async def _stream(self, start_time):
+        """
+        Generate the records to serve from start_time on, as
+        _records() does, but read READ_BATCH at a time on a worker
+        thread, so one client's reads don't hold up the others.
+        """
+        loop = asyncio.get_running_loop()
+        records = self._records(start_time)
+        while True:
+            batch = await loop.run_in_executor(
+                None, list, itertools.islice(records, READ_BATCH))
+            if not batch:
+                return
+            for record in batch:
+                yield record
+
+    async def serve(self, writer, name):
+        """
+        Play the recording to one client. Each client has its own
+        place in the recording and its own clock, so clients that
+        connect at different times each get the whole recording.
+        """
+        if self._seek_time is None:
+            return
+        clock = SyntheticClock(self._time_factor)
+        warmup = 0
+        started = False
+        # Time is measured from the seek time, which is the first
+        # record's time when not seeking
+        first_timestamp = self._seek_time
+        async for timestamp, line in self._stream(
+                self._seek_time - self._prewarm):
+            if timestamp < self._seek_time:
+                # Send the records before the seek time at once, to
+                # warm up the client's map
+                writer.write(line.encode("utf-8"))
+                await writer.drain()
+                warmup += 1
+                continue
+            if not started:
+                if warmup:
+                    print("Sent %s %d records from the %d seconds before "
+                          "the start" % (name, warmup, self._prewarm))
+                clock.start()
+                started = True
+            time_offset = timestamp - first_timestamp
+            clock_now = clock.now()
+            if time_offset >= clock_now:
+                await asyncio.sleep((time_offset - clock_now) /
+                                    self._time_factor)
+            print("%s %0.2f %s" % (name, time_offset, line))
+            writer.write(line.encode("utf-8"))
+            # Waits only while more than client_buffer bytes are
+            # waiting to be sent, so a slow client just falls behind
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        name = "%s:%d" % writer.get_extra_info("peername")[:2]
+        print("Client %s connected" % name)
+        writer.transport.set_write_buffer_limits(high=self._client_buffer)
+        try:
+            await self.serve(writer, name)
+        except ConnectionError:
+            pass  # the client disconnected
+        except Exception as ex:
+            print(traceback.format_exc())
+        finally:
+            print("Client %s finished" % name)
+            writer.close()
+
+    async def _run(self):
+        server = await asyncio.start_server(self._handle, "localhost",
+                                            self._port)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        """Serve the recording to any number of clients at once."""
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            pass
+
+def parse_time(text):
+    """
+    Return the time given as seconds since the epoch or an ISO 8601
+    local time, in seconds since the epoch.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time: %r" % text)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -83,17 +222,30 @@ def main():
     parser.add_argument("--time-factor", type=float,
                          help="Scale playback by this factor",
                          default=1)
-    # start-offset not yet implemented
-    parser.add_argument("--start-offset", type=int,
-                        help="Start point (in seconds)",
+    parser.add_argument("--start-offset", type=float,
+                        help="Start point (in seconds from the start of "
+                        "the recording)",
                         default=0)
+    parser.add_argument("--start-time", type=parse_time,
+                        help="Start point, as a local time (e.g. "
+                        "2021-06-01T12:30:00) or seconds since the epoch; "
+                        "overrides --start-offset")
+    parser.add_argument("--prewarm", type=float,
+                        help="Seconds of data before the start point to "
+                        "send at once, so the client starts with a full "
+                        "map (0 to not)",
+                        default=aircraft_map.DEFAULT_PURGE_TIME)
+    parser.add_argument("--client-buffer", type=int,
+                        help="Most bytes to buffer for a client before "
+                        "pausing its playback until it catches up",
+                        default=DEFAULT_CLIENT_BUFFER)
     parser.add_argument("files", nargs="*")
 
     args = parser.parse_args()
 
     file_player = FileSocketServer(args)
     file_player.init()
-    file_player.wait_for_connection()
+    file_player.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+# geodesy: ways of computing the distance and bearing from a fixed
+# observer to an aircraft, trading accuracy for speed.
+#
+# Each strategy is constructed with the observer's position, so the
+# terms that only depend on the observer are computed once. Pick one
+# by name with observer(), e.g. observer("equirectangular", lat, lon).
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_RADIUS = 6371000  # Earth's radius in meters
+_RADIANS_PER_DEGREE = math.pi / 180.0
+
+# Worst case relative distance error, versus haversine, for aircraft
+# within MAX_CHECKED_RANGE meters of an observer at up to
+# MAX_CHECKED_LATITUDE degrees north or south (checked by test_geodesy.py)
+MAX_CHECKED_RANGE = 200000
+MAX_CHECKED_LATITUDE = 60.0
+ERROR_BOUNDS = {
+    "haversine": 1e-9,
+    "equirectangular": 0.001,
+    "numpy": 1e-9,
+}
+
+
+class Haversine(object):
+    """
+    Great circle distance with the haversine formula, and rhumb line
+    bearing. This is the reference: it computes the same values as
+    util.distance_to() and util.bearing_from().
+    """
+    __slots__ = ("latitude", "longitude", "lat_rad", "lon_rad", "cos_lat",
+                 "mercator")
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.lat_rad = math.radians(latitude)
+        self.lon_rad = math.radians(longitude)
+        self.cos_lat = math.cos(self.lat_rad)
+        self.mercator = math.log(math.tan(self.lat_rad/2.0+math.pi/4.0))
+
+    def distance(self, latitude, longitude):
+        """
+        Distance, in meters, from the observer to the ground projection
+        of an aircraft at latitude, longitude.
+        """
+        lat_rad = math.radians(latitude)
+        sin_d_lat = math.sin((self.lat_rad - lat_rad)/2)
+        sin_d_lon = math.sin((self.lon_rad - math.radians(longitude))/2)
+        a = (sin_d_lat * sin_d_lat +
+             sin_d_lon * sin_d_lon * math.cos(lat_rad) * self.cos_lat)
+        return EARTH_RADIUS * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+    def bearing(self, latitude, longitude):
+        """
+        Bearing, in degrees, of an aircraft at latitude, longitude as
+        seen from the observer.
+        """
+        d_lon = self.lon_rad - math.radians(longitude)
+        d_phi = self.mercator - math.log(
+            math.tan(math.radians(latitude)/2.0+math.pi/4.0))
+        if abs(d_lon) > math.pi:
+            if d_lon > 0.0:
+                d_lon = -(2.0 * math.pi - d_lon)
+            else:
+                d_lon = (2.0 * math.pi + d_lon)
+        return (math.degrees(math.atan2(d_lon, d_phi)) + 360.0) % 360.0
+
+
+class Equirectangular(Haversine):
+    """
+    Treats the earth around the observer as flat, scaling longitude
+    differences by the cosine of the mean latitude (approximated to
+    first order from the observer's cosine, so there's no trig per
+    aircraft). Needs one sqrt per distance, and is within 0.1% of
+    haversine out to 200 km at latitudes up to 60 degrees.
+    """
+    __slots__ = ("meters_per_radian_lon", "half_tan_lat")
+
+    def __init__(self, latitude, longitude):
+        Haversine.__init__(self, latitude, longitude)
+        self.meters_per_radian_lon = EARTH_RADIUS * self.cos_lat
+        # cos(lat - d/2) ~= cos(lat) * (1 + tan(lat) * d/2)
+        self.half_tan_lat = math.tan(self.lat_rad) / 2.0
+
+    def _offsets(self, latitude, longitude):
+        d_lat = self.lat_rad - math.radians(latitude)
+        d_lon = self.lon_rad - math.radians(longitude)
+        if d_lon > math.pi:
+            d_lon -= 2.0 * math.pi
+        elif d_lon < -math.pi:
+            d_lon += 2.0 * math.pi
+        return (d_lon * self.meters_per_radian_lon *
+                (1.0 + self.half_tan_lat * d_lat),
+                d_lat * EARTH_RADIUS)
+
+    def distance(self, latitude, longitude):
+        # Same as _offsets(), inlined since this is the hot path
+        d_lat = self.lat_rad - latitude * _RADIANS_PER_DEGREE
+        d_lon = self.lon_rad - longitude * _RADIANS_PER_DEGREE
+        if d_lon > math.pi:
+            d_lon -= 2.0 * math.pi
+        elif d_lon < -math.pi:
+            d_lon += 2.0 * math.pi
+        x = (d_lon * self.meters_per_radian_lon *
+             (1.0 + self.half_tan_lat * d_lat))
+        y = d_lat * EARTH_RADIUS
+        return math.sqrt(x * x + y * y)
+
+    def bearing(self, latitude, longitude):
+        x, y = self._offsets(latitude, longitude)
+        return (math.degrees(math.atan2(x, y)) + 360.0) % 360.0
+
+    def distances(self, latitudes, longitudes):
+        """Vectorized distance() over NumPy arrays."""
+        x, y = self._offset_arrays(latitudes, longitudes)
+        return numpy.hypot(x, y)
+
+    def bearings(self, latitudes, longitudes):
+        """Vectorized bearing() over NumPy arrays."""
+        x, y = self._offset_arrays(latitudes, longitudes)
+        return (numpy.degrees(numpy.arctan2(x, y)) + 360.0) % 360.0
+
+    def _offset_arrays(self, latitudes, longitudes):
+        d_lat = self.lat_rad - numpy.radians(latitudes)
+        d_lon = self.lon_rad - numpy.radians(longitudes)
+        d_lon = (d_lon + math.pi) % (2.0 * math.pi) - math.pi
+        return (d_lon * self.meters_per_radian_lon *
+                (1.0 + self.half_tan_lat * d_lat),
+                d_lat * EARTH_RADIUS)
+
+
+class NumpyHaversine(Haversine):
+    """
+    Haversine and rhumb line bearing, vectorized over NumPy arrays of
+    aircraft positions. The scalar methods are those of Haversine.
+    """
+    __slots__ = ()
+
+    def __init__(self, latitude, longitude):
+        if numpy is None:
+            raise ImportError("The numpy geodesy strategy requires numpy")
+        Haversine.__init__(self, latitude, longitude)
+
+    def distances(self, latitudes, longitudes):
+        """Vectorized distance() over NumPy arrays."""
+        lat_rad = numpy.radians(latitudes)
+        sin_d_lat = numpy.sin((self.lat_rad - lat_rad) / 2)
+        sin_d_lon = numpy.sin((self.lon_rad - numpy.radians(longitudes)) / 2)
+        a = (sin_d_lat * sin_d_lat +
+             sin_d_lon * sin_d_lon * numpy.cos(lat_rad) * self.cos_lat)
+        numpy.clip(a, 0.0, 1.0, out=a)
+        return EARTH_RADIUS * 2 * numpy.arctan2(numpy.sqrt(a),
+                                                numpy.sqrt(1 - a))
+
+    def bearings(self, latitudes, longitudes):
+        """Vectorized bearing() over NumPy arrays."""
+        d_lon = self.lon_rad - numpy.radians(longitudes)
+        d_lon = numpy.where(d_lon > math.pi, d_lon - 2.0 * math.pi,
+                            numpy.where(d_lon < -math.pi,
+                                        d_lon + 2.0 * math.pi, d_lon))
+        d_phi = self.mercator - numpy.log(
+            numpy.tan(numpy.radians(latitudes) / 2.0 + math.pi / 4.0))
+        return (numpy.degrees(numpy.arctan2(d_lon, d_phi)) + 360.0) % 360.0
+
+
+STRATEGIES = {
+    "haversine": Haversine,
+    "equirectangular": Equirectangular,
+    "numpy": NumpyHaversine,
+}
+DEFAULT_STRATEGY = "haversine"
+
+
+def observer(strategy, latitude, longitude):
+    """
+    Return an observer at latitude, longitude that computes distances
+    and bearings with the named strategy (one of STRATEGIES).
+    """
+    try:
+        return STRATEGIES[strategy](latitude, longitude)
+    except KeyError:
+        raise ValueError("Unknown geodesy strategy %s (choose from %s)" % (
+            strategy, ", ".join(sorted(STRATEGIES))))
+
+
+def vectorized_observer(strategy, latitude, longitude):
+    """
+    Like observer(), but the result also has the vectorized
+    distances() and bearings() methods. Strategies without a
+    vectorized form fall back to the numpy (haversine) strategy.
+    """
+    result = observer(strategy, latitude, longitude)
+    if not hasattr(result, "distances") or numpy is None:
+        result = NumpyHaversine(latitude, longitude)
+    return result
+
+
+def add_arguments(parser):
+    """Add the --geodesy option to parser."""
+    parser.add_argument("--geodesy",
+                        choices=sorted(STRATEGIES.keys()),
+                        help="How to compute distances and bearings",
+                        default=DEFAULT_STRATEGY)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# ingest_daemon: owns the connection to the receiver(s) and the
+# AircraftMap, and publishes the map to shared memory (see
+# shared_map.py) for front ends started with --shared-map, so running
+# several of them at once costs one connection and one parse of the
+# feed instead of one each.
+
+import argparse
+import asyncio
+import signal
+import sys
+
+import aircraft_map
+import aircraft_table
+import feed_client
+import geodesy
+import load_shedding
+import map_snapshot
+import metrics
+import shared_map
+
+
+class IngestDaemon(object):
+    def __init__(self, args):
+        self._receivers = feed_client.receivers(args)
+        self._duplicate_window = args.duplicate_window
+        self._feed_options = feed_client.feed_options(args)
+        self._publish_interval = args.publish_interval
+        map_class = aircraft_map.AircraftMap
+        if args.table:
+            map_class = aircraft_table.TableAircraftMap
+        self._map = map_class(args.lat, args.lon,
+                              geodesy_strategy=args.geodesy)
+        self._feed = load_shedding.LoadShedder(
+            self._map, max_lag=args.max_lag, interval=args.shed_interval)
+        self._saver, warm = map_snapshot.warm_start(args, self._map)
+        self._writer = shared_map.SharedMapWriter(
+            self._map, args.lat, args.lon, name=args.name,
+            capacity=args.capacity, interval=args.publish_interval)
+        self._client = None
+
+    def _publish(self):
+        # The map only purges itself as updates arrive, so purge here
+        # too, or a quiet feed would leave departed aircraft published
+        self._map.purge()
+        self._writer.publish()
+
+    def stop(self):
+        self._client.stop()
+
+    async def _run(self):
+        # Stop from the event loop, so a signal can't arrive part way
+        # through a publish and leave the table marked as being written
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        self._client = feed_client.open_feed(
+            self._receivers, self._feed,
+            duplicate_window=self._duplicate_window,
+            after_batch=self._saver.maybe_save if self._saver else None,
+            **self._feed_options)
+        # Publish on a timer rather than after each batch, so departed
+        # aircraft are purged, and the publish time shows the daemon is
+        # alive, even when the feed is quiet
+        publisher = asyncio.ensure_future(feed_client.run_periodically(
+            self._publish_interval, self._publish))
+        try:
+            await self._client.run()
+        finally:
+            publisher.cancel()
+
+    def run(self):
+        print("Publishing aircraft map as %s" % self._writer.name)
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._writer.close()
+            if self._saver is not None:
+                self._saver.save()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host",
+                        help="IP address or hostname of host running dump1090",
+                        required=True)
+    parser.add_argument("-p", "--port", type=int,
+                        help="Port for dump1090 server",
+                        required=True)
+    parser.add_argument("--lat", type=float, help="Your latitude",
+                        required=True)
+    parser.add_argument("--lon", type=float, help="Your longitude",
+                        required=True)
+    geodesy.add_arguments(parser)
+    parser.add_argument("--name",
+                        help="Name of the shared memory block to publish",
+                        default=shared_map.DEFAULT_NAME)
+    parser.add_argument("--capacity", type=int,
+                        help="Most aircraft to publish (the closest)",
+                        default=shared_map.DEFAULT_CAPACITY)
+    parser.add_argument("--publish-interval", type=float,
+                        help="Seconds between publishing the map",
+                        default=shared_map.DEFAULT_PUBLISH_INTERVAL)
+    parser.add_argument("--table", action="store_true",
+                        help="Keep the map in NumPy columns, for "
+                        "thousands of aircraft (e.g. several receivers)")
+    feed_client.add_arguments(parser)
+    load_shedding.add_arguments(parser)
+    map_snapshot.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.start_exporters(args)
+
+    try:
+        daemon = IngestDaemon(args)
+    except FileExistsError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# load_shedding: keeps a slow machine (e.g. a Pi Zero near a busy
+# airport) current when it can't process the whole feed.
+#
+# Lag is measured by comparing the receiver's timestamp on the newest
+# message in each batch with the wall clock. The two clocks needn't
+# agree: the smallest difference seen is taken as the baseline, and
+# lag is how far the current difference is above it. Receivers'
+# clocks needn't agree with each other either, so when several are
+# merged (feed_client.MultiFeed) each has its own baseline, and the
+# lag is the largest of theirs. While lag is over a threshold, work
+# is shed until it falls to half that:
+#
+# - instead of updating the map with every batch, only the newest
+#   position and velocity of each aircraft are applied, once an
+#   interval, and the reports they supersede are dropped unparsed;
+# - update callbacks are only delivered for audible aircraft, if an
+#   audible() test is given.
+
+import time
+
+import aircraft_map
+import metrics
+import sbs_parser
+
+DEFAULT_MAX_LAG = 2.0  # seconds
+DEFAULT_SHED_INTERVAL = 1.0  # seconds between map updates when shedding
+SOURCE_TIMEOUT = 10.0  # seconds before a silent receiver's lag is ignored
+
+
+class LoadShedder(object):
+    """
+    Wraps an AircraftMap. Feed it with update_from_raw_many(), as
+    you would the map (so it can be passed to feed_client.open_feed()
+    in place of the map). max_lag of None or 0 turns shedding off, but
+    lag is still measured.
+    """
+    def __init__(self, aircraft_map, max_lag=DEFAULT_MAX_LAG,
+                 interval=DEFAULT_SHED_INTERVAL, audible=None,
+                 metrics_registry=metrics.REGISTRY):
+        self._map = aircraft_map
+        self._max_lag = max_lag
+        self._interval = interval
+        self._audible = audible
+        # source -> [smallest wall clock - receiver clock seen, its
+        # latest lag, when that was measured]
+        self._sources = {}
+        self._lag = 0.0
+        self._shedding = False
+        self._latest = {}  # (message type, ICAO) -> newest line
+        self._last_flush = 0.0
+        self._dropped_since_start = 0  # of the current shedding period
+        self._lag_gauge = metrics_registry.gauge(
+            "adsb_feed_lag_seconds",
+            "How far the feed is behind the receiver")
+        self._shedding_gauge = metrics_registry.gauge(
+            "adsb_shedding", "1 while shedding load, 0 otherwise")
+        self._dropped = metrics_registry.counter(
+            "adsb_shed_reports_total",
+            "Position and velocity reports dropped while shedding")
+
+    @property
+    def lag(self):
+        """Seconds the feed is behind, as of the last batch."""
+        return self._lag
+
+    @property
+    def shedding(self):
+        return self._shedding
+
+    def update_from_raw_many(self, data, now=None, source=None):
+        """
+        Measure lag on a batch of lines from source (as for
+        AircraftMap.update_from_raw_many()) and update the map with it,
+        shedding load if necessary. Returns the map's ChangeSet, or an
+        empty one if the batch was only queued.
+        """
+        if now == None:
+            now = time.time()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).split(b"\n")
+        self._measure_lag(data, now, source)
+        if self._max_lag:
+            if not self._shedding and self._lag > self._max_lag:
+                self._start_shedding(now)
+            elif self._shedding and self._lag < self._max_lag / 2:
+                self._stop_shedding(now)
+        if not self._shedding:
+            return self._map.update_from_raw_many(data, now=now)
+        malformed = self._queue(data)
+        if malformed:
+            # Let the map count them, as it does when not shedding
+            self._map.update_from_raw_many(malformed, now=now)
+        if now - self._last_flush < self._interval:
+            return aircraft_map.ChangeSet([], [], [])
+        return self._flush(now)
+
+    def _measure_lag(self, lines, now, source):
+        # The newest message is at the end of the batch; skip the
+        # empty string after a final newline
+        for line in reversed(lines):
+            if line:
+                break
+        else:
+            return
+        sent = sbs_parser.message_time(line)
+        if sent is None:
+            return
+        offset = now - sent
+        state = self._sources.get(source)
+        if state is None:
+            state = self._sources[source] = [offset, 0.0, now]
+        elif offset < state[0]:
+            state[0] = offset
+        state[1] = offset - state[0]
+        state[2] = now
+        self._lag = max(lag for baseline, lag, measured in
+                        self._sources.values()
+                        if now - measured < SOURCE_TIMEOUT)
+        self._lag_gauge.set(self._lag)
+
+    def _queue(self, lines):
+        # Returns the position and velocity lines too short to queue
+        if lines and isinstance(lines[0], str):
+            prefixes = (sbs_parser.POSITION_PREFIX, sbs_parser.VELOCITY_PREFIX)
+            comma = ","
+        else:
+            prefixes = (sbs_parser.POSITION_PREFIX_BYTES,
+                        sbs_parser.VELOCITY_PREFIX_BYTES)
+            comma = b","
+        latest = self._latest
+        dropped = 0
+        malformed = []
+        for line in lines:
+            if not line.startswith(prefixes):
+                continue
+            parts = line.split(comma, sbs_parser.ICAO_FIELD + 1)
+            if len(parts) <= sbs_parser.ICAO_FIELD:
+                malformed.append(line)
+                continue
+            # The message type ("3" or "4") and ICAO
+            key = (line[4:5], parts[sbs_parser.ICAO_FIELD])
+            if key in latest:
+                dropped += 1
+            latest[key] = line
+        self._dropped.inc(dropped)
+        self._dropped_since_start += dropped
+        return malformed
+
+    def _flush(self, now):
+        lines = list(self._latest.values())
+        self._latest.clear()
+        self._last_flush = now
+        return self._map.update_from_raw_many(lines, now=now)
+
+    def _start_shedding(self, now):
+        print("Feed is %.1f s behind, shedding load" % self._lag)
+        self._shedding = True
+        self._shedding_gauge.set(1)
+        self._dropped_since_start = 0
+        self._last_flush = now
+        if self._audible is not None:
+            self._map.set_update_filter(self._audible)
+
+    def _stop_shedding(self, now):
+        self._flush(now)
+        self._shedding = False
+        self._shedding_gauge.set(0)
+        if self._audible is not None:
+            self._map.set_update_filter(None)
+        print("Feed caught up (%.1f s behind), %d reports dropped" % (
+            self._lag, self._dropped_since_start))
+
+
+def add_arguments(parser):
+    """Add the --max-lag and --shed-interval options to parser."""
+    parser.add_argument("--max-lag", type=float,
+                        help="Shed load when the feed falls this many "
+                        "seconds behind (0 to never shed)",
+                        default=DEFAULT_MAX_LAG)
+    parser.add_argument("--shed-interval", type=float,
+                        help="Seconds between map updates while shedding",
+                        default=DEFAULT_SHED_INTERVAL)
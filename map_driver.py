@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import datetime
-import socket
 import sys
 import time
 
 import aircraft_map
+import feed_client
 
 DEFAULT_UPDATE_INTERVAL = 10.0  # seconds
 MIN_ALTITUDE = 3000
@@ -28,6 +29,7 @@ class MapDriver(object):
         self._mylat = args.lat
         self._mylon = args.lon
         self._update_interval = args.update_interval
+        self._start_time = time.time()
         self._map = aircraft_map.AircraftMap(args.lat, args.lon)
 
     def init(self):
@@ -38,28 +40,23 @@ class MapDriver(object):
               (datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
                self._map.count()))
 
+    def _print_line(self, line):
+        print("%f: read %s" % (time.time() - self._start_time, line))
+        #self._map.update_from_raw(line)
+
+    async def _play(self):
+        self._start_time = time.time()
+        client = feed_client.FeedClient(
+            self._host, self._port, line_callback=self._print_line,
+            prefixes=None)
+        await asyncio.gather(
+            client.run(),
+            feed_client.run_periodically(self._update_interval,
+                                         self.make_sound,
+                                         initial_delay=self._update_interval))
+
     def play(self):
-        cont = True
-        while True:
-            if not cont:
-                break
-            cont = False
-            print("Connect to %s:%d" % (self._host, self._port))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self._host, self._port))
-            fp = sock.makefile("rb", buffering=0)
-            start_time = time.time()
-            try:
-                while True:
-                    line = fp.readline()
-                    print("%f: read %s" % (time.time() - start_time, line))
-                    if len(line) == 0:
-                        print("No data, restart")
-                        cont = True
-                        break
-                    #self._map.update(line)
-            finally:
-                sock.close()
+        asyncio.run(self._play())
 
 
 def main():
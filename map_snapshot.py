@@ -0,0 +1,225 @@
+# map_snapshot: saves the aircraft in an AircraftMap to a compact
+# binary file, and loads them back, so a restarted front end can make
+# sound straight away instead of waiting for the sky to fill in. A map
+# can also be bootstrapped from dump1090's aircraft.json.
+#
+# The file is a header followed by one fixed size record per aircraft,
+# all little endian:
+#
+#   header: magic "ADSBSNAP", u16 version, f8 save time, u32 count
+#   record: u4 ID, i4 altitude (feet), f8 latitude, f8 longitude,
+#           f8 update time, u1 has velocity, f4 ground speed (knots),
+#           f4 track (degrees), i4 vertical rate (feet/minute)
+#
+# The ID is the integer one from sbs_parser.parse_icao(). Version 1
+# files, which had the hex ICAO address as 8s instead, can still be
+# loaded.
+#
+# Positions are the unrounded ones from the last position report, so
+# loading applies the map's rounding and filtering as usual.
+
+import json
+import os
+import struct
+import time
+
+import sbs_parser
+
+MAGIC = b"ADSBSNAP"
+VERSION = 2
+DEFAULT_SAVE_INTERVAL = 30.0  # seconds
+
+_HEADER = struct.Struct("<8sHdI")
+_RECORD = struct.Struct("<Iiddd?ffi")
+_RECORDS = {1: struct.Struct("<8siddd?ffi"), VERSION: _RECORD}
+
+
+def save(aircraft_map, path, now=None):
+    """
+    Write a snapshot of aircraft_map to path. The file is replaced
+    atomically, so a crash while saving leaves the old snapshot.
+    """
+    if now == None:
+        now = time.time()
+    # Oldest first, so loading restores them in the right order
+    aircraft = sorted(aircraft_map.aircraft(), key=lambda a: a.update_time)
+    records = []
+    for a in aircraft:
+        fix = a.fix
+        if fix is None:
+            latitude, longitude, altitude = a.latitude, a.longitude, a.altitude
+        else:
+            latitude, longitude, altitude = fix[:3]
+        velocity = a.velocity
+        if velocity is None:
+            ground_speed, track, vertical_rate = 0.0, 0.0, 0
+        else:
+            ground_speed, track, vertical_rate = velocity
+        records.append(_RECORD.pack(
+            a.id, int(altitude), latitude, longitude,
+            a.update_time, velocity is not None, ground_speed, track,
+            int(vertical_rate)))
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as fp:
+        fp.write(_HEADER.pack(MAGIC, VERSION, now, len(records)))
+        fp.write(b"".join(records))
+    os.replace(temp_path, path)
+
+
+def load(aircraft_map, path, now=None):
+    """
+    Restore the aircraft saved in the snapshot at path into
+    aircraft_map, skipping any not heard from in the map's purge_age
+    seconds. Returns the number of aircraft restored. Raises ValueError
+    if the file isn't a snapshot this code can read.
+    """
+    if now == None:
+        now = time.time()
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if len(data) < _HEADER.size:
+        raise ValueError("%s is too short to be a snapshot" % path)
+    magic, version, saved, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("%s is not an aircraft map snapshot" % path)
+    record = _RECORDS.get(version)
+    if record is None:
+        raise ValueError("%s is a version %d snapshot, expected %d" % (
+            path, version, VERSION))
+    if len(data) < _HEADER.size + count * record.size:
+        raise ValueError("%s is truncated" % path)
+    cutoff = now - aircraft_map.purge_age
+    restored = 0
+    for (id, altitude, latitude, longitude, update_time, has_velocity,
+         ground_speed, track, vertical_rate) in record.iter_unpack(
+             data[_HEADER.size:_HEADER.size + count * record.size]):
+        if update_time < cutoff:
+            continue
+        if version == 1:
+            try:
+                id = sbs_parser.parse_icao(
+                    id.rstrip(b"\0").decode("ascii", "replace"))
+            except ValueError:
+                continue
+        velocity = None
+        if has_velocity:
+            velocity = (ground_speed, track, vertical_rate)
+        if aircraft_map.restore(id, altitude, latitude, longitude,
+                                update_time, velocity) is not None:
+            restored += 1
+    return restored
+
+
+def load_aircraft_json(aircraft_map, path, now=None):
+    """
+    Restore the aircraft with positions in a dump1090 aircraft.json
+    file (e.g. /run/dump1090-fa/aircraft.json) into aircraft_map,
+    skipping any whose position is older than the map's purge_age.
+    Returns the number of aircraft restored.
+    """
+    if now == None:
+        now = time.time()
+    with open(path, "r") as fp:
+        data = json.load(fp)
+    # Ages in the file are relative to its "now", but it may be a
+    # little old itself
+    file_now = data.get("now", now)
+    cutoff = now - aircraft_map.purge_age
+    reports = []
+    for entry in data.get("aircraft", []):
+        # Newer dump1090s call it alt_baro, and it's "ground" on the ground
+        altitude = entry.get("alt_baro", entry.get("altitude"))
+        if ("lat" not in entry or "lon" not in entry or
+                not isinstance(altitude, (int, float))):
+            continue
+        update_time = file_now - entry.get("seen_pos", entry.get("seen", 0))
+        if update_time < cutoff:
+            continue
+        velocity = None
+        vertical_rate = entry.get("baro_rate", entry.get(
+            "vert_rate", entry.get("geom_rate", 0)))
+        if "gs" in entry and "track" in entry:
+            velocity = (entry["gs"], entry["track"], vertical_rate)
+        elif "speed" in entry and "track" in entry:
+            velocity = (entry["speed"], entry["track"], vertical_rate)
+        try:
+            id = sbs_parser.parse_icao(entry["hex"])
+        except (KeyError, ValueError):
+            continue
+        reports.append((update_time, id, int(altitude), entry["lat"],
+                        entry["lon"], velocity))
+    restored = 0
+    for update_time, id, altitude, latitude, longitude, velocity in sorted(
+            reports, key=lambda report: report[0]):
+        if aircraft_map.restore(id, altitude, latitude, longitude,
+                                update_time, velocity) is not None:
+            restored += 1
+    return restored
+
+
+class SnapshotSaver(object):
+    """
+    Saves a map to path every interval seconds. Call maybe_save()
+    from whatever thread updates the map (e.g. as a FeedClient's
+    after_batch hook), and save() on shutdown.
+    """
+    def __init__(self, aircraft_map, path, interval=DEFAULT_SAVE_INTERVAL):
+        self._map = aircraft_map
+        self._path = path
+        self._interval = interval
+        self._last_save = time.time()
+
+    def maybe_save(self, now=None):
+        if now == None:
+            now = time.time()
+        if now - self._last_save >= self._interval:
+            self.save(now)
+
+    def save(self, now=None):
+        if now == None:
+            now = time.time()
+        try:
+            save(self._map, self._path, now)
+        except (OSError, struct.error) as e:
+            print("Can't save snapshot to %s: %s" % (self._path, e))
+        self._last_save = now
+
+
+def add_arguments(parser):
+    """Add the --snapshot, --snapshot-interval and --aircraft-json options."""
+    parser.add_argument("--snapshot",
+                        help="Load aircraft from this file at startup, and "
+                        "save them to it periodically and on exit")
+    parser.add_argument("--snapshot-interval", type=float,
+                        help="Seconds between snapshot saves",
+                        default=DEFAULT_SAVE_INTERVAL)
+    parser.add_argument("--aircraft-json",
+                        help="Load aircraft at startup from this dump1090 "
+                        "aircraft.json file")
+
+
+def warm_start(args, aircraft_map):
+    """
+    Load aircraft_map from the files named by the options from
+    add_arguments(), the snapshot first since aircraft.json is likely
+    to be fresher. Returns a SnapshotSaver (or None if there is no
+    --snapshot) and the number of aircraft in the map.
+    """
+    if args.snapshot is not None and os.path.exists(args.snapshot):
+        try:
+            print("Loaded %d aircraft from %s" % (
+                load(aircraft_map, args.snapshot), args.snapshot))
+        except (OSError, ValueError) as e:
+            print("Can't load snapshot %s: %s" % (args.snapshot, e))
+    if args.aircraft_json is not None:
+        try:
+            print("Loaded %d aircraft from %s" % (
+                load_aircraft_json(aircraft_map, args.aircraft_json),
+                args.aircraft_json))
+        except (OSError, ValueError) as e:
+            print("Can't load %s: %s" % (args.aircraft_json, e))
+    saver = None
+    if args.snapshot is not None:
+        saver = SnapshotSaver(aircraft_map, args.snapshot,
+                              args.snapshot_interval)
+    return saver, aircraft_map.count()
@@ -0,0 +1,264 @@
+# metrics: a lightweight registry of counters, gauges and histograms
+# describing what the ingest pipeline is doing, cheap enough to leave
+# on all the time. The registry can be dumped periodically to a local
+# file, or served as Prometheus text on a local port.
+#
+# Updates are plain attribute arithmetic without locks, so values
+# bumped from several threads at once may occasionally miss a count.
+
+import bisect
+import http.server
+import json
+import threading
+import time
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, v)
+                             for k, v in sorted(labels.items()))
+
+
+class Counter(object):
+    """A value that only goes up, e.g. the number of lines read."""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(object):
+    """A value that goes up and down, e.g. the number of aircraft."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Histogram(object):
+    """
+    Counts observations (e.g. durations, in seconds) into buckets.
+    Use observe(), or time() as a context manager.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            labels = dict(self.labels)
+            labels["le"] = bound
+            samples.append((self.name + "_bucket", labels, cumulative))
+        samples.append((self.name + "_sum", self.labels, self.sum))
+        samples.append((self.name + "_count", self.labels, self.count))
+        return samples
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Registry(object):
+    """
+    Holds all metrics. Asking for a metric that already exists (same
+    name and labels) returns the existing one, so independent pieces
+    of code can share counters.
+    """
+    def __init__(self):
+        self._metrics = {}  # (name, labels) -> metric
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, help, labels, **kwargs)
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name, help, labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=None):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """Return a dict of sample name (with labels) -> value."""
+        result = {}
+        for metric in self.metrics():
+            for name, labels, value in metric.samples():
+                result[name + _label_text(labels)] = value
+        return result
+
+    def prometheus_text(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics(), key=lambda m: m.name):
+            if metric.name not in described:
+                lines.append("# HELP %s %s" % (metric.name, metric.help))
+                lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+                described.add(metric.name)
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, _label_text(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()  # The registry used unless told otherwise
+
+
+class FileDumper(object):
+    """
+    Appends a JSON snapshot of a registry to a file every interval
+    seconds, from a background thread. Each line also has the
+    per-second rate of every counter since the previous line.
+    """
+    def __init__(self, path, interval=10.0, registry=REGISTRY):
+        self._path = path
+        self._interval = interval
+        self._registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+        self._last_time = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="metrics-dumper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.dump()
+
+    def dump(self):
+        now = time.time()
+        snapshot = self._registry.snapshot()
+        counters = set()
+        for metric in self._registry.metrics():
+            if metric.kind == "counter":
+                counters.add(metric.name + _label_text(metric.labels))
+        rates = {}
+        if self._last is not None and now > self._last_time:
+            for name in counters:
+                rates[name] = ((snapshot[name] - self._last.get(name, 0)) /
+                               (now - self._last_time))
+        self._last = snapshot
+        self._last_time = now
+        with open(self._path, "a") as fp:
+            fp.write(json.dumps({"time": now, "metrics": snapshot,
+                                 "rates": rates}, sort_keys=True) + "\n")
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.dump()
+
+
+def serve_prometheus(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Serve the registry as Prometheus text on http://host:port/metrics
+    from a background thread. Returns the HTTPServer.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Don't print a line for every scrape
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+
+def add_arguments(parser):
+    """Add the --metrics-file and --metrics-port options to parser."""
+    parser.add_argument("--metrics-file",
+                        help="Periodically append metrics to this file")
+    parser.add_argument("--metrics-interval", type=float,
+                        help="Seconds between metrics file dumps",
+                        default=10.0)
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this local port")
+
+
+def start_exporters(args, registry=REGISTRY):
+    """
+    Start whichever exporters were asked for by the options from
+    add_arguments(). Returns the FileDumper, or None.
+    """
+    dumper = None
+    if args.metrics_file is not None:
+        dumper = FileDumper(args.metrics_file, args.metrics_interval,
+                            registry)
+        dumper.start()
+    if args.metrics_port is not None:
+        serve_prometheus(args.metrics_port, registry=registry)
+    return dumper
@@ -2,18 +2,28 @@
 
 """
 A Python program to read ADS-B transponder messages from aircraft
-and save them for later playback
+and save them for later playback. Recordings are written as they're
+made (see recording.py), so stopping or killing the recorder loses at
+most the last second or so.
 """
 
 import argparse
+import asyncio
 import datetime
-import pickle
 import signal
-import socket
 import sys
 import time
 
 import aircraft_map
+import feed_client
+import metrics
+import recording
+
+STOP_CHECK_INTERVAL = 0.5  # seconds
+
+LINES_READ = metrics.REGISTRY.counter(
+    "adsb_lines_read_total", "Lines read from the ADSB receiver")
+
 
 def sigint_handler(signum, frame):
     global adsb_recorder
@@ -25,11 +35,12 @@ class ADSBRecorder(object):
     def __init__(self, args):
         self._host = args.host
         self._port = args.port
+        self._feed_options = feed_client.feed_options(args)
         self._input_file = args.input_file
         self._mylat = args.lat
         self._mylon = args.lon
         self._output_filename = args.output_file
-        self._output_file = open(args.output_file, "wb")
+        self._writer = recording.RecordingWriter(args.output_file)
         self._duration = args.duration
         if self._duration is None:
             self._stop_time = sys.float_info.max
@@ -39,59 +50,55 @@ class ADSBRecorder(object):
                                              position_accuracy=1)
         self._stop_requested = False
 
-    def _get_fp(self):
-        if self._input_file is not None:
-            print("reading from file %s" % self._input_file)
-            fp = open(self._input_file, "r")
-            return fp, None
-        else:
-            print("Connect to %s:%d" % (self._host, self._port))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self._host, self._port))
-            fp = sock.makefile()
-            return fp, sock
+    def _record_line(self, line):
+        (updated, aircraft) = self._map.update_from_raw(line)
+        if aircraft is not None:
+            if updated:
+                print("%s, %d aircraft" %
+                      (aircraft.icao, self._map.count()))
+        if updated:
+#            self._recorded_data.append(
+#                [time.time(), aircraft.id, aircraft.altitude,
+#                 aircraft.latitude, aircraft.longitude])
+            self._writer.append(time.time(), line)
+
+    def _should_stop(self):
+        if time.time() > self._stop_time:
+            print("Now %s is after stop time %s" % (time.time(), self._stop_time))
+            return True
+        return self._stop_requested
+
+    def _record_file(self):
+        print("reading from file %s" % self._input_file)
+        with open(self._input_file, "r") as fp:
+            for line in fp:
+                if self._should_stop():
+                    break
+                LINES_READ.inc()
+                self._record_line(line)
+
+    async def _record_feed(self):
+        client = feed_client.FeedClient(
+            self._host, self._port, line_callback=self._record_line,
+            **self._feed_options)
+
+        async def _stop_when_done():
+            while not self._should_stop():
+                await asyncio.sleep(STOP_CHECK_INTERVAL)
+            client.stop()
+
+        await asyncio.gather(client.run(), _stop_when_done())
 
     def record(self):
-        recorded_data = []
         try:
-            cont = True
-            while True:
-                if not cont:
-                    break
-                fp, sock = self._get_fp()
-                cont = False
-                while not self._stop_requested:
-                    if time.time() > self._stop_time:
-                        print("Now %s is after stop time %s" % (time.time(), self._stop_time))
-                        break
-                    line = fp.readline()
-                    if (len(line) == 0) and (sock is not None):
-                        # This seems to happen sometimes, we need to reconnect
-                        # if connected over a socket
-                        print("No data, reconnect")
-                        cont = True
-                        break
-                    (updated, aircraft) = self._map.update_from_raw(line)
-                    if aircraft is not None:
-                        if updated:
-                            print("%s, %d aircraft" %
-                                  (aircraft.id, self._map.count()))
-                    if updated:
-#                        recorded_data.append(
-#                            [time.time(), aircraft.id, aircraft.altitude,
-#                             aircraft.latitude, aircraft.longitude])
-                        recorded_data.append([time.time(), line])
-        except ConnectionResetError:
-            pass  # ignore and continue
+            if self._input_file is not None:
+                self._record_file()
+            else:
+                asyncio.run(self._record_feed())
         finally:
-            if sock is not None:
-                sock.close()
-            if fp is not None:
-                fp.close()
-            pickle.dump(recorded_data, self._output_file)
-            self._output_file.close()
+            self._writer.close()
             print("%d records written to %s" % (
-                len(recorded_data), self._output_filename))
+                self._writer.count, self._output_filename))
 
     def stop(self):
         self._stop_requested = True
@@ -114,8 +121,11 @@ def main():
                         required=True)
     parser.add_argument("-d", "--duration", type=int,
                         help="Run time in seconds")
+    feed_client.add_arguments(parser, multiple_receivers=False)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    dumper = metrics.start_exporters(args)
 
     if not((args.host is not None and args.port is not None) or
             args.input_file is not None):
@@ -125,6 +135,8 @@ def main():
     global adsb_recorder
     adsb_recorder = ADSBRecorder(args)
     adsb_recorder.record()
+    if dumper is not None:
+        dumper.stop()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
 #!/bin/sh
 
-filename=`date +"%Y-%M-%d-%T.pkl"`
+filename=`date +"%Y-%M-%d-%T.rec"`
 
 ./recorder.py \
     --host 192.168.1.117 --port 30003 \
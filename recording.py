@@ -0,0 +1,319 @@
+# recording: an append-only, crash-safe file format for recorded feed
+# lines, written as it's recorded rather than all at the end.
+#
+# A recording is a file header followed by chunks, all little endian:
+#
+#   file header:  magic "ADSBREC\0", u16 version
+#   chunk header: magic "CHNK", u32 payload length, u32 record count,
+#                 u32 CRC-32 of the payload, f8 first timestamp,
+#                 f8 last timestamp
+#   payload:      for each record, f8 timestamp, u16 line length,
+#                 the line (ASCII, including its line ending)
+#
+# Chunks are written whole by a background thread, so a recording
+# that's killed (or crashes, or fills the disk) part way through can
+# be read up to its last complete chunk, and at most flush_interval
+# seconds of data is lost. The timestamps in chunk headers let a
+# reader find a time without decoding every record.
+#
+# read_recording() also reads the older pickled [[time, line], ...]
+# recordings, though those have to be loaded whole (convert() turns
+# them into chunked ones), and the "<time> <line>" text files written
+# by capture.py.
+
+import collections
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b"ADSBREC\0"
+VERSION = 1
+CHUNK_MAGIC = b"CHNK"
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+DEFAULT_CHUNK_RECORDS = 4096
+DEFAULT_MAX_PENDING_CHUNKS = 16  # chunks waiting to be written
+_PUT_TIMEOUT = 1.0  # seconds between checks that the writer is alive
+
+_FILE_HEADER = struct.Struct("<8sH")
+_CHUNK_HEADER = struct.Struct("<4sIIIdd")
+_RECORD_HEADER = struct.Struct("<dH")
+
+# Where a chunk is in a recording, and what time it covers
+ChunkInfo = collections.namedtuple(
+    "ChunkInfo", ["offset", "count", "first_time", "last_time"])
+
+
+class RecordingWriter(object):
+    """
+    Writes (timestamp, line) records to a new recording at path.
+    Records are collected into chunks of up to chunk_records, and a
+    chunk is handed to a writer thread when it's full or
+    flush_interval seconds old. At most max_pending chunks wait to be
+    written; beyond that, append() waits for the disk. Call close()
+    to write the last chunk. If sync is True, each chunk is also
+    fsync()ed, so it survives a power cut as well as a crash. If
+    writing fails, append() and close() raise the error.
+    """
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 chunk_records=DEFAULT_CHUNK_RECORDS,
+                 max_pending=DEFAULT_MAX_PENDING_CHUNKS, sync=False):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._chunk_records = chunk_records
+        self._sync = sync
+        self._fp = open(path, "wb")
+        self._fp.write(_FILE_HEADER.pack(MAGIC, VERSION))
+        self._fp.flush()
+        self._lock = threading.Lock()
+        self._records = []  # the chunk being collected
+        self._chunk_started = None
+        self._count = 0
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name="recording-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def count(self):
+        """The number of records appended so far."""
+        return self._count
+
+    def append(self, timestamp, line):
+        """Record line (a str) as received at timestamp."""
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            if not self._records:
+                self._chunk_started = time.monotonic()
+            self._records.append((timestamp, line))
+            self._count += 1
+            if len(self._records) < self._chunk_records:
+                return
+            records = self._take()
+        self._put(records)
+
+    def _take(self):
+        # Must hold the lock
+        records = self._records
+        self._records = []
+        return records
+
+    def _put(self, item):
+        # Hand item to the writer thread. If it has stopped after an
+        # error, nothing will empty a full queue, so don't wait forever
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            try:
+                records = self._queue.get(timeout=self._flush_interval)
+            except queue.Empty:
+                with self._lock:
+                    if (not self._records or time.monotonic() -
+                            self._chunk_started < self._flush_interval):
+                        continue
+                    records = self._take()
+            if records is None:
+                return
+            try:
+                self._write_chunk(records)
+            except (OSError, ValueError) as e:
+                print("Can't write to %s: %s" % (self._path, e))
+                self._error = e
+                return
+
+    def _write_chunk(self, records):
+        parts = []
+        for timestamp, line in records:
+            data = line.encode("ascii", "replace")[:0xffff]
+            parts.append(_RECORD_HEADER.pack(timestamp, len(data)))
+            parts.append(data)
+        payload = b"".join(parts)
+        self._fp.write(_CHUNK_HEADER.pack(
+            CHUNK_MAGIC, len(payload), len(records), zlib.crc32(payload),
+            records[0][0], records[-1][0]) + payload)
+        self._fp.flush()
+        if self._sync:
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        """Write any records not yet written, and close the file."""
+        with self._lock:
+            records = self._take()
+        try:
+            if records:
+                self._put(records)
+            self._put(None)
+            self._thread.join()
+        finally:
+            self._fp.close()
+        if self._error is not None:
+            raise self._error
+
+
+def _read_chunk_header(fp):
+    # Returns (payload length, payload CRC, ChunkInfo), or None at the
+    # end of the file or a damaged chunk header
+    offset = fp.tell()
+    header = fp.read(_CHUNK_HEADER.size)
+    if len(header) < _CHUNK_HEADER.size:
+        if header:
+            print("Recording ends with a partial chunk header")
+        return None
+    magic, length, count, crc, first, last = _CHUNK_HEADER.unpack(header)
+    if magic != CHUNK_MAGIC:
+        print("Damaged chunk at offset %d" % offset)
+        return None
+    return length, crc, ChunkInfo(offset, count, first, last)
+
+
+def _decode_chunk(payload, count):
+    records = []
+    offset = 0
+    for i in range(count):
+        timestamp, length = _RECORD_HEADER.unpack_from(payload, offset)
+        offset += _RECORD_HEADER.size
+        records.append((timestamp,
+                        payload[offset:offset + length].decode("ascii")))
+        offset += length
+    return records
+
+
+def is_recording(path):
+    """Return True if path is a chunked recording (not a pickle)."""
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def is_pickle(path):
+    """Return True if path is an old pickled recording."""
+    # Every pickle protocol recorder.py has used starts with PROTO
+    with open(path, "rb") as fp:
+        return fp.read(1) == b"\x80"
+
+
+def _read_capture(path):
+    # capture.py writes "<time> <line>" per line
+    with open(path, "r", errors="replace") as fp:
+        for text in fp:
+            timestamp, _, line = text.partition(" ")
+            if not line:
+                continue
+            try:
+                yield float(timestamp), line
+            except ValueError:
+                print("Skipping malformed line in %s: %r" % (path, text))
+
+
+def _open_recording(path):
+    fp = open(path, "rb")
+    header = fp.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size or not header.startswith(MAGIC):
+        fp.close()
+        raise ValueError("%s is not a recording" % path)
+    magic, version = _FILE_HEADER.unpack(header)
+    if version != VERSION:
+        fp.close()
+        raise ValueError("%s is a version %d recording, expected %d" % (
+            path, version, VERSION))
+    return fp
+
+
+def read_chunks(path):
+    """
+    Generate the ChunkInfo of each complete chunk in the recording at
+    path, reading only the chunk headers (so checksums aren't checked).
+    """
+    with _open_recording(path) as fp:
+        size = os.fstat(fp.fileno()).st_size
+        while True:
+            header = _read_chunk_header(fp)
+            if header is None:
+                return
+            length, crc, info = header
+            if fp.tell() + length > size:
+                return
+            fp.seek(length, 1)
+            yield info
+
+
+def read_recording(path, start_time=None):
+    """
+    Generate the (timestamp, line) records in the recording at path, a
+    chunk at a time, stopping at the first damaged or incomplete chunk
+    (the end of a recording that was killed). If start_time is given,
+    records before it are skipped; chunks that end before it are
+    skipped using their headers alone, without being read. Old pickled
+    recordings are read too, but all at once, as are capture.py's text
+    files.
+    """
+    if not is_recording(path):
+        if not is_pickle(path):
+            records = _read_capture(path)
+        else:
+            with open(path, "rb") as fp:
+                records = pickle.load(fp)
+        for timestamp, line in records:
+            if start_time is None or timestamp >= start_time:
+                yield timestamp, line
+        return
+    with _open_recording(path) as fp:
+        while True:
+            header = _read_chunk_header(fp)
+            if header is None:
+                return
+            length, crc, info = header
+            if start_time is not None and info.last_time < start_time:
+                fp.seek(length, 1)
+                continue
+            payload = fp.read(length)
+            if len(payload) < length:
+                print("Recording ends with a partial chunk")
+                return
+            if zlib.crc32(payload) != crc:
+                print("Chunk at offset %d fails its checksum" % info.offset)
+                return
+            for record in _decode_chunk(payload, info.count):
+                if start_time is None or record[0] >= start_time:
+                    yield record
+
+
+def convert(path, output_path):
+    """
+    Write the records of the recording at path (anything
+    read_recording() reads) to a chunked recording at output_path.
+    Returns the number of records written.
+    """
+    writer = RecordingWriter(output_path)
+    try:
+        for timestamp, line in read_recording(path):
+            writer.append(timestamp, line)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def first_timestamp(path):
+    """
+    Return the time of the first record in the recording at path, or
+    None if it has none.
+    """
+    if is_recording(path):
+        for info in read_chunks(path):
+            return info.first_time
+        return None
+    for timestamp, line in read_recording(path):
+        return timestamp
+    return None
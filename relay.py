@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# relay: holds one connection to dump1090's port 30003 and serves the
+# same stream to any number of local clients, so a small receiver
+# (e.g. a Pi Zero) only ever has one client however many of our tools
+# are running. Point them at the relay's --listen-host and
+# --listen-port instead of the receiver.
+#
+# Data is passed on a line at a time, never part of one, and writes to
+# clients never block: each client has a bounded buffer, and a client
+# that lets it fill (e.g. one stopped in a debugger) either misses
+# data until it catches up, or is disconnected, so it can't hold up
+# the others.
+
+import argparse
+import asyncio
+import signal
+
+import feed_client
+import metrics
+
+DEFAULT_LISTEN_HOST = "127.0.0.1"
+DEFAULT_LISTEN_PORT = 30003
+DEFAULT_CLIENT_BUFFER = 1024 * 1024  # bytes
+SLOW_CLIENT_POLICIES = ("skip", "drop")
+
+
+class _RelayClient(asyncio.Protocol):
+    def __init__(self, relay):
+        self._relay = relay
+        self.transport = None
+        self.name = None
+        self.skipping = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.name = "%s:%d" % transport.get_extra_info("peername")[:2]
+        self._relay._add_client(self)
+
+    def connection_lost(self, exc):
+        self._relay._remove_client(self)
+
+    def data_received(self, data):
+        pass  # clients have nothing to say
+
+    def eof_received(self):
+        return False  # close our side too
+
+
+class Relay(object):
+    """
+    Relays the feed from host:port to every client connected to
+    listen_host:listen_port. A client with more than client_buffer
+    bytes waiting to be sent is skipped (sent nothing until its
+    buffer has room, then resumes at the start of a later line) if
+    slow_clients is "skip", or disconnected if it's "drop". Other
+    keyword arguments are passed to the FeedClient.
+    """
+    def __init__(self, host, port, listen_host=DEFAULT_LISTEN_HOST,
+                 listen_port=DEFAULT_LISTEN_PORT,
+                 client_buffer=DEFAULT_CLIENT_BUFFER, slow_clients="skip",
+                 metrics_registry=metrics.REGISTRY, **kwargs):
+        if slow_clients not in SLOW_CLIENT_POLICIES:
+            raise ValueError("slow_clients must be one of %s" % (
+                ", ".join(SLOW_CLIENT_POLICIES)))
+        self._listen_host = listen_host
+        self._listen_port = listen_port
+        self._client_buffer = client_buffer
+        self._drop_slow_clients = slow_clients == "drop"
+        self._clients = set()
+        self._server = None
+        self._client = feed_client.FeedClient(
+            host, port, data_callback=self._relay,
+            metrics_registry=metrics_registry, **kwargs)
+        self._clients_gauge = metrics_registry.gauge(
+            "adsb_relay_clients", "Clients connected to the relay")
+        self._bytes_sent = metrics_registry.counter(
+            "adsb_relay_bytes_total", "Bytes relayed, summed over clients")
+        self._skipped = metrics_registry.counter(
+            "adsb_relay_skipped_bytes_total",
+            "Bytes not sent to clients that had fallen behind")
+        self._dropped = metrics_registry.counter(
+            "adsb_relay_dropped_clients_total",
+            "Clients disconnected for falling behind")
+
+    @property
+    def port(self):
+        """The port being listened on (useful if listen_port was 0)."""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        """Start listening for clients."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _RelayClient(self), self._listen_host, self._listen_port)
+
+    async def run(self):
+        """Listen, and relay the feed until stop() is called."""
+        if self._server is None:
+            await self.start()
+        try:
+            await self._client.run()
+        finally:
+            self._server.close()
+            for client in list(self._clients):
+                client.transport.close()
+
+    def stop(self):
+        self._client.stop()
+
+    def _add_client(self, client):
+        print("Client %s connected" % client.name)
+        self._clients.add(client)
+        self._clients_gauge.set(len(self._clients))
+
+    def _remove_client(self, client):
+        if client in self._clients:
+            print("Client %s disconnected" % client.name)
+            self._clients.discard(client)
+            self._clients_gauge.set(len(self._clients))
+
+    def _relay(self, data):
+        sent = 0
+        skipped = 0
+        for client in list(self._clients):
+            transport = client.transport
+            if transport.get_write_buffer_size() > self._client_buffer:
+                if self._drop_slow_clients:
+                    print("Client %s fell behind, disconnecting" %
+                          client.name)
+                    self._dropped.inc()
+                    self._remove_client(client)
+                    transport.abort()
+                    continue
+                if not client.skipping:
+                    print("Client %s fell behind, skipping" % client.name)
+                    client.skipping = True
+                skipped += len(data)
+                continue
+            if client.skipping:
+                print("Client %s caught up" % client.name)
+                client.skipping = False
+            transport.write(data)
+            sent += len(data)
+        self._bytes_sent.inc(sent)
+        self._skipped.inc(skipped)
+
+
+async def _run(relay):
+    # Stop from the event loop, so run() closes the server and the
+    # client connections on the way out
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, relay.stop)
+    await relay.run()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host",
+                        help="IP address or hostname of host running dump1090",
+                        required=True)
+    parser.add_argument("-p", "--port", type=int,
+                        help="Port for dump1090 server",
+                        required=True)
+    parser.add_argument("--listen-host",
+                        help="Address to serve the feed on (0.0.0.0 for all)",
+                        default=DEFAULT_LISTEN_HOST)
+    parser.add_argument("--listen-port", type=int,
+                        help="Port to serve the feed on",
+                        default=DEFAULT_LISTEN_PORT)
+    parser.add_argument("--client-buffer", type=int,
+                        help="Most bytes to buffer for a client that isn't "
+                        "keeping up",
+                        default=DEFAULT_CLIENT_BUFFER)
+    parser.add_argument("--slow-clients", choices=SLOW_CLIENT_POLICIES,
+                        help="What to do with a client whose buffer is full: "
+                        "skip data until it catches up, or disconnect it",
+                        default="skip")
+    feed_client.add_arguments(parser, multiple_receivers=False)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.start_exporters(args)
+
+    relay = Relay(args.host, args.port, listen_host=args.listen_host,
+                  listen_port=args.listen_port,
+                  client_buffer=args.client_buffer,
+                  slow_clients=args.slow_clients,
+                  **feed_client.feed_options(args))
+    try:
+        asyncio.run(_run(relay))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+#!/bin/sh
+
+# Serve the receiver's feed on localhost:30003; run the other scripts
+# with --host 127.0.0.1 --port 30003
+./relay.py --host 192.168.1.117 --port 30003 $*
@@ -0,0 +1,178 @@
+# sbs_parser: a fast parser for the SBS-1 (BaseStation) text format
+# served by dump1090 on port 30003.
+#
+# Only airborne position (MSG,3) and velocity (MSG,4) messages carry
+# data the aircraft map needs, and they are a minority of the feed, so
+# everything else is rejected with a single prefix check before
+# any splitting happens.
+#
+# Aircraft IDs are returned as ints: the 24 bit ICAO address, plus
+# NON_ICAO_FLAG for the "~" prefixed addresses dump1090 gives TIS-B
+# and other non-ICAO targets. They hash and compare faster than the
+# hex strings, and fit a uint32 column; format_icao() turns one back
+# into the usual hex for display.
+
+import collections
+import time
+
+POSITION_PREFIX = "MSG,3,"
+POSITION_PREFIX_BYTES = b"MSG,3,"
+VELOCITY_PREFIX = "MSG,4,"
+VELOCITY_PREFIX_BYTES = b"MSG,4,"
+
+# Field indexes in a comma separated SBS-1 line
+ICAO_FIELD = 4
+DATE_FIELD = 6
+TIME_FIELD = 7
+ALTITUDE_FIELD = 11
+GROUND_SPEED_FIELD = 12
+TRACK_FIELD = 13
+LATITUDE_FIELD = 14
+LONGITUDE_FIELD = 15
+VERTICAL_RATE_FIELD = 16
+
+NON_ICAO_FLAG = 1 << 24
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+# We never need anything past the last field we read, so don't split
+# the rest
+_POSITION_SPLIT = LONGITUDE_FIELD + 1
+_VELOCITY_SPLIT = VERTICAL_RATE_FIELD + 1
+
+PositionReport = collections.namedtuple(
+    "PositionReport",
+    ["aircraft_id", "altitude", "latitude", "longitude", "timestamp"])
+
+# ground_speed is in knots, track in degrees, vertical_rate in feet/minute
+VelocityReport = collections.namedtuple(
+    "VelocityReport",
+    ["aircraft_id", "ground_speed", "track", "vertical_rate", "timestamp"])
+
+
+class TimestampParser(object):
+    """
+    Converts the receiver's "YYYY/MM/DD" and "HH:MM:SS.fff" fields
+    to seconds since the epoch. The date rarely changes, so the
+    epoch time of midnight is cached and only the time of day is
+    parsed for each message. Like dump1090, this assumes local time.
+    """
+    def __init__(self):
+        self._date = None
+        self._midnight = 0.0
+
+    def parse(self, date, time_of_day):
+        if date != self._date:
+            year, month, day = date.split("/")
+            self._midnight = time.mktime(
+                (int(year), int(month), int(day), 0, 0, 0, 0, 0, -1))
+            self._date = date
+        hours, minutes, seconds = time_of_day.split(":")
+        return (self._midnight + int(hours) * 3600 + int(minutes) * 60 +
+                float(seconds))
+
+
+_timestamp_parser = TimestampParser()
+
+
+def parse_icao(text):
+    """
+    Return the integer aircraft ID for a hex ICAO address (str), as
+    found in SBS-1 lines or aircraft.json ("A1B2C3", "a1b2c3" or
+    "~A1B2C3"). Raises ValueError if it isn't one: exactly six hex
+    digits, so every ID fits in the 32-bit fields of snapshots and the
+    shared map.
+    """
+    flag = 0
+    digits = text
+    if text.startswith("~"):
+        flag = NON_ICAO_FLAG
+        digits = text[1:]
+    if len(digits) != 6 or not _HEX_DIGITS.issuperset(digits):
+        raise ValueError("Bad ICAO address: %r" % text)
+    return int(digits, 16) | flag
+
+
+def format_icao(aircraft_id):
+    """Return the hex ICAO address for an integer aircraft ID."""
+    if aircraft_id & NON_ICAO_FLAG:
+        return "~%06X" % (aircraft_id & 0xffffff)
+    return "%06X" % aircraft_id
+
+
+def message_time(line):
+    """
+    Return the time the receiver generated an SBS-1 message (str or
+    bytes), in seconds since the epoch, or None if the line doesn't
+    have a valid timestamp.
+    """
+    if not isinstance(line, str):
+        line = line.decode("ascii", "replace")
+    parts = line.split(",", TIME_FIELD + 1)
+    if len(parts) <= TIME_FIELD:
+        return None
+    try:
+        return _timestamp_parser.parse(parts[DATE_FIELD], parts[TIME_FIELD])
+    except ValueError:
+        return None
+
+
+def parse_position(line, parse_time=False):
+    """
+    Parse an airborne position message.
+
+    Returns None if the line (str or bytes) is not an MSG,3 line.
+    Raises ValueError if it is, but the altitude or position is
+    missing or malformed (some position messages omit the lat/lon).
+    If parse_time is True, the receiver's timestamp is returned in
+    the timestamp field, otherwise the timestamp field is None.
+    """
+    if isinstance(line, str):
+        if not line.startswith(POSITION_PREFIX):
+            return None
+    else:
+        if not line.startswith(POSITION_PREFIX_BYTES):
+            return None
+        line = line.decode("ascii", "replace")
+    parts = line.split(",", _POSITION_SPLIT)
+    if len(parts) <= LONGITUDE_FIELD:
+        raise ValueError("Truncated position message: %r" % line)
+    timestamp = None
+    if parse_time:
+        timestamp = _timestamp_parser.parse(parts[DATE_FIELD],
+                                            parts[TIME_FIELD])
+    return PositionReport(parse_icao(parts[ICAO_FIELD]),
+                          int(parts[ALTITUDE_FIELD]),
+                          float(parts[LATITUDE_FIELD]),
+                          float(parts[LONGITUDE_FIELD]),
+                          timestamp)
+
+
+def parse_velocity(line, parse_time=False):
+    """
+    Parse an airborne velocity message.
+
+    Returns None if the line (str or bytes) is not an MSG,4 line.
+    Raises ValueError if it is, but the ground speed or track is
+    missing or malformed. A missing vertical rate is taken as level
+    flight. parse_time is as for parse_position().
+    """
+    if isinstance(line, str):
+        if not line.startswith(VELOCITY_PREFIX):
+            return None
+    else:
+        if not line.startswith(VELOCITY_PREFIX_BYTES):
+            return None
+        line = line.decode("ascii", "replace")
+    parts = line.split(",", _VELOCITY_SPLIT)
+    if len(parts) <= VERTICAL_RATE_FIELD:
+        raise ValueError("Truncated velocity message: %r" % line)
+    timestamp = None
+    if parse_time:
+        timestamp = _timestamp_parser.parse(parts[DATE_FIELD],
+                                            parts[TIME_FIELD])
+    vertical_rate = parts[VERTICAL_RATE_FIELD].strip()
+    return VelocityReport(parse_icao(parts[ICAO_FIELD]),
+                          float(parts[GROUND_SPEED_FIELD]),
+                          float(parts[TRACK_FIELD]),
+                          int(vertical_rate) if vertical_rate else 0,
+                          timestamp)
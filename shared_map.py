@@ -0,0 +1,295 @@
+# shared_map: publishes the aircraft in an AircraftMap as a fixed layout
+# table in shared memory, so one ingest process (ingest_daemon.py) can
+# own the receiver connection and the map, and any number of front ends
+# on the same machine can read it without connecting or parsing.
+#
+# The block is a header followed by capacity fixed size records, all
+# little endian:
+#
+#   header: magic "ADSBSHM\0", u16 version, u32 capacity, u32 sequence,
+#           u32 count, f8 observer latitude, f8 observer longitude,
+#           f8 publish time
+#   record: u4 ID, i4 altitude (feet), f8 latitude, f8 longitude,
+#           f8 distance (meters), f8 bearing (degrees), f8 update time,
+#           u1 has velocity, f4 ground speed (knots), f4 track (degrees),
+#           i4 vertical rate (feet/minute)
+#
+# IDs are the integer ones from sbs_parser.parse_icao(). Records are
+# sorted closest first. The sequence number is a seqlock:
+# the writer makes it odd before changing the table and even again
+# afterwards, and a reader that sees it odd, or changed by the time it
+# has finished reading, reads again. Readers never write to the block,
+# and only retry for READ_TIMEOUT: a sequence that stays odd means the
+# writer died part way through publishing. The writer publishes
+# regularly even when nothing changes, so readers also treat a map
+# that hasn't been published for stale_after seconds as dead, and
+# return no aircraft rather than ones frozen in place.
+
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import aircraft_map
+import geodesy
+
+MAGIC = b"ADSBSHM\0"
+VERSION = 2
+DEFAULT_NAME = "adsb-theremin"
+DEFAULT_CAPACITY = 1024  # aircraft
+DEFAULT_PUBLISH_INTERVAL = 0.1  # seconds
+DEFAULT_STALE_AFTER = 5.0  # seconds without a publish before it's dead
+READ_TIMEOUT = 0.1  # seconds to retry reading a table being written
+
+_HEADER = struct.Struct("<8sHxxIIIddd")
+_SEQUENCE = struct.Struct("<I")
+_SEQUENCE_OFFSET = 16
+_COUNT = struct.Struct("<I")
+_COUNT_OFFSET = 20
+_PUBLISHED = struct.Struct("<d")
+_PUBLISHED_OFFSET = 40
+_RECORD = struct.Struct("<Ii5d?ffi")
+
+
+def _size(capacity):
+    return _HEADER.size + capacity * _RECORD.size
+
+
+class SharedMapWriter(object):
+    """
+    Creates the shared memory block called name and publishes
+    aircraft_map to it. Call maybe_publish() from whatever updates the
+    map (e.g. as a FeedClient's after_batch hook), and close() on
+    shutdown, which removes the block. A block of that name left by a
+    writer that died is replaced; if another writer is still
+    publishing it, FileExistsError is raised.
+    """
+    def __init__(self, aircraft_map, latitude, longitude, name=DEFAULT_NAME,
+                 capacity=DEFAULT_CAPACITY,
+                 interval=DEFAULT_PUBLISH_INTERVAL):
+        self._map = aircraft_map
+        self._capacity = capacity
+        self._interval = interval
+        self._last_publish = 0.0
+        try:
+            self._shm = shared_memory.SharedMemory(
+                name=name, create=True, size=_size(capacity))
+        except FileExistsError:
+            _remove_stale(name)
+            self._shm = shared_memory.SharedMemory(
+                name=name, create=True, size=_size(capacity))
+        self._buf = self._shm.buf
+        self._sequence = 0
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, capacity,
+                          self._sequence, 0, latitude, longitude, 0.0)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def maybe_publish(self, now=None):
+        if now == None:
+            now = time.time()
+        if now - self._last_publish >= self._interval:
+            self.publish(now)
+
+    def publish(self, now=None):
+        """Copy the map into the shared table."""
+        if now == None:
+            now = time.time()
+        aircraft = sorted(self._map.aircraft(),
+                          key=lambda a: a.distance)[:self._capacity]
+        buf = self._buf
+        self._sequence = (self._sequence + 1) & 0xffffffff
+        _SEQUENCE.pack_into(buf, _SEQUENCE_OFFSET, self._sequence)
+        offset = _HEADER.size
+        count = 0
+        try:
+            for a in aircraft:
+                velocity = a.velocity
+                if velocity is None:
+                    ground_speed, track, vertical_rate = 0.0, 0.0, 0
+                else:
+                    ground_speed, track, vertical_rate = velocity
+                _RECORD.pack_into(
+                    buf, offset, a.id, int(a.altitude),
+                    a.latitude, a.longitude, a.distance, a.bearing,
+                    a.update_time, velocity is not None, ground_speed,
+                    track, int(vertical_rate))
+                offset += _RECORD.size
+                count += 1
+        finally:
+            # Even if a record couldn't be packed, leave a consistent
+            # table (of the records before it) for readers
+            _COUNT.pack_into(buf, _COUNT_OFFSET, count)
+            _PUBLISHED.pack_into(buf, _PUBLISHED_OFFSET, now)
+            self._sequence = (self._sequence + 1) & 0xffffffff
+            _SEQUENCE.pack_into(buf, _SEQUENCE_OFFSET, self._sequence)
+        self._last_publish = now
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _remove_stale(name):
+    # Remove the block called name if it was left behind by a writer
+    # that was killed, but not if its writer is still publishing, or
+    # if it isn't a shared map at all
+    try:
+        existing = SharedMapReader(name)
+    except (ValueError, struct.error):
+        raise FileExistsError(
+            "%s exists but isn't a version %d shared map (remove it if "
+            "it's left over)" % (name, VERSION))
+    try:
+        if not existing.is_stale():
+            raise FileExistsError(
+                "Shared map %s is already being published" % name)
+    finally:
+        existing.close()
+    print("Replacing stale shared map %s" % name)
+    stale = shared_memory.SharedMemory(name=name)
+    stale.close()
+    stale.unlink()
+
+
+class SharedMapReader(object):
+    """
+    Attaches, read only, to the shared memory block called name, and
+    answers count() and closest() like an AircraftMap, so a front end
+    can use it in place of one. Aircraft are returned as
+    aircraft_map.Aircraft objects that belong to the caller. If the
+    writer hasn't published for stale_after seconds, or died part way
+    through publishing, the map reads as empty.
+    """
+    def __init__(self, name=DEFAULT_NAME,
+                 geodesy_strategy=geodesy.DEFAULT_STRATEGY,
+                 stale_after=DEFAULT_STALE_AFTER):
+        self._name = name
+        self._stale_after = stale_after
+        self._dead = False  # whether the writer was last seen dead
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 every attached process registers the
+            # block with its resource tracker, which unlinks it when
+            # that process exits. Only the writer should.
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._buf = self._shm.buf.toreadonly()
+        (magic, version, self._capacity, sequence, count, latitude,
+         longitude, published) = _HEADER.unpack_from(self._buf)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a shared aircraft map" % name)
+        if version != VERSION:
+            self.close()
+            raise ValueError("%s is a version %d shared map, expected %d" % (
+                name, version, VERSION))
+        self._observer = geodesy.observer(geodesy_strategy, latitude,
+                                          longitude)
+
+    def _read(self, limit, min_altitude, max_altitude):
+        # Returns the first limit records with altitudes in range, from
+        # a consistent version of the table, or None if there wasn't
+        # one within READ_TIMEOUT
+        buf = self._buf
+        deadline = time.monotonic() + READ_TIMEOUT
+        while True:
+            if time.monotonic() > deadline:
+                return None
+            sequence = _SEQUENCE.unpack_from(buf, _SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                time.sleep(0)  # the writer is part way through
+                continue
+            count = _COUNT.unpack_from(buf, _COUNT_OFFSET)[0]
+            records = []
+            offset = _HEADER.size
+            for i in range(min(count, self._capacity)):
+                if len(records) >= limit:
+                    break
+                record = _RECORD.unpack_from(buf, offset)
+                offset += _RECORD.size
+                if min_altitude <= record[1] <= max_altitude:
+                    records.append(record)
+            if _SEQUENCE.unpack_from(buf, _SEQUENCE_OFFSET)[0] == sequence:
+                return records
+
+    def _records(self, limit, min_altitude, max_altitude):
+        # As _read(), but empty if the writer is dead, which is
+        # reported when it's first noticed
+        records = None
+        if not self.is_stale():
+            records = self._read(limit, min_altitude, max_altitude)
+        if records is None:
+            if not self._dead:
+                print("Shared map %s isn't being published; is "
+                      "ingest_daemon.py running?" % self._name)
+                self._dead = True
+            return []
+        if self._dead:
+            print("Shared map %s is being published again" % self._name)
+            self._dead = False
+        return records
+
+    def _aircraft(self, record):
+        (id, altitude, latitude, longitude, distance, bearing, update_time,
+         has_velocity, ground_speed, track, vertical_rate) = record
+        aircraft = aircraft_map.Aircraft(id, update_time)
+        aircraft.update(altitude, latitude, longitude, now=update_time)
+        # Set after the update, which would recompute the distance
+        aircraft._observer = self._observer
+        aircraft._distance = distance
+        aircraft._bearing = bearing
+        if has_velocity:
+            aircraft._velocity = (ground_speed, track, vertical_rate)
+        return aircraft
+
+    def count(self):
+        """Return the count of aircraft in the map."""
+        if self.is_stale():
+            return 0
+        return _COUNT.unpack_from(self._buf, _COUNT_OFFSET)[0]
+
+    @property
+    def published(self):
+        """When the writer last published the map, or 0 if never."""
+        return _PUBLISHED.unpack_from(self._buf, _PUBLISHED_OFFSET)[0]
+
+    def is_stale(self, now=None):
+        """
+        Return True if the writer hasn't published the map for
+        stale_after seconds (or ever), so is probably dead.
+        """
+        if now == None:
+            now = time.time()
+        return now - self.published > self._stale_after
+
+    def closest(self, count, min_altitude=0, max_altitude=100000):
+        """
+        Return the closest [count] aircraft, as
+        AircraftMap.closest() does.
+        """
+        if count <= 0:
+            return []
+        return [self._aircraft(r)
+                for r in self._records(count, min_altitude, max_altitude)]
+
+    def aircraft(self):
+        """Return a list of all the aircraft in the map, closest first."""
+        return [self._aircraft(r) for r in self._records(
+            self._capacity, -float("inf"), float("inf"))]
+
+    def close(self):
+        self._buf.release()
+        self._shm.close()
+
+
+def add_arguments(parser):
+    """Add the --shared-map option to parser."""
+    parser.add_argument("--shared-map", metavar="NAME",
+                        help="Read aircraft from the shared memory map "
+                        "published by ingest_daemon.py, instead of "
+                        "connecting to the receiver (the daemon's default "
+                        "name is %s)" % DEFAULT_NAME)
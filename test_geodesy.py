@@ -0,0 +1,109 @@
+"""
+Checks that every geodesy strategy, scalar and vectorized, stays
+within its geodesy.ERROR_BOUNDS of the reference distance
+(util.distance_to()) over random observers and aircraft positions.
+Run with "python -m pytest" or "python -m unittest".
+"""
+
+import math
+import random
+import unittest
+
+import geodesy
+import util
+
+OBSERVERS = 100
+POSITIONS = 200
+
+
+def random_positions(rng, observer_lat, observer_lon, count, max_range):
+    """
+    Return lists of [count] latitudes and longitudes scattered
+    uniformly in bearing and distance, out to max_range meters, around
+    the observer.
+    """
+    lats = []
+    lons = []
+    for i in range(count):
+        distance = rng.uniform(1.0, max_range)
+        heading = rng.uniform(0, 2 * math.pi)
+        lats.append(observer_lat + math.degrees(
+            distance * math.cos(heading) / util.EARTH_RADIUS))
+        lons.append(observer_lon + math.degrees(
+            distance * math.sin(heading) / util.EARTH_RADIUS /
+            math.cos(math.radians(observer_lat))))
+    return lats, lons
+
+
+def random_cases(seed=1):
+    """
+    Generate (observer_lat, observer_lon, lats, lons, reference
+    distances) within the range the error bounds are claimed for.
+    """
+    rng = random.Random(seed)
+    for i in range(OBSERVERS):
+        observer_lat = rng.uniform(-geodesy.MAX_CHECKED_LATITUDE,
+                                   geodesy.MAX_CHECKED_LATITUDE)
+        # Include observers near the antimeridian
+        observer_lon = rng.uniform(-180.0, 180.0)
+        lats, lons = random_positions(rng, observer_lat, observer_lon,
+                                      POSITIONS, geodesy.MAX_CHECKED_RANGE)
+        reference = [util.distance_to(lat, lon, 0, observer_lat,
+                                      observer_lon)
+                     for lat, lon in zip(lats, lons)]
+        yield observer_lat, observer_lon, lats, lons, reference
+
+
+class GeodesyErrorTest(unittest.TestCase):
+    def assertWithinBound(self, name, distances, reference):
+        bound = geodesy.ERROR_BOUNDS[name]
+        for distance, expected in zip(distances, reference):
+            error = abs(distance - expected) / expected
+            self.assertLessEqual(error, bound, "%s: %f vs %f" % (
+                name, distance, expected))
+
+    def test_distance(self):
+        for observer_lat, observer_lon, lats, lons, reference in (
+                random_cases()):
+            for name in geodesy.STRATEGIES:
+                if name == "numpy" and geodesy.numpy is None:
+                    continue
+                strategy = geodesy.observer(name, observer_lat, observer_lon)
+                self.assertWithinBound(
+                    name, [strategy.distance(lat, lon)
+                           for lat, lon in zip(lats, lons)], reference)
+
+    @unittest.skipIf(geodesy.numpy is None, "needs numpy")
+    def test_distances(self):
+        numpy = geodesy.numpy
+        vectorized = [name for name, strategy in geodesy.STRATEGIES.items()
+                      if hasattr(strategy, "distances")]
+        self.assertEqual(sorted(vectorized), ["equirectangular", "numpy"])
+        for observer_lat, observer_lon, lats, lons, reference in (
+                random_cases()):
+            lat_array = numpy.array(lats)
+            lon_array = numpy.array(lons)
+            for name in vectorized:
+                strategy = geodesy.observer(name, observer_lat, observer_lon)
+                self.assertWithinBound(
+                    name, strategy.distances(lat_array, lon_array).tolist(),
+                    reference)
+
+    @unittest.skipIf(geodesy.numpy is None, "needs numpy")
+    def test_bearings_match_scalar(self):
+        numpy = geodesy.numpy
+        for observer_lat, observer_lon, lats, lons, reference in (
+                random_cases()):
+            for name in ("equirectangular", "numpy"):
+                strategy = geodesy.observer(name, observer_lat, observer_lon)
+                bearings = strategy.bearings(numpy.array(lats),
+                                             numpy.array(lons)).tolist()
+                for bearing, lat, lon in zip(bearings, lats, lons):
+                    expected = strategy.bearing(lat, lon)
+                    difference = abs(bearing - expected) % 360.0
+                    self.assertLess(min(difference, 360.0 - difference),
+                                    1e-9, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,13 +6,14 @@ and turn then into music.
 """
 
 import argparse
+import asyncio
 import datetime
 import pygame.midi
-import socket
 import sys
-import time
 
 import aircraft_map
+import feed_client
+import geodesy
 import palettes
 
 DEFAULT_UPDATE_INTERVAL = 10.0  # seconds
@@ -50,6 +51,9 @@ class ADSBTheremin(object):
     def __init__(self, args):
         self._host = args.host
         self._port = args.port
+        self._receivers = feed_client.receivers(args)
+        self._duplicate_window = args.duplicate_window
+        self._feed_options = feed_client.feed_options(args)
         self._mylat = args.lat
         self._mylon = args.lon
         self._midi_channels = range(args.midi_channels)  # 0-based
@@ -63,7 +67,8 @@ class ADSBTheremin(object):
         self._palette_offset = 0
         self._min_altitude = args.min_altitude
         self._max_altitude = args.max_altitude
-        self._map = aircraft_map.AircraftMap(args.lat, args.lon)
+        self._map = aircraft_map.AircraftMap(
+            args.lat, args.lon, geodesy_strategy=args.geodesy)
         self._map.add_callback("my-id", self._callback)
 
     @staticmethod
@@ -119,43 +124,18 @@ class ADSBTheremin(object):
         self._player.note_on(note, volume, midi_channel)
         print("Id %s alt %s MIDI note %d MIDI vol %d MIDI chan %d "
               "dist %d m" %
-              (a.id, a.altitude, note, volume, midi_channel + 1,
+              (a.icao, a.altitude, note, volume, midi_channel + 1,
                a.distance_to(self._mylat, self._mylon)))
         midi_channel = (midi_channel + 1) % self._num_midi_channels
 
     def play(self):
+        client = feed_client.open_feed(
+            self._receivers, self._map,
+            duplicate_window=self._duplicate_window,
+            on_disconnect=self.all_notes_off, **self._feed_options)
         try:
-            cont = True
-            while True:
-                if not cont:
-                    break
-                print("Connect to %s:%d" % (self._host, self._port))
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((self._host, self._port))
-                fp = sock.makefile()
-                # Prime the aircraft list - just get updates for a little while
-                print("Priming aircraft map...")
-                prime_start = time.time()
-                while True:
-                    if time.time() - prime_start > 3.0:
-                        break
-                    line = fp.readline()
-                    self._map.update_from_raw(line)
-                print("Done.")
-                last_midi_update = 0.0
-                cont = False
-                while True:
-                    line = fp.readline()
-                    if len(line) == 0:
-                        # This seems to happen sometimes, we need to reconnect
-                        print("No data, reconnect")
-                        cont = True
-                        sock.close()
-                        self.all_notes_off()
-                        break
-                    self._map.update_from_raw(line)
+            asyncio.run(client.run())
         finally:
-            sock.close()
             self.all_notes_off()
             pygame.midi.quit()
 
@@ -187,6 +167,8 @@ def main():
     parser.add_argument("--max-altitude", type=int,
                          help="Ignore aircraft higher than this altitude (feet)",
                          default=100000)
+    geodesy.add_arguments(parser)
+    feed_client.add_arguments(parser)
 
     args = parser.parse_args()
 
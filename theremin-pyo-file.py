@@ -7,14 +7,17 @@ data and turn it into music.
 
 import argparse
 import datetime
-import pickle
+import itertools
 import sys
 import time
 
 import pyo
 
 import aircraft_map
+import columnar_recording
+import geodesy
 import palettes
+import recording
 
 DEFAULT_UPDATE_INTERVAL = 10.0  # seconds
 MAX_DISTANCE = 70000
@@ -36,10 +39,15 @@ class FilePlayerTheremin(object):
         self._max_altitude = args.max_altitude
         self._input_file = args.input_file
         self._playback_factor = args.playback_factor
+        self._start_offset = args.start_offset
+        self._duration = args.duration
+        self._columnar = False  # True for a columnar recording
+        self._geodesy_strategy = args.geodesy
         self._synthetic_now = 0.0
         self._map = None
         self._num_midi_channels = 8
-        self._recorded_data = []
+        self._records = None  # iterator over the recording
+        self._next_record = None  # the next one to play, or None at the end
         self._real_start_time = 0.0
         self._synthetic_start_time = 0.0
         self._synthetic_now = 0.0
@@ -47,18 +55,42 @@ class FilePlayerTheremin(object):
         self._server = pyo.Server().boot().start()
         self._oscs = []
         self._shutdown_requested = False
-        self._playback_index = 0
+        self._played = 0
+
+    def _open_records(self):
+        # The recording is read as it's played, not loaded up front
+        if columnar_recording.is_columnar(self._input_file):
+            self._columnar = True
+            columns = columnar_recording.ColumnarRecording(self._input_file)
+            start = columns.start_time + self._start_offset
+            end = start + self._duration if self._duration else None
+            return columns.records(start, end)
+        records = recording.read_recording(self._input_file)
+        first = next(records, None)
+        if first is None:
+            return iter([])
+        records = itertools.chain([first], records)
+        start = first[0] + self._start_offset
+        records = itertools.dropwhile(lambda r: r[0] < start, records)
+        if self._duration:
+            end = start + self._duration
+            records = itertools.takewhile(lambda r: r[0] < end, records)
+        return records
 
     def init(self):
-        with open(self._input_file, "rb") as fp:
-            self._recorded_data = pickle.load(fp)
-        self._synthetic_start_time = self._recorded_data[0][0]
+        self._records = self._open_records()
+        self._next_record = next(self._records, None)
+        if self._next_record is None:
+            sys.stderr.write("Nothing to play in %s\n" % self._input_file)
+            sys.exit(1)
+        self._synthetic_start_time = self._next_record[0]
         self._synthetic_now = self._synthetic_start_time
-        self._map = aircraft_map.AircraftMap(self._mylat, self._mylon,
-                                             start_time=self._synthetic_now)
+        self._map = aircraft_map.AircraftMap(
+            self._mylat, self._mylon, start_time=self._synthetic_now,
+            geodesy_strategy=self._geodesy_strategy)
         self._real_start_time = time.time()
-        print("Read %d entries starting at %f" % (
-              len(self._recorded_data), self._real_start_time))
+        print("Playing %s from %f" % (
+              self._input_file, self._real_start_time))
         for i in range(self._polyphony):
             #self._oscs.append(pyo.RCOsc(freq=[100, 100], mul=0).out())
             self._oscs.append(pyo.Sine(freq=[100, 100], mul=0).out())
@@ -76,37 +108,37 @@ class FilePlayerTheremin(object):
                                     max_altitude=self._max_altitude)
 
         def _advance_time():
-            if self._playback_index > len(self._recorded_data) - 1:
+            if self._next_record is None:
                 self._server.closeGui()
                 return
             # Compute new synthetic time
             real_time_offset = time.time() - self._real_start_time
             synthetic_time_offset = real_time_offset * self._playback_factor
-            print("index: %d real_time_offset %d synthetic_time_offset %d" % (self._playback_index, real_time_offset, synthetic_time_offset))
+            print("played: %d real_time_offset %d synthetic_time_offset %d" % (self._played, real_time_offset, synthetic_time_offset))
             self._synthetic_now = (self._synthetic_start_time +
                                    real_time_offset *
                                    self._playback_factor)
             # Send updates to aircraft map up until current synthetic time
-            while True:
-                self._map.update(
-                    self._recorded_data[self._playback_index],
-                    now=self._synthetic_now)
-                self._playback_index += 1
-                if self._playback_index > len(self._recorded_data) - 1:
-                    break
-                next_time = self._recorded_data[self._playback_index][0]
-                if next_time > self._synthetic_now:
-                    break
+            while (self._next_record is not None and
+                   self._next_record[0] <= self._synthetic_now):
+                if self._columnar:
+                    self._map.update(self._next_record,
+                                     now=self._synthetic_now)
+                else:
+                    self._map.update_from_raw(self._next_record[1],
+                                              now=self._synthetic_now)
+                self._played += 1
+                self._next_record = next(self._records, None)
 
         def _make_sound():
             to_remove = []
             for aircraft_id, aircraft in list(self._current_aircraft.items()):
                 if self._map.get(aircraft_id) is None:
-                    print("lost %s" % aircraft_id)
+                    print("lost %s" % aircraft.icao)
                     to_remove.append(aircraft_id)
                 if (aircraft.altitude <= self._min_altitude or
                         aircraft.altitude >= self._max_altitude):
-                    print("aircraft %s busted altitude limits" % aircraft_id)
+                    print("aircraft %s busted altitude limits" % aircraft.icao)
                     to_remove.append(aircraft_id)
             for aircraft_id in to_remove:
                 del(self._current_aircraft[aircraft_id])
@@ -118,7 +150,7 @@ class FilePlayerTheremin(object):
                 for aircraft in closest:
                     if aircraft.id not in self._current_aircraft:
                         self._current_aircraft[aircraft.id] = aircraft
-                        print("Added %s" % aircraft.id)
+                        print("Added %s" % aircraft.icao)
                         break
             osc_index = 0
             fa = self._map.farthest()
@@ -132,7 +164,7 @@ class FilePlayerTheremin(object):
                 freq = self.map_frequency(aircraft)
                 self._oscs[osc_index].mul = vol
                 self._oscs[osc_index].freq = freq
-                print("%d: %s %f Hz vol %f for alt %s dist %d" % (osc_index, aircraft.id, freq, vol, aircraft.altitude, dist))
+                print("%d: %s %f Hz vol %f for alt %s dist %d" % (osc_index, aircraft.icao, freq, vol, aircraft.altitude, dist))
                 self._oscs[osc_index].mul = 0.01
                 osc_index += 1
 
@@ -161,6 +193,14 @@ def main():
     parser.add_argument("--playback-factor", type=float,
                         help="Playback factor - how many times to speed up time",
                         default=10)
+    parser.add_argument("--start-offset", type=float,
+                        help="Start this many seconds into the recording",
+                        default=0)
+    parser.add_argument("--duration", type=float,
+                        help="Play this many seconds of the recording "
+                        "(default: to the end)",
+                        default=None)
+    geodesy.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -6,19 +6,34 @@ and turn then into music.
 """
 
 import argparse
+import collections
+import copy
 import datetime
-import socket
 import sys
 import time
 
 import pyo
 
 import aircraft_map
+import feed_client
+import geodesy
+import load_shedding
+import map_snapshot
+import metrics
 import palettes
+import shared_map
 
 DEFAULT_UPDATE_INTERVAL = 10.0  # seconds
 MAX_DISTANCE = 70000
 MIDI_VOLUME_MAX = 100
+PRIME_TIME = 3.0  # seconds to collect aircraft before the first sound
+
+MAKE_SOUND_TIME = metrics.REGISTRY.histogram(
+    "adsb_make_sound_duration_seconds", "Time spent rendering sound")
+
+# What make_sound() needs from the aircraft map: the number of aircraft
+# and copies of the closest ones in the altitude range
+MapSnapshot = collections.namedtuple("MapSnapshot", ["count", "closest"])
 
 
 def map_int(x_coord, in_min, in_max, out_min, out_max):
@@ -51,6 +66,9 @@ class ADSBTheremin(object):
     def __init__(self, args):
         self._host = args.host
         self._port = args.port
+        self._receivers = feed_client.receivers(args)
+        self._duplicate_window = args.duplicate_window
+        self._feed_options = feed_client.feed_options(args)
         self._mylat = args.lat
         self._mylon = args.lon
         self._polyphony = args.polyphony
@@ -62,7 +80,21 @@ class ADSBTheremin(object):
         self._palette_offset = 0
         self._min_altitude = args.min_altitude
         self._max_altitude = args.max_altitude
-        self._map = aircraft_map.AircraftMap(args.lat, args.lon)
+        self._snapshot = MapSnapshot(0, [])
+        if args.shared_map is not None:
+            # ingest_daemon.py owns the feed and the map
+            self._map = shared_map.SharedMapReader(
+                args.shared_map, geodesy_strategy=args.geodesy)
+            self._feed = None
+            self._saver, warm = None, True
+        else:
+            self._map = aircraft_map.AircraftMap(
+                args.lat, args.lon, geodesy_strategy=args.geodesy)
+            self._feed = load_shedding.LoadShedder(
+                self._map, max_lag=args.max_lag, interval=args.shed_interval)
+            self._saver, warm = map_snapshot.warm_start(args, self._map)
+        if warm:
+            self._publish_snapshot()
         self._num_midi_channels = 8
         self._server = pyo.Server().boot().start()
         self._oscs = []
@@ -76,17 +108,17 @@ class ADSBTheremin(object):
               (self._palette_index, self._palette_offset))
         palette = [note + self._palette_offset for note in self._palette]
 
+        snapshot = self._snapshot
         print("%s: %d aircraft" %
               (datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
-               self._map.count()))
+               snapshot.count))
 
-        aircraft = self._map.closest(
-            self._polyphony, min_altitude=self._min_altitude,
-            max_altitude=self._max_altitude)
+        aircraft = snapshot.closest
         midi_channel = 0
         osc_index = 0
         for a in aircraft:
-            if (a.distance_to(self._mylat, self._mylon) > MAX_DISTANCE or
+            dist = a.distance_to(self._mylat, self._mylon)
+            if (dist > MAX_DISTANCE or
                 a.altitude > self._max_altitude):
                 print("ignoring %s" % a)
                 continue
@@ -96,15 +128,13 @@ class ADSBTheremin(object):
             note_index = int(float(a.altitude - 1) / self._max_altitude * len(palette))
 
             note = palette[note_index]
-            volume = int((MAX_DISTANCE -
-                          a.distance_to(self._mylat, self._mylon)) /
+            volume = int((MAX_DISTANCE - dist) /
                           MAX_DISTANCE * MIDI_VOLUME_MAX)
             deg = a.bearing_from(self._mylat, self._mylon)
             pan_value = map_bearing_to_pan(deg)
             print("Id %s alt %s MIDI note %d MIDI vol %d MIDI chan %d "
                   "dist %d m" %
-                  (a.id, a.altitude, note, volume, midi_channel + 1,
-                   a.distance_to(self._mylat, self._mylon)))
+                  (a.icao, a.altitude, note, volume, midi_channel + 1, dist))
             freq = pyo.midiToHz(note)
             print(freq)
             self._oscs[osc_index].freq = freq
@@ -116,49 +146,65 @@ class ADSBTheremin(object):
         self._palette_offset = (self._palette_offset + self._shift) % 12
         print("")
 
+    def _publish_snapshot(self):
+        # Runs on the feed thread after every batch. make_sound() runs on
+        # pyo's thread and only ever reads self._snapshot, which is
+        # replaced in one assignment, so it never waits on the feed or
+        # sees the map half updated.
+        closest = self._map.closest(
+            self._polyphony, min_altitude=self._min_altitude,
+            max_altitude=self._max_altitude)
+        self._snapshot = MapSnapshot(self._map.count(),
+                                     [copy.copy(a) for a in closest])
+
+    def _after_batch(self):
+        self._publish_snapshot()
+        if self._saver is not None:
+            self._saver.maybe_save()
+
     def play(self):
-        def _collect():
-            # TODO - loop and read all available lines. This
-            # might get behind if not called often enough.
-            line = fp.readline()
-            self._map.update_from_raw(line)
-
-        try:
-            cont = True
-            while True:
-                if not cont:
-                    break
-                print("Connect to %s:%d" % (self._host, self._port))
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((self._host, self._port))
-                fp = sock.makefile()
-                # Prime the aircraft list - just get updates for a little while
-                print("Priming aircraft map...")
-                prime_start = time.time()
-                while True:
-                    if time.time() - prime_start > 3.0:  # XXX FIX
-                        break
-                    line = fp.readline()
-                    self._map.update_from_raw(line)
-                print("Done.")
-                break
-            print("Starting pattern")
-            collect_pat = pyo.Pattern(function=_collect, time=0.1).play()
-            make_sound_pat = pyo.Pattern(function=self.make_sound, time=self._update_interval).play()
-            #self._server.start()
+        def _make_sound():
+            with MAKE_SOUND_TIME.time():
+                self.make_sound()
+
+        if self._feed is None:
+            # Reading the shared map never waits on the daemon, so it
+            # can be done right here on pyo's thread
+            def _make_sound_from_shared_map():
+                self._publish_snapshot()
+                _make_sound()
+
+            make_sound_pat = pyo.Pattern(function=_make_sound_from_shared_map,
+                                         time=self._update_interval).play()
             self._server.gui()
-        finally:
-            sock.close()
+            return
+        # The feed is read on its own thread, as fast as it arrives,
+        # since the main thread belongs to the pyo GUI.
+        client = feed_client.open_feed(
+            self._receivers, self._feed,
+            duplicate_window=self._duplicate_window,
+            after_batch=self._after_batch, **self._feed_options)
+        feed_client.start_thread(client)
+        # Prime the aircraft list - just get updates for a little while,
+        # unless a snapshot already filled it
+        if not self._snapshot.count:
+            print("Priming aircraft map...")
+            time.sleep(PRIME_TIME)
+            print("Done.")
+        print("Starting pattern")
+        make_sound_pat = pyo.Pattern(function=_make_sound, time=self._update_interval).play()
+        #self._server.start()
+        self._server.gui()
+        if self._saver is not None:
+            self._saver.save()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host",
-                        help="IP address or hostname of host running dump1090",
-                        required=True)
+                        help="IP address or hostname of host running dump1090")
     parser.add_argument("-p", "--port", type=int,
-                        help="Port for dump1090 server",
-                        required=True)
+                        help="Port for dump1090 server")
     parser.add_argument("--lat", type=float, help="Your latitude",
                         required=True)
     parser.add_argument("--lon", type=float, help="Your longitude",
@@ -181,8 +227,19 @@ def main():
     parser.add_argument("--max-altitude", type=int,
                          help="Ignore aircraft higher than this altitude (feet)",
                          default=100000)
+    geodesy.add_arguments(parser)
+    feed_client.add_arguments(parser)
+    load_shedding.add_arguments(parser)
+    map_snapshot.add_arguments(parser)
+    shared_map.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    if not((args.host is not None and args.port is not None) or
+            args.shared_map is not None):
+        sys.stderr.write("Either shared-map or host and port are required\n")
+        sys.exit(1)
+    metrics.start_exporters(args)
 
     adsb_theremin = ADSBTheremin(args)
     adsb_theremin.init()
@@ -7,13 +7,18 @@ Music in Python - https://scamp.marcevanstein.com/)
 """
 
 import argparse
+import asyncio
 import datetime
 import random
-import socket
 import sys
 import time
 
 import aircraft_map
+import callback_dispatcher
+import feed_client
+import geodesy
+import load_shedding
+import metrics
 import palettes
 import scamp_band
 import util
@@ -45,6 +50,9 @@ class ADSBTheremin(object):
     def __init__(self, session, args):
         self._host = args.host
         self._port = args.port
+        self._receivers = feed_client.receivers(args)
+        self._duplicate_window = args.duplicate_window
+        self._feed_options = feed_client.feed_options(args)
         self._mylat = args.lat
         self._mylon = args.lon
         self._midi_channels = range(args.midi_channels)  # 0-based
@@ -60,7 +68,11 @@ class ADSBTheremin(object):
         self._map = aircraft_map.AircraftMap(args.lat, args.lon,
                                              minimum_altitude=args.min_altitude,
                                              maximum_altitude=args.max_altitude,
-                                             maximum_distance=args.max_distance)
+                                             maximum_distance=args.max_distance,
+                                             geodesy_strategy=args.geodesy)
+        self._feed = load_shedding.LoadShedder(
+            self._map, max_lag=args.max_lag, interval=args.shed_interval,
+            audible=self.altitude_in_range)
         self._announcer_instrument = None
         self._session = session
         self._band = None
@@ -74,6 +86,10 @@ class ADSBTheremin(object):
         print("XXXXXXXXXXXXXXX")
         self._band.start()
         self._map.register_callback("Updater", self)
+        # Starting notes can be slow, so don't let it hold up reading
+        # from the receiver
+        self._map.set_dispatcher(callback_dispatcher.CallbackDispatcher(
+            overflow=callback_dispatcher.DROP_OLDEST))
 
 
     def all_notes_off(self):
@@ -81,7 +97,7 @@ class ADSBTheremin(object):
 
     def new_aircraft_callback(self, aircraft):
         print("New aircraft %s detected altitude %d distance %d" %
-              (aircraft.id, aircraft.altitude,
+              (aircraft.icao, aircraft.altitude,
                aircraft.distance_to(self._mylat, self._mylon)))
         # TODO "announce" the new aircraft with a percussive
         # pitched sound like a vibraphone, piano, marimba...
@@ -96,7 +112,7 @@ class ADSBTheremin(object):
         self._band.play_random_sustained(midi_note, volume=volume, duration=8.0)
 
     def update_aircraft_callback(self, aircraft):
-        # print("Position update for aircraft %s" % aircraft.id)
+        # print("Position update for aircraft %s" % aircraft.icao)
         # TODO: re-determine the pitch based on the altitude
         # and if it's different, play a note of the new pitch.
         midi_note = self.altitude_to_midi_note(aircraft)
@@ -104,7 +120,7 @@ class ADSBTheremin(object):
         #self._band.play_random_sustained(midi_note, volume=volume, duration=8.0)
 
     def remove_aircraft_callback(self, aircraft):
-        print("Removal of aircraft %s" % aircraft.id)
+        print("Removal of aircraft %s" % aircraft.icao)
         # TODO remove the instrument from the ensemble
 
     def altitude_to_midi_note(self, aircraft):
@@ -151,29 +167,13 @@ class ADSBTheremin(object):
         # and their positions, and will call us back (via update_callback(),
         # above) when a change in an aircraft's position or altitude
         # is detected.
+        client = feed_client.open_feed(
+            self._receivers, self._feed,
+            duplicate_window=self._duplicate_window,
+            on_disconnect=self.all_notes_off, **self._feed_options)
         try:
-            cont = True
-            while True:
-                if not cont:
-                    # Something other than a lost connection happened, so bail
-                    break
-                print("Connect to %s:%d" % (self._host, self._port))
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((self._host, self._port))
-                fp = sock.makefile()
-                cont = False
-                while True:
-                    line = fp.readline()
-                    if len(line) == 0:
-                        # This seems to happen sometimes, we need to reconnect
-                        print("No data, reconnect")
-                        cont = True
-                        sock.close()
-                        self.all_notes_off()
-                        break
-                    self._map.update_from_raw(line)
+            asyncio.run(client.run())
         finally:
-            sock.close()
             self.all_notes_off()
 
 
@@ -204,8 +204,13 @@ def main():
     parser.add_argument("--max-distance", type=int,
                          help="Ignore aircraft farther than this distance (feet)",
                          default=100000)
+    geodesy.add_arguments(parser)
+    feed_client.add_arguments(parser)
+    load_shedding.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics.start_exporters(args)
 
     adsb_theremin = ADSBTheremin(session, args)
     session.fork_unsynchronized(scale_update_thread)
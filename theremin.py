@@ -6,18 +6,27 @@ and turn then into music.
 """
 
 import argparse
+import asyncio
 import datetime
 import pygame.midi
-import socket
 import sys
-import time
 
 import aircraft_map
+import feed_client
+import geodesy
+import load_shedding
+import map_snapshot
+import metrics
 import palettes
+import shared_map
 
 DEFAULT_UPDATE_INTERVAL = 10.0  # seconds
 MAX_DISTANCE = 70000
 MIDI_VOLUME_MAX = 100
+PRIME_TIME = 3.0  # seconds to collect aircraft before the first sound
+
+MAKE_SOUND_TIME = metrics.REGISTRY.histogram(
+    "adsb_make_sound_duration_seconds", "Time spent rendering sound")
 
 
 def map_int(x_coord, in_min, in_max, out_min, out_max):
@@ -50,6 +59,9 @@ class ADSBTheremin(object):
     def __init__(self, args):
         self._host = args.host
         self._port = args.port
+        self._receivers = feed_client.receivers(args)
+        self._duplicate_window = args.duplicate_window
+        self._feed_options = feed_client.feed_options(args)
         self._mylat = args.lat
         self._mylon = args.lon
         self._midi_channels = range(args.midi_channels)  # 0-based
@@ -64,7 +76,18 @@ class ADSBTheremin(object):
         self._palette_offset = 0
         self._min_altitude = args.min_altitude
         self._max_altitude = args.max_altitude
-        self._map = aircraft_map.AircraftMap(args.lat, args.lon)
+        if args.shared_map is not None:
+            # ingest_daemon.py owns the feed and the map
+            self._map = shared_map.SharedMapReader(
+                args.shared_map, geodesy_strategy=args.geodesy)
+            self._feed = None
+            self._saver, self._warm = None, True
+        else:
+            self._map = aircraft_map.AircraftMap(
+                args.lat, args.lon, geodesy_strategy=args.geodesy)
+            self._feed = load_shedding.LoadShedder(
+                self._map, max_lag=args.max_lag, interval=args.shed_interval)
+            self._saver, self._warm = map_snapshot.warm_start(args, self._map)
 
     def init(self):
         if not pygame.midi.get_init():
@@ -108,7 +131,8 @@ class ADSBTheremin(object):
             max_altitude=self._max_altitude)
         midi_channel = 0
         for a in aircraft:
-            if (a.distance_to(self._mylat, self._mylon) > MAX_DISTANCE or
+            dist = a.distance_to(self._mylat, self._mylon)
+            if (dist > MAX_DISTANCE or
                 a.altitude > self._max_altitude):
                 print("ignoring %s" % a)
                 continue
@@ -118,8 +142,7 @@ class ADSBTheremin(object):
             note_index = int(float(a.altitude - 1) / self._max_altitude * len(palette))
 
             note = palette[note_index]
-            volume = int((MAX_DISTANCE -
-                          a.distance_to(self._mylat, self._mylon)) /
+            volume = int((MAX_DISTANCE - dist) /
                           MAX_DISTANCE * MIDI_VOLUME_MAX)
             deg = a.bearing_from(self._mylat, self._mylon)
             pan_value = map_bearing_to_pan(deg)
@@ -127,8 +150,7 @@ class ADSBTheremin(object):
             self._player.note_on(note, volume, midi_channel)
             print("Id %s alt %s MIDI note %d MIDI vol %d MIDI chan %d "
                   "dist %d m" %
-                  (a.id, a.altitude, note, volume, midi_channel + 1,
-                   a.distance_to(self._mylat, self._mylon)))
+                  (a.icao, a.altitude, note, volume, midi_channel + 1, dist))
             midi_channel = (midi_channel + 1) % self._num_midi_channels
         self._palette_index = (self._palette_index + self._shift) % len(self._all_palettes)
         self._palette = self._all_palettes[self._palette_index]
@@ -136,54 +158,48 @@ class ADSBTheremin(object):
         print("")
 
 
+    def _render(self):
+        with MAKE_SOUND_TIME.time():
+            self.make_sound()
+
+    async def _play(self):
+        if self._feed is None:
+            await feed_client.run_periodically(self._update_interval,
+                                               self._render)
+            return
+        client = feed_client.open_feed(
+            self._receivers, self._feed,
+            duplicate_window=self._duplicate_window,
+            on_disconnect=self.all_notes_off,
+            after_batch=self._saver.maybe_save if self._saver else None,
+            **self._feed_options)
+        # Let the aircraft map fill up for a little while before
+        # the first sound, unless it was loaded with some
+        prime_time = 0
+        if not self._warm:
+            print("Priming aircraft map...")
+            prime_time = PRIME_TIME
+        await asyncio.gather(
+            client.run(),
+            feed_client.run_periodically(self._update_interval, self._render,
+                                         initial_delay=prime_time))
+
     def play(self):
         try:
-            cont = True
-            while True:
-                if not cont:
-                    break
-                print("Connect to %s:%d" % (self._host, self._port))
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((self._host, self._port))
-                fp = sock.makefile()
-                # Prime the aircraft list - just get updates for a little while
-                print("Priming aircraft map...")
-                prime_start = time.time()
-                while True:
-                    if time.time() - prime_start > 3.0:
-                        break
-                    line = fp.readline()
-                    self._map.update_from_raw(line)
-                print("Done.")
-                last_midi_update = 0.0
-                cont = False
-                while True:
-                    line = fp.readline()
-                    if len(line) == 0:
-                        # This seems to happen sometimes, we need to reconnect
-                        print("No data, reconnect")
-                        cont = True
-                        sock.close()
-                        self.all_notes_off()
-                        break
-                    self._map.update_from_raw(line)
-                    if time.time() - last_midi_update > self._update_interval:
-                        self.make_sound()
-                        last_midi_update = time.time()
+            asyncio.run(self._play())
         finally:
-            sock.close()
             self.all_notes_off()
             pygame.midi.quit()
+            if self._saver is not None:
+                self._saver.save()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host",
-                        help="IP address or hostname of host running dump1090",
-                        required=True)
+                        help="IP address or hostname of host running dump1090")
     parser.add_argument("-p", "--port", type=int,
-                        help="Port for dump1090 server",
-                        required=True)
+                        help="Port for dump1090 server")
     parser.add_argument("--lat", type=float, help="Your latitude",
                         required=True)
     parser.add_argument("--lon", type=float, help="Your longitude",
@@ -206,8 +222,19 @@ def main():
     parser.add_argument("--max-altitude", type=int,
                          help="Ignore aircraft higher than this altitude (feet)",
                          default=100000)
+    geodesy.add_arguments(parser)
+    feed_client.add_arguments(parser)
+    load_shedding.add_arguments(parser)
+    map_snapshot.add_arguments(parser)
+    shared_map.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    if not((args.host is not None and args.port is not None) or
+            args.shared_map is not None):
+        sys.stderr.write("Either shared-map or host and port are required\n")
+        sys.exit(1)
+    metrics.start_exporters(args)
 
     adsb_theremin = ADSBTheremin(args)
     adsb_theremin.init()
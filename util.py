@@ -55,3 +55,31 @@ def distance_to(aircraft_latitude, aircraft_longitude, altitude,
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a));
     d = EARTH_RADIUS * c;
     return d
+
+
+def bearing_from(aircraft_latitude, aircraft_longitude,
+                 observer_latitude, observer_longitude):
+    """
+    Compute the bearing, in degrees, of the aircraft as seen from
+    the position given by observer_latitude and observer_longitude.
+    """
+    lat1_rad = math.radians(aircraft_latitude)
+    long1_rad = math.radians(aircraft_longitude)
+    lat2_rad = math.radians(observer_latitude)
+    long2_rad = math.radians(observer_longitude)
+
+    d_lon = long2_rad - long1_rad
+
+    d_phi = math.log(
+        math.tan(
+            lat2_rad/2.0+math.pi/4.0)/math.tan(lat1_rad/2.0+math.pi/4.0))
+
+    if abs(d_lon) > math.pi:
+        if d_lon > 0.0:
+            d_lon = -(2.0 * math.pi - d_lon)
+        else:
+            d_lon = (2.0 * math.pi + d_lon)
+
+    bearing = (math.degrees(math.atan2(d_lon, d_phi)) + 360.0) % 360.0;
+    return bearing
+